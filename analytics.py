@@ -0,0 +1,242 @@
+import importlib.util
+import os
+import re
+import sqlite3
+import uuid
+from datetime import date, datetime
+
+import numpy as np
+import pandas as pd
+
+import db
+import exporter
+import workers
+from db_async import get_table_version
+
+# Отчёты для админа: когорты по неделе регистрации и тепловая карта загрузки
+# студии. Считаются в рабочем процессе (workers.run) и кэшируются, пока не
+# изменились исходные таблицы
+
+# Версии из table_versions, от которых зависит отчёт: для users — узкая
+# user_cohorts (регистрация и приглашение), а не вся таблица с last_seen
+COHORT_TABLES = ("user_cohorts", "bookings", "coin_history")
+COHORT_WEEKS = 12  # сколько последних недель показывать
+
+
+def cohort_report(db_path: str | None = None, now: datetime | None = None) -> pd.DataFrame:
+    """Метрики когорт по неделе registration_date (с понедельника).
+
+    users — размер когорты, booked_rate — доля записавшихся хоть раз,
+    repeat_rate — доля записавшихся два раза и больше среди записавшихся,
+    attendance_rate — доля посещённых (confirmed = 2) среди прошедших
+    неотменённых записей, coins_spent — монеты на покупки в магазине,
+    referred — пришли по приглашению, referral_conversion — доля
+    записавшихся среди них.
+    """
+    now_ts = db.to_ts(now or datetime.now())
+    conn = sqlite3.connect(f"file:{db_path or db.DB_NAME}?mode=ro", uri=True)
+    try:
+        # Свёртки до строки на пользователя — в SQLite, дальше — векторно в pandas
+        users = pd.read_sql_query("""
+            WITH user_bookings AS (
+                SELECT telegram_id,
+                       COUNT(*) AS bookings,
+                       SUM(end_at < :now) AS past_bookings,
+                       SUM(confirmed = 2) AS attended
+                FROM bookings
+                WHERE confirmed != -1
+                GROUP BY telegram_id
+            ),
+            spend AS (
+                SELECT telegram_id, -SUM(amount) AS coins_spent
+                FROM coin_history
+                WHERE action = 'purchase'
+                GROUP BY telegram_id
+            )
+            SELECT DATE(u.registration_date, 'weekday 0', '-6 days') AS week,
+                   u.invited_by IS NOT NULL AS referred,
+                   COALESCE(b.bookings, 0) AS bookings,
+                   COALESCE(b.past_bookings, 0) AS past_bookings,
+                   COALESCE(b.attended, 0) AS attended,
+                   COALESCE(s.coins_spent, 0) AS coins_spent
+            FROM users u
+            LEFT JOIN user_bookings b ON b.telegram_id = u.telegram_id
+            LEFT JOIN spend s ON s.telegram_id = u.telegram_id
+            WHERE u.is_registered = 1 AND u.registration_date IS NOT NULL
+        """, conn, params={"now": now_ts})
+    finally:
+        conn.close()
+
+    users["booked"] = users["bookings"] > 0
+    users["repeat"] = users["bookings"] > 1
+    users["referred"] = users["referred"].astype(bool)
+    users["referred_booked"] = users["referred"] & users["booked"]
+
+    report = users.groupby("week").agg(
+        users=("booked", "size"),
+        booked=("booked", "sum"),
+        repeat=("repeat", "sum"),
+        past_bookings=("past_bookings", "sum"),
+        attended=("attended", "sum"),
+        coins_spent=("coins_spent", "sum"),
+        referred=("referred", "sum"),
+        referred_booked=("referred_booked", "sum"),
+    ).sort_index()
+    # Деление на ноль даёт NaN — в отчёте это "—"
+    report["booked_rate"] = report["booked"] / report["users"]
+    report["repeat_rate"] = report["repeat"] / report["booked"].where(report["booked"] > 0)
+    report["attendance_rate"] = report["attended"] / report["past_bookings"].where(report["past_bookings"] > 0)
+    report["referral_conversion"] = report["referred_booked"] / report["referred"].where(report["referred"] > 0)
+    return report
+
+
+_cache: dict[tuple, pd.DataFrame] = {}
+
+
+async def cohorts() -> pd.DataFrame:
+    # Ключ — версии исходных таблиц и день: "прошедшие записи" сдвигаются
+    # и без изменений в данных
+    versions = tuple([await get_table_version(table) for table in COHORT_TABLES])
+    key = (*versions, date.today())
+    if None in versions or key not in _cache:
+        report = await workers.run(cohort_report, db.DB_NAME)
+        _cache.clear()
+        _cache[key] = report
+        return report
+    return _cache[key]
+
+
+def _percent(value) -> str:
+    return "—" if pd.isna(value) else f"{value:.0%}"
+
+
+def format_cohorts(report: pd.DataFrame, weeks: int = COHORT_WEEKS) -> str:
+    if report.empty:
+        return "Пока нет зарегистрированных пользователей."
+
+    lines = [
+        "<b>📈 Когорты по неделе регистрации</b>",
+        "Зап. — записались, Повт. — записались снова, Приш. — пришли на прошедшие записи, "
+        "Реф. — записались из приглашённых\n",
+        "<pre>Неделя   Польз  Зап. Повт. Приш.  Монет  Реф.",
+    ]
+    for week, row in report.tail(weeks).iloc[::-1].iterrows():
+        lines.append(
+            f"{week[8:]}.{week[5:7]:<5} {int(row['users']):>5} {_percent(row['booked_rate']):>5} {_percent(row['repeat_rate']):>5}"
+            f" {_percent(row['attendance_rate']):>5} {int(row['coins_spent']):>6} {_percent(row['referral_conversion']):>5}"
+        )
+    lines.append("</pre>")
+    return "\n".join(lines)
+
+
+# Тепловая карта: доля занятых часов по дню недели и часу, отдельно по тарифам
+HEATMAP_TARIFFS = {"hourly": "🕒 Почасовой", "night": "🌙 Ночной"}
+WEEKDAYS = ("Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс")
+HEATMAP_CACHE_SIZE = 20  # сколько последних картинок держать в CACHE_DIR
+
+
+def heatmap_available() -> bool:
+    return importlib.util.find_spec("matplotlib") is not None
+
+
+def occupancy(db_path: str, start: str, end: str) -> np.ndarray:
+    """Доля занятых часов за [start, end): массив (тариф, день недели, час).
+
+    Каждая неотменённая запись раскладывается на часы векторно (np.repeat),
+    часы суммируются по ячейкам и делятся на число таких дней недели в периоде.
+    """
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        bookings = pd.read_sql_query("""
+            SELECT tariff, start_at, end_at FROM bookings
+            WHERE start_at >= ? AND start_at < ? AND confirmed != -1
+        """, conn, params=(start, end), parse_dates=["start_at", "end_at"])
+    finally:
+        conn.close()
+
+    tariff = bookings["tariff"].map({t: i for i, t in enumerate(HEATMAP_TARIFFS)})
+    bookings = bookings[tariff.notna()]
+    tariff = tariff[tariff.notna()].to_numpy(dtype=int)
+
+    hours = ((bookings["end_at"] - bookings["start_at"]) / pd.Timedelta(hours=1)).round()
+    hours = hours.clip(lower=0).to_numpy(dtype=int)
+    row = np.repeat(np.arange(len(hours)), hours)
+    offset = np.arange(hours.sum()) - np.repeat(np.cumsum(hours) - hours, hours)
+    slots = pd.DatetimeIndex(bookings["start_at"].to_numpy()[row] + offset * np.timedelta64(1, "h"))
+    # Ночная сессия последнего дня заходит за конец периода — эти часы не считаем
+    inside = slots < pd.Timestamp(end)
+
+    grid = np.zeros((len(HEATMAP_TARIFFS), 7, 24))
+    np.add.at(grid, (tariff[row][inside], slots.weekday[inside], slots.hour[inside]), 1)
+    days = np.bincount(pd.date_range(start, end, inclusive="left").weekday, minlength=7)
+    return np.divide(grid, days[None, :, None], out=np.zeros_like(grid), where=days[None, :, None] > 0)
+
+
+def _heatmap_name(start: str, end: str, version: int) -> str:
+    return f"heatmap_{start}_{end}.v{version}.png"
+
+
+def cached_heatmap(start: str, end: str, version: int) -> str | None:
+    path = os.path.join(exporter.CACHE_DIR, _heatmap_name(start, end, version))
+    return path if os.path.exists(path) else None
+
+
+def render_heatmap(db_path: str, start: str, end: str, version: int | None = None) -> str:
+    """PNG тепловой карты за [start, end). С версией bookings картинка
+    кладётся в кэш, без неё — разовый файл, который удаляет вызывающий.
+    Запускается в рабочем процессе."""
+    # Figure без pyplot: нет глобального состояния и GUI-бэкенда
+    from matplotlib.figure import Figure
+
+    grid = occupancy(db_path, start, end) * 100
+    last = (pd.Timestamp(end) - pd.Timedelta(days=1)).date()
+    fig = Figure(figsize=(11, 6.5), layout="constrained")
+    axes = fig.subplots(len(HEATMAP_TARIFFS), 1, sharex=True)
+    for ax, title, data in zip(axes, HEATMAP_TARIFFS.values(), grid):
+        image = ax.imshow(data, cmap="YlOrRd", vmin=0, vmax=100, aspect="auto")
+        ax.set_title(title.split(" ", 1)[1])
+        ax.set_yticks(range(7), WEEKDAYS)
+        for day, hour in zip(*np.nonzero(data)):
+            ax.text(hour, day, f"{data[day, hour]:.0f}", ha="center", va="center", fontsize=7)
+    axes[-1].set_xticks(range(24), [f"{h:02d}" for h in range(24)])
+    fig.colorbar(image, ax=axes, label="% занятых часов")
+    fig.suptitle(f"Загрузка студии {date.fromisoformat(start):%d.%m.%Y} — {last:%d.%m.%Y}")
+
+    if version is None:
+        os.makedirs(exporter.EXPORT_DIR, exist_ok=True)
+        path = os.path.join(exporter.EXPORT_DIR, f"heatmap-{uuid.uuid4().hex[:8]}.png")
+        fig.savefig(path, dpi=110)
+        return path
+
+    os.makedirs(exporter.CACHE_DIR, exist_ok=True)
+    name = _heatmap_name(start, end, version)
+    path = os.path.join(exporter.CACHE_DIR, name)
+    fig.savefig(path + ".tmp", dpi=110, format="png")
+    os.replace(path + ".tmp", path)
+
+    # Старые версии этого периода не понадобятся, остальные — не больше HEATMAP_CACHE_SIZE
+    same_period = re.compile(rf"heatmap_{re.escape(start)}_{re.escape(end)}\.v\d+\.png")
+    heatmaps = []
+    for other in os.listdir(exporter.CACHE_DIR):
+        if other.startswith("heatmap_") and other.endswith(".png") and other != name:
+            other_path = os.path.join(exporter.CACHE_DIR, other)
+            if same_period.fullmatch(other):
+                os.remove(other_path)
+            else:
+                heatmaps.append(other_path)
+    heatmaps.sort(key=os.path.getmtime, reverse=True)
+    for stale in heatmaps[HEATMAP_CACHE_SIZE - 1:]:
+        os.remove(stale)
+    return path
+
+
+async def heatmap(start: str, end: str) -> dict:
+    """Картинка за [start, end): path и cached (как у выгрузок exporter)."""
+    version = await get_table_version("bookings")
+    if version is not None:
+        # Записи не менялись — готовый файл, без рабочего процесса
+        path = cached_heatmap(start, end, version)
+        if path is not None:
+            return {"path": path, "cached": True}
+    path = await workers.run(render_heatmap, db.DB_NAME, start, end, version)
+    return {"path": path, "cached": version is not None}
@@ -7,9 +7,16 @@ from aiogram.client.default import DefaultBotProperties
 from dotenv import load_dotenv
 from handlers import register
 from handlers import start, booking, social, location  
-from db import init_db
+from db_async import init_db, checkpoint_loop, shutdown as shutdown_db
 from handlers import referral
 from notifier import check_bookings_loop  # ⏰ фоновая проверка записей
+from leader import LeaderLease
+from supervisor import supervisor
+from outbound import OutboundDispatcher
+from broadcast import broadcasts
+import workers
+from middlewares.activity import ActivityMiddleware
+from middlewares.unit_of_work import UnitOfWorkMiddleware
 
 # Загрузка .env
 load_dotenv()
@@ -22,15 +29,24 @@ async def main():
     )
 
     # Создание базы данных
-    init_db()
+    await init_db()
 
     # Инициализация бота
     bot = Bot(
         token=TOKEN,
         default=DefaultBotProperties(parse_mode="HTML")
     )
+    # Единственный Bot и его сессия на весь процесс; все отправки —
+    # через лимиты и полосы приоритета
+    bot.session.middleware(OutboundDispatcher())
     dp = Dispatcher(storage=MemoryStorage())
 
+    # Имя и последняя активность — в буфер, в БД пачками
+    activity = ActivityMiddleware()
+    dp.update.outer_middleware(activity)
+    # Одна транзакция БД на апдейт
+    dp.update.outer_middleware(UnitOfWorkMiddleware())
+
     # Подключение роутеров
     dp.include_router(start.router)
     dp.include_router(booking.router)
@@ -40,10 +56,24 @@ async def main():
     dp.include_router(referral.router)
 
     # Запуск фона: уведомления и подтверждения
-    asyncio.create_task(check_bookings_loop())
+    # Уведомления шлёт только один процесс — держатель аренды "notifier"
+    notifier_lease = LeaderLease("notifier")
+    supervisor.spawn("notifier", lambda: notifier_lease.run(lambda: check_bookings_loop(bot)))
+    # Рассылки — тоже в одном процессе; после рестарта продолжаются с курсора
+    broadcast_lease = LeaderLease("broadcasts")
+    supervisor.spawn("broadcasts", lambda: broadcast_lease.run(lambda: broadcasts.run(bot)))
+    supervisor.spawn("checkpoint", checkpoint_loop)  # обслуживание хранилища (контрольные точки WAL)
+    supervisor.spawn("activity", activity.run)
 
     # Запуск бота
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        # Остановить фон, дождаться начатых отправок, сбросить буферы и БД
+        await supervisor.shutdown()
+        await activity.flush()
+        await shutdown_db()
+        await asyncio.to_thread(workers.shutdown)
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,139 @@
+import asyncio
+import logging
+import time
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError
+
+import outbound
+import segments
+from db_async import (
+    advance_broadcast, get_broadcast, get_broadcast_recipients, get_running_broadcasts, set_broadcast_status,
+)
+from keyboards.admin_kb import get_broadcast_keyboard
+from supervisor import supervisor
+
+BATCH_SIZE = 100  # получателей за шаг курсора; после рестарта повторится не больше одной пачки
+CONCURRENCY = 25  # одновременных отправок; темп задаёт полоса "bulk" в outbound
+PROGRESS_INTERVAL = 5  # секунд между правками сообщения о ходе рассылки
+POLL_INTERVAL = 10  # как часто подбирать рассылки, запущенные из других процессов
+
+STATUS_TITLES = {
+    "running": "🚀 Рассылка идёт",
+    "paused": "⏸ Рассылка на паузе",
+    "cancelled": "⛔ Рассылка отменена",
+    "done": "📢 Рассылка завершена!",
+}
+
+
+def format_progress(broadcast: dict) -> str:
+    processed = broadcast["sent"] + broadcast["failed"]
+    return (
+        f"<b>{STATUS_TITLES[broadcast['status']]}</b> (#{broadcast['id']})\n"
+        f"👥 {segments.describe(broadcast['segment'])}\n\n"
+        f"📬 Обработано: {processed} из {broadcast['total']}\n"
+        f"✅ Отправлено: {broadcast['sent']}\n"
+        f"❌ Ошибок: {broadcast['failed']}"
+    )
+
+
+class BroadcastRunner:
+    """Рассылки админа как фоновые задания из таблицы broadcasts.
+
+    Получатели выбираются пачками по курсору telegram_id; после каждой пачки
+    курсор и счётчики сохраняются, поэтому пауза, отмена и рестарт бота не
+    теряют и не начинают рассылку заново. Ход рассылки — правкой одного
+    сообщения с кнопками паузы и отмены. Хендлеры меняют только статус в БД
+    и будят run(); задание замечает смену статуса между пачками.
+    """
+
+    def __init__(self):
+        self._tasks: dict[int, asyncio.Task] = {}
+        self._wakeup = asyncio.Event()
+
+    def wakeup(self):
+        self._wakeup.set()
+
+    async def run(self, bot: Bot):
+        try:
+            while True:
+                for broadcast in await get_running_broadcasts():
+                    task = self._tasks.get(broadcast["id"])
+                    if task is None or task.done():
+                        self._tasks[broadcast["id"]] = asyncio.create_task(self._run_job(bot, broadcast))
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                self._tasks = {i: t for i, t in self._tasks.items() if not t.done()}
+        finally:
+            # Начатые пачки доживут до конца через supervisor.track
+            for task in self._tasks.values():
+                task.cancel()
+            await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+            self._tasks.clear()
+
+    async def _run_job(self, bot: Bot, broadcast: dict):
+        reported_at = time.monotonic()
+        try:
+            while True:
+                broadcast = await get_broadcast(broadcast["id"])
+                if broadcast is None or broadcast["status"] != "running":
+                    break
+                recipients = await get_broadcast_recipients(broadcast["cursor"], BATCH_SIZE, broadcast["segment"])
+                if not recipients:
+                    await set_broadcast_status(broadcast["id"], "done")
+                    broadcast = await get_broadcast(broadcast["id"])
+                    break
+                await supervisor.track(self._send_batch(bot, broadcast, recipients))
+                if time.monotonic() - reported_at >= PROGRESS_INTERVAL:
+                    await self.report(bot, await get_broadcast(broadcast["id"]))
+                    reported_at = time.monotonic()
+        except Exception:
+            logging.exception("Broadcast %s failed", broadcast["id"])
+            raise
+        if broadcast is not None:
+            await self.report(bot, broadcast)
+
+    async def _send_batch(self, bot: Bot, broadcast: dict, recipients: list[int]):
+        slots = asyncio.Semaphore(CONCURRENCY)
+
+        async def send(user_id: int) -> bool:
+            async with slots:
+                try:
+                    if broadcast["source_message_id"]:
+                        # Копия сообщения админа: фото и видео не загружаются заново
+                        await bot.copy_message(
+                            chat_id=user_id,
+                            from_chat_id=broadcast["source_chat_id"],
+                            message_id=broadcast["source_message_id"],
+                        )
+                    else:
+                        await bot.send_message(chat_id=user_id, text=broadcast["text"])
+                    return True
+                except TelegramAPIError as e:
+                    logging.info("Broadcast %s to %s failed: %s", broadcast["id"], user_id, e)
+                    return False
+
+        # Рассылка — в нижней полосе: ответы пользователям идут вперёд неё
+        with outbound.priority("bulk"):
+            results = await asyncio.gather(*(send(user_id) for user_id in recipients))
+        sent = sum(results)
+        await advance_broadcast(broadcast["id"], recipients[-1], sent, len(results) - sent)
+
+    @staticmethod
+    async def report(bot: Bot, broadcast: dict):
+        try:
+            await bot.edit_message_text(
+                text=format_progress(broadcast),
+                chat_id=broadcast["status_chat_id"],
+                message_id=broadcast["status_message_id"],
+                reply_markup=get_broadcast_keyboard(broadcast["id"], broadcast["status"]),
+            )
+        except TelegramAPIError as e:
+            # "message is not modified", сообщение удалено — ход рассылки не важнее её самой
+            logging.debug("Broadcast %s progress not updated: %s", broadcast["id"], e)
+
+
+broadcasts = BroadcastRunner()
@@ -0,0 +1,62 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """Потокобезопасный LRU-кэш с временем жизни записей.
+
+    Заполнение из БД идёт в нескольких потоках параллельно с записями:
+    поколение ключа берётся до чтения (generation()) и передаётся в set(),
+    и если между ними ключ сбросили, значение уже устарело и не кладётся.
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expires = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def generation(self, key) -> int:
+        with self._lock:
+            return self._generations.get(key, 0)
+
+    def set(self, key, value, generation: int | None = None):
+        with self._lock:
+            if generation is not None and self._generations.get(key, 0) != generation:
+                return
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+                self._generations[key] = self._generations.get(key, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+# Профили пользователей (строки users). Заполняются в потоке БД при чтении,
+# сбрасываются мутаторами db.py после записи
+profiles = TTLCache(maxsize=20000, ttl=600)
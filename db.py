@@ -1,461 +1,1066 @@
+import contextvars
+import functools
+import inspect
+import os
+import queue
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+
+import migrations
+import occupancy
+import segments
+from cache import profiles
+
+DB_NAME = os.getenv("DB_PATH", "users.db")  # или путь к БД
+
+# Одно долгоживущее соединение на поток: без connect/close на каждый запрос,
+# а скомпилированные запросы остаются в кэше соединения (cached_statements)
+_local = threading.local()
+
+# Контрольные точки WAL делаем сами (checkpoint()), а не на случайном коммите
+WAL_CHECKPOINT_TRUNCATE_PAGES = 10000
+
+
+def _connect(readonly: bool = False) -> sqlite3.Connection:
+    if readonly:
+        # Только чтение: выгрузки и статистика не берут блокировку записи,
+        # а в WAL видят согласованный снимок, не мешая писателям
+        target, uri = f"file:{DB_NAME}?mode=ro", True
+    else:
+        target, uri = DB_NAME, False
+    conn = sqlite3.connect(
+        target,
+        uri=uri,
+        timeout=10,
+        isolation_level=None,  # транзакции открываем явно через transaction()
+        check_same_thread=False,
+        cached_statements=256,
+    )
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute("PRAGMA cache_size = -16000")
+    if readonly:
+        conn.execute("PRAGMA query_only = ON")
+        conn.execute("PRAGMA mmap_size = 268435456")
+    else:
+        conn.execute("PRAGMA wal_autocheckpoint = 0")
+    return conn
+
+
+class Session:
+    """Единица работы на один апдейт: одно соединение на все его запросы.
+
+    Пока сессия установлена в current_session, get_db_connection() отдаёт
+    её соединение, а transaction() внутри становится SAVEPOINT. При первом
+    обращении открывается отложенная транзакция (только чтение, без
+    блокировки записи). begin_write() перед первой записью фиксирует этот
+    снимок и открывает BEGIN IMMEDIATE, поэтому прочитанное до неё запись
+    не защищает: хендлер, который проверяет что-то чтением перед записью
+    (свободные часы, баланс, статус), сначала вызывает
+    Storage.begin_write().
+
+    Блокировка записи процесса держится до фиксации. Перед каждым запросом
+    к Telegram (outbound) сессия фиксирует записанное и отпускает её
+    (Storage.commit), чтобы сеть и лимиты отправки не задерживали записи
+    других апдейтов. Атомарна часть хендлера между запросами к Telegram,
+    а не апдейт целиком; исключение откатывает только незафиксированное.
+    Остаток фиксируется в close().
+    """
+
+    def __init__(self):
+        self.conn = None
+        self.writing = False
+        self.write_lock = None  # захват блокировки записи процесса (storage.sqlite)
+        self.calls_in_flight = 0  # запросы сессии, выполняющиеся сейчас (storage.sqlite)
+        self.touched = set()  # профили, изменённые в сессии
+        self.occupied = {}  # биты занятости новых записей по дням (occupancy)
+        self.freed = set()  # дни с отменёнными записями
+        self.committed_callbacks = []  # Storage.on_commit
+
+    def connection(self) -> sqlite3.Connection:
+        if self.conn is None:
+            conn = _checkout()
+            try:
+                conn.execute("BEGIN")
+            except BaseException:
+                _checkin(conn)
+                raise
+            self.conn = conn
+        return self.conn
+
+    def begin_write(self):
+        if self.writing:
+            return
+        conn, self.conn = self.conn or _checkout(), None
+        try:
+            if conn.in_transaction:
+                # Снимок чтения до первой записи: записей в нём нет, фиксировать нечего.
+                # Поднять его до записи нельзя — после чужого коммита это SQLITE_BUSY_SNAPSHOT
+                conn.execute("COMMIT")
+            conn.execute("BEGIN IMMEDIATE")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            _checkin(conn)
+            raise
+        self.conn, self.writing = conn, True
+
+    def close(self, commit: bool = True):
+        conn, self.conn = self.conn, None
+        committed = False
+        try:
+            if conn is not None:
+                try:
+                    conn.execute("COMMIT" if commit else "ROLLBACK")
+                    committed = commit and self.writing
+                except BaseException:
+                    if conn.in_transaction:
+                        conn.execute("ROLLBACK")
+                    raise
+                finally:
+                    _checkin(conn)
+                    self.writing = False
+        finally:
+            # До коммита кэш мог снова заполниться старыми данными
+            profiles.invalidate(*self.touched)
+            # Занятость меняется только зафиксированными записями и отменами
+            if committed:
+                occupancy.slots.occupy(self.occupied)
+                occupancy.slots.invalidate(*self.freed)
+            # Сессия может продолжиться после промежуточной фиксации
+            self.touched, self.occupied, self.freed = set(), {}, set()
+
+
+current_session: contextvars.ContextVar[Session | None] = contextvars.ContextVar("db_session", default=None)
+
+# Соединения сессий переиспользуются, а не открываются на каждый апдейт
+_session_conns = queue.SimpleQueue()
+
+
+def _checkout() -> sqlite3.Connection:
+    try:
+        return _session_conns.get_nowait()
+    except queue.Empty:
+        return _connect()
+
+
+def _checkin(conn: sqlite3.Connection):
+    _session_conns.put(conn)
+
+
+def get_db_connection() -> sqlite3.Connection:
+    session = current_session.get()
+    if session is not None:
+        return session.connection()
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _local.conn = _connect()
+    return conn
+
+
+def get_read_connection() -> sqlite3.Connection:
+    conn = getattr(_local, "read_conn", None)
+    if conn is None:
+        conn = _local.read_conn = _connect(readonly=True)
+    return conn
+
+
+def close_db_connection():
+    for attr in ("conn", "read_conn"):
+        conn = getattr(_local, attr, None)
+        if conn is not None:
+            conn.close()
+            setattr(_local, attr, None)
+    while not _session_conns.empty():
+        _session_conns.get_nowait().close()
+
+
+def checkpoint(mode: str = "PASSIVE") -> tuple[int, int, int]:
+    # (busy, страниц в WAL, перенесено в БД)
+    if mode not in ("PASSIVE", "FULL", "RESTART", "TRUNCATE"):
+        raise ValueError(f"Unknown checkpoint mode: {mode}")
+    c = get_db_connection()
+    busy, log, done = c.execute(f"PRAGMA wal_checkpoint({mode})").fetchone()
+    if mode == "PASSIVE" and not busy and log >= WAL_CHECKPOINT_TRUNCATE_PAGES and log == done:
+        # WAL разросся и полностью перенесён — обрежем файл
+        busy, log, done = c.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+    return busy, log, done
+
+
+@contextmanager
+def transaction():
+    """Короткая транзакция записи; вложенные вызовы становятся SAVEPOINT."""
+    conn = get_db_connection()
+    if conn.in_transaction:
+        conn.execute("SAVEPOINT tx")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK TO tx")
+            conn.execute("RELEASE tx")
+            raise
+        conn.execute("RELEASE tx")
+        return
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+def invalidate_profiles(*user_ids):
+    session = current_session.get()
+    if session is not None:
+        session.touched.update(user_ids)
+    profiles.invalidate(*user_ids)
+
+
+def occupy_slots(start_at: str, end_at: str):
+    # Новая или возвращённая запись: её биты дописываются в маски дней
+    masks = occupancy.day_masks(datetime.strptime(start_at, TS_FORMAT), datetime.strptime(end_at, TS_FORMAT))
+    session = current_session.get()
+    if session is not None:
+        for day, bits in masks.items():
+            session.occupied[day] = session.occupied.get(day, 0) | bits
+    else:
+        occupancy.slots.occupy(masks)
+
+
+def free_slots(start_at: str, end_at: str):
+    # Отмена: дни сбрасываются целиком — часы могла занимать и другая запись
+    days = occupancy.day_masks(datetime.strptime(start_at, TS_FORMAT), datetime.strptime(end_at, TS_FORMAT))
+    session = current_session.get()
+    if session is not None:
+        session.freed.update(days)
+    else:
+        occupancy.slots.invalidate(*days)
+
+
+def cache_profile(user_id: int, user: dict, generation: int):
+    # Незафиксированные данные сессии в общий кэш не кладём; generation —
+    # profiles.generation() до чтения строки (сброс после него отменяет заполнение)
+    if current_session.get() is None:
+        profiles.set(user_id, user, generation)
+
+
+def invalidates_profiles(*params):
+    """Сбрасывает кэш профилей для перечисленных аргументов после записи."""
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                return func(*args, **kwargs)
+            finally:
+                bound = signature.bind(*args, **kwargs)
+                invalidate_profiles(*(bound.arguments.get(p) for p in params))
+        return wrapper
+    return decorator
+
+
+# Время записей: start_at/end_at — абсолютные метки "YYYY-MM-DD HH:MM:SS"
+# (формат SQLite datetime()), сравниваются как строки и индексируются
+TS_FORMAT = "%Y-%m-%d %H:%M:%S"
+MAX_BOOKING_HOURS = 12  # с запасом: длиннее сессию выбрать нельзя
+BOOKING_DAY_HOURS = 30  # сетка дня: 0–30, где 24–30 — ночь до 06:00
+
+
+def to_ts(dt: datetime) -> str:
+    return dt.strftime(TS_FORMAT)
+
+
+def parse_period(text: str) -> tuple[date, date]:
+    """"01.09.2026-30.09.2026" -> (первый, последний день); ValueError — не разобрать."""
+    first, last = (datetime.strptime(part.strip(), "%d.%m.%Y").date() for part in text.split("-"))
+    return (first, last) if first <= last else (last, first)
+
+
+def booking_interval(date: str, time_from, time_to) -> tuple[datetime, datetime]:
+    day = datetime.strptime(date, "%Y-%m-%d")
+    return day + timedelta(hours=int(time_from)), day + timedelta(hours=int(time_to))
+
 
 def init_db():
-    conn = sqlite3.connect("users.db")
-    c = conn.cursor()
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            telegram_id INTEGER PRIMARY KEY,
-            full_name TEXT,
-            username TEXT,
-            birth_date TEXT,
-            phone TEXT,
-            birthdate TEXT,
-            age INTEGER,
-            underage INTEGER DEFAULT 0,
-            coins INTEGER DEFAULT 0,
-            invited_by INTEGER,
-            invited_count INTEGER DEFAULT 0,
-            is_registered INTEGER DEFAULT 0,
-            referrals_count INTEGER DEFAULT 0,
-            registration_date TEXT
-        )
-    """)
-
-    # Таблица магазина
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS shop_items (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT,
-            description TEXT,
-            price INTEGER
-        )
-    """)
+    c = get_db_connection()
+    c.execute("PRAGMA journal_mode = WAL")
+    migrations.migrate(c)
 
 
-    # Таблица записей
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS bookings (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            telegram_id INTEGER,
-            date TEXT,
-            time_from TEXT,
-            time_to TEXT,
-            tariff TEXT,
-            confirmed INTEGER DEFAULT 0,
-            attended INTEGER DEFAULT 0
-        )
-    """)
-
-    # История монет
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS coin_history (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            telegram_id INTEGER,
-            action TEXT,
-            amount INTEGER,
-            description TEXT,
-            timestamp TEXT
-        )
-    """)
-
-    # Покупки пользователя
+# --- Движок монет. Каждое списание/начисление — один атомарный UPDATE
+# с условием, поэтому параллельные покупки и правки админа не уводят баланс
+# в минус и не теряют обновления. Любое изменение users.coins пишется
+# в coin_history в той же транзакции вместе с итоговым балансом
+
+REFERRAL_BONUS = 10
+REFERRAL_LIMIT = 3  # бонус начисляется максимум за троих приглашённых
+
+
+class InsufficientCoins(Exception):
+    pass
+
+
+def record_coin_change(c: sqlite3.Connection, user_id: int, action: str, amount: int,
+                       balance: int, description: str):
+    if amount == 0:
+        return
     c.execute("""
-    CREATE TABLE IF NOT EXISTS purchases (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        telegram_id INTEGER,
-        shop_item_id INTEGER,
-        code TEXT,
-        status TEXT DEFAULT 'active',
-        timestamp TEXT
-    )
-    """)
+        INSERT INTO coin_history (telegram_id, action, amount, description, timestamp, balance_after)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, (user_id, action, amount, description, datetime.now().strftime(TS_FORMAT), balance))
 
 
-    conn.commit()
-    conn.close()
+def debit_coins(c: sqlite3.Connection, user_id: int, amount: int,
+                action: str = "debit", description: str = "") -> int | None:
+    # Новый баланс или None, если монет не хватает (или нет пользователя)
+    row = c.execute("""
+        UPDATE users SET coins = coins - ?
+        WHERE telegram_id = ? AND coins >= ?
+        RETURNING coins
+    """, (amount, user_id, amount)).fetchone()
+    if not row:
+        return None
+    record_coin_change(c, user_id, action, -amount, row[0], description)
+    return row[0]
 
-DB_NAME = "users.db"  # или путь к БД
+
+def credit_coins(c: sqlite3.Connection, user_id: int, amount: int,
+                 action: str = "credit", description: str = "") -> int | None:
+    row = c.execute("""
+        UPDATE users SET coins = coins + ?
+        WHERE telegram_id = ?
+        RETURNING coins
+    """, (amount, user_id)).fetchone()
+    if not row:
+        return None
+    record_coin_change(c, user_id, action, amount, row[0], description)
+    return row[0]
+
+
+def credit_referral_bonus(c: sqlite3.Connection, inviter_id: int) -> int | None:
+    # Лимит проверяется в том же UPDATE, что и начисление
+    row = c.execute("""
+        UPDATE users
+        SET invited_count = invited_count + 1,
+            coins = coins + ?
+        WHERE telegram_id = ? AND invited_count < ?
+        RETURNING coins
+    """, (REFERRAL_BONUS, inviter_id, REFERRAL_LIMIT)).fetchone()
+    if not row:
+        return None
+    record_coin_change(c, inviter_id, "referral", REFERRAL_BONUS, row[0], "Бонус за приглашённого друга")
+    return row[0]
+
+
+@invalidates_profiles("user_id")
+def adjust_user_coins(user_id: int, delta: int, clamp: bool = False,
+                      action: str = "admin", description: str = "Изменение администратором") -> int | None:
+    """Изменить баланс на delta. clamp=True — списать сколько есть, не уходя
+    ниже нуля; иначе при нехватке монет ничего не меняется (None)."""
+    with transaction() as c:
+        if delta >= 0:
+            return credit_coins(c, user_id, delta, action, description)
+        if clamp:
+            row = c.execute("SELECT coins FROM users WHERE telegram_id = ?", (user_id,)).fetchone()
+            if not row:
+                return None
+            return debit_coins(c, user_id, min(-delta, row[0]), action, description)
+        return debit_coins(c, user_id, -delta, action, description)
+
+
+def apply_coin_operations(operations: list[tuple[int, int, str]], action: str = "batch") -> list[int]:
+    """Пачка (user_id, delta, описание) в одной транзакции: всё или ничего.
+    Возвращает новые балансы, при нехватке монет — InsufficientCoins."""
+    balances = []
+    try:
+        with transaction() as c:
+            for user_id, delta, description in operations:
+                if delta >= 0:
+                    balance = credit_coins(c, user_id, delta, action, description)
+                else:
+                    balance = debit_coins(c, user_id, -delta, action, description)
+                if balance is None:
+                    raise InsufficientCoins(user_id)
+                balances.append(balance)
+    finally:
+        invalidate_profiles(*(op[0] for op in operations))
+    return balances
 
 
 def get_username_by_id(user_id: int) -> str | None:
-    conn = sqlite3.connect("users.db")
-    c = conn.cursor()
-    c.execute("SELECT username FROM users WHERE telegram_id = ?", (user_id,))
-    result = c.fetchone()
-    conn.close()
-    return result[0] if result else None
+    user = get_user(user_id)
+    return user["username"] if user else None
 
 def get_user_coins(user_id):
-    conn = sqlite3.connect("users.db")
-    c = conn.cursor()
-    c.execute("SELECT coins FROM users WHERE telegram_id = ?", (user_id,))
-    row = c.fetchone()
-    conn.close()
-    return row[0] if row else 0
+    user = get_user(user_id)
+    return user["coins"] if user else 0
 
+@invalidates_profiles("user_id")
 def update_user_coins(user_id, new_amount):
-    conn = sqlite3.connect("users.db")
-    c = conn.cursor()
-    c.execute("UPDATE users SET coins = ? WHERE telegram_id = ?", (new_amount, user_id))
-    conn.commit()
-    conn.close()
+    # Внутри транзакции записи чтение и запись не разойдутся
+    with transaction() as c:
+        row = c.execute("SELECT coins FROM users WHERE telegram_id = ?", (user_id,)).fetchone()
+        if not row:
+            return
+        c.execute("UPDATE users SET coins = ? WHERE telegram_id = ?", (new_amount, user_id))
+        record_coin_change(c, user_id, "admin", new_amount - row[0], new_amount, "Изменение администратором")
 
 
+@invalidates_profiles("inviter_id")
 def add_referral_bonus(inviter_id: int):
-    conn = sqlite3.connect("users.db")
-    c = conn.cursor()
-
-    c.execute("SELECT invited_count FROM users WHERE telegram_id = ?", (inviter_id,))
-    row = c.fetchone()
-    if row:
-        count = row[0]
-        if count < 3:
-            c.execute("""
-                UPDATE users
-                SET coins = coins + 10,
-                    invited_count = invited_count + 1
-                WHERE telegram_id = ?
-            """, (inviter_id,))
-            conn.commit()
-            conn.close()
-            return True
-    conn.close()
-    return False
+    with transaction() as c:
+        return credit_referral_bonus(c, inviter_id) is not None
 
 
 
 
 def get_user_referral_stats(user_id):
-    conn = sqlite3.connect("users.db")
-    c = conn.cursor()
-    c.execute("SELECT invited_count FROM users WHERE telegram_id = ?", (user_id,))
-    result = c.fetchone()
-    conn.close()
+    c = get_db_connection()
+    result = c.execute("SELECT invited_count FROM users WHERE telegram_id = ?", (user_id,)).fetchone()
     return result[0] if result else 0
 
 def get_user(user_id: int):
-    conn = sqlite3.connect("users.db")
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT * FROM users WHERE telegram_id = ?", (user_id,))
-    result = c.fetchone()
-    conn.close()
-    return dict(result) if result else None
-
+    cached = profiles.get(user_id)
+    if cached is not None:
+        return dict(cached)
+
+    generation = profiles.generation(user_id)
+    c = get_db_connection()
+    result = c.execute("SELECT * FROM users WHERE telegram_id = ?", (user_id,)).fetchone()
+    if not result:
+        return None
+    cache_profile(user_id, dict(result), generation)
+    return dict(result)
+
+
+
+def touch_users(rows: list[tuple[int, str | None, str | None, str]]):
+    """Пачка (telegram_id, username, full_name, last_seen) одной транзакцией."""
+    with transaction() as c:
+        c.executemany("""
+            UPDATE users SET username = ?, full_name = ?, last_seen = ?, blocked_at = NULL
+            WHERE telegram_id = ?
+        """, [(username, full_name, last_seen, telegram_id) for telegram_id, username, full_name, last_seen in rows])
+
+    # last_seen в кэше не нужен свежим, сбрасываем только сменивших имя
+    # и снова достижимых (написал боту — значит, не блокирует его)
+    stale = []
+    for telegram_id, username, full_name, _ in rows:
+        cached = profiles.get(telegram_id)
+        if cached is not None and (
+                (cached["username"], cached["full_name"]) != (username, full_name) or cached["blocked_at"]):
+            stale.append(telegram_id)
+    invalidate_profiles(*stale)
+
+
+def mark_user_blocked(telegram_id: int):
+    # Telegram окончательно отказал в доставке: пропускаем пользователя
+    # в рассылках и напоминаниях, пока он снова не напишет боту
+    c = get_db_connection()
+    c.execute("UPDATE users SET blocked_at = ? WHERE telegram_id = ? AND blocked_at IS NULL",
+              (to_ts(datetime.now()), telegram_id))
+    invalidate_profiles(telegram_id)
 
 
 def get_referral_count(referrer_id: int) -> int:
-    conn = sqlite3.connect("users.db")
-    c = conn.cursor()
-    c.execute("SELECT COUNT(*) FROM users WHERE invited_by = ?", (referrer_id,))
-    count = c.fetchone()[0]
-    conn.close()
-    return count
+    c = get_db_connection()
+    return c.execute("SELECT COUNT(*) FROM users WHERE invited_by = ?", (referrer_id,)).fetchone()[0]
 
 def user_exists(telegram_id: int) -> bool:
-    conn = sqlite3.connect("users.db")
-    c = conn.cursor()
-    c.execute("SELECT 1 FROM users WHERE telegram_id = ?", (telegram_id,))
-    result = c.fetchone()
-    conn.close()
-    return result is not None
+    return get_user(telegram_id) is not None
 
+@invalidates_profiles("telegram_id", "invited_by")
 def add_user(telegram_id, full_name, username, invited_by=None):
-    from datetime import datetime
-    conn = sqlite3.connect("users.db")
     registration_date = datetime.now().date().isoformat()
-    c = conn.cursor()
 
-    c.execute("SELECT 1 FROM users WHERE telegram_id = ?", (telegram_id,))
-    if c.fetchone():
-        conn.close()
-        return
+    with transaction() as c:
+        if c.execute("SELECT 1 FROM users WHERE telegram_id = ?", (telegram_id,)).fetchone():
+            return
 
-    c.execute("""
-        INSERT INTO users (telegram_id, full_name, username, invited_by, registration_date)
-        VALUES (?, ?, ?, ?, ?)
-    """, (telegram_id, full_name, username, invited_by, registration_date))
-
-    if invited_by and invited_by != telegram_id:
-        # Посчитаем уже приглашённых
-        c.execute("SELECT invited_count FROM users WHERE telegram_id = ?", (invited_by,))
-        row = c.fetchone()
-        if row:
-            current_count = row[0]
-            if current_count < 3:
-                c.execute("""
-                    UPDATE users
-                    SET invited_count = invited_count + 1,
-                        coins = coins + 10
-                    WHERE telegram_id = ?
-                """, (invited_by,))
+        c.execute("""
+            INSERT INTO users (telegram_id, full_name, username, invited_by, registration_date)
+            VALUES (?, ?, ?, ?, ?)
+        """, (telegram_id, full_name, username, invited_by, registration_date))
 
-    conn.commit()
-    conn.close()
+        if invited_by and invited_by != telegram_id:
+            credit_referral_bonus(c, invited_by)
 
 
 
 
 def is_user_registered(telegram_id: int) -> bool:
-    conn = sqlite3.connect("users.db")
-    c = conn.cursor()
-    c.execute("SELECT is_registered FROM users WHERE telegram_id = ?", (telegram_id,))
-    result = c.fetchone()
-    conn.close()
-    return result and result[0] == 1
-
-def get_booked_slots(date: str) -> list[tuple[str, str]]:
-    conn = sqlite3.connect("users.db")
-    c = conn.cursor()
-    c.execute("SELECT time_from, time_to FROM bookings WHERE date = ? AND confirmed != -1", (date,))
-    result = c.fetchall()
-    conn.close()
-    return result
+    user = get_user(telegram_id)
+    return bool(user and user["is_registered"] == 1)
 
-def add_booking(telegram_id: int, date: str, time_from: str, time_to: str, tariff: str):
-    conn = sqlite3.connect("users.db")
-    c = conn.cursor()
-    c.execute("""
-        INSERT INTO bookings (telegram_id, date, time_from, time_to, tariff)
-        VALUES (?, ?, ?, ?, ?)
-    """, (telegram_id, date, time_from, time_to, tariff))
-    conn.commit()
-    conn.close()
 
+def start_user(telegram_id: int, full_name: str, username: str, inviter_id: int | None = None) -> dict:
+    """Весь /start за одну транзакцию: создать или найти пользователя,
+    записать пригласившего и вернуть профиль."""
+    registration_date = datetime.now().date().isoformat()
+    result = {"is_new": False, "invited": False, "inviter_username": None}
+
+    generation = profiles.generation(telegram_id)
+    with transaction() as c:
+        cur = c.execute("""
+            INSERT OR IGNORE INTO users (telegram_id, full_name, username, registration_date)
+            VALUES (?, ?, ?, ?)
+        """, (telegram_id, full_name, username, registration_date))
+        result["is_new"] = cur.rowcount == 1
+        if not result["is_new"]:
+            # /start от заблокировавшего бота — он снова доступен для рассылок
+            c.execute("UPDATE users SET blocked_at = NULL WHERE telegram_id = ? AND blocked_at IS NOT NULL",
+                      (telegram_id,))
+
+        if inviter_id and inviter_id != telegram_id:
+            cur = c.execute("""
+                UPDATE users SET invited_by = ?
+                WHERE telegram_id = ? AND invited_by IS NULL
+            """, (inviter_id, telegram_id))
+            if cur.rowcount:
+                result["invited"] = True
+                credit_referral_bonus(c, inviter_id)
+                row = c.execute("SELECT username FROM users WHERE telegram_id = ?", (inviter_id,)).fetchone()
+                result["inviter_username"] = row[0] if row else None
+
+        user = dict(c.execute("SELECT * FROM users WHERE telegram_id = ?", (telegram_id,)).fetchone())
+
+    if result["invited"]:
+        invalidate_profiles(inviter_id)
+    cache_profile(telegram_id, user, generation)
+    result["user"] = dict(user)
+    return result
+
+def _booked_slots(c: sqlite3.Connection, date: str) -> list[tuple[int, int]]:
+    day = datetime.strptime(date, "%Y-%m-%d")
+    rows = c.execute("""
+        SELECT CAST(ROUND((julianday(start_at) - julianday(:day)) * 24) AS INTEGER),
+               CAST(ROUND((julianday(end_at) - julianday(:day)) * 24) AS INTEGER)
+        FROM bookings
+        WHERE start_at >= :lo AND start_at < :hi AND end_at > :day AND confirmed != -1
+    """, {
+        "day": to_ts(day),
+        "lo": to_ts(day - timedelta(hours=MAX_BOOKING_HOURS)),
+        "hi": to_ts(day + timedelta(hours=BOOKING_DAY_HOURS)),
+    }).fetchall()
+    return [tuple(row) for row in rows]
+
+def get_booked_slots(date: str) -> list[tuple[int, int]]:
+    # Часы (от, до) относительно полуночи date, в т.ч. ночные 24–30 и хвосты
+    # ночных сессий предыдущего дня (отрицательное "от")
+    return _booked_slots(get_db_connection(), date)
+
+def occupancy_shared() -> bool:
+    # Общий индекс занятости верен, пока сессия апдейта сама не меняла записи
+    session = current_session.get()
+    return session is None or not (session.occupied or session.freed)
+
+def get_day_occupancy(date: str) -> int:
+    """Маска занятых часов дня (occupancy.to_mask); промах индекса читает БД."""
+    if not occupancy_shared():
+        # Сессия видит свои незафиксированные записи — в общий индекс их не кладём
+        return occupancy.to_mask(get_booked_slots(date))
+    mask = occupancy.slots.get(date)
+    if mask is None:
+        generation = occupancy.slots.generation(date)
+        # Версия — до выборки: чужая правка между ними только заставит
+        # перечитать день при следующей сверке
+        version = get_table_version("bookings")
+        cached = occupancy.slots.lookup(date)
+        if cached is not None and version is not None and cached[1] == version:
+            mask = cached[0]
+        else:
+            mask = occupancy.to_mask(_booked_slots(get_read_connection(), date))
+        occupancy.slots.store(date, mask, generation, version)
+    return mask
+
+def add_booking(telegram_id: int, date: str, time_from: str, time_to: str, tariff: str) -> int:
+    start_at, end_at = booking_interval(date, time_from, time_to)
+    c = get_db_connection()
+    cur = c.execute("""
+        INSERT INTO bookings (telegram_id, date, time_from, time_to, tariff, start_at, end_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, (telegram_id, date, time_from, time_to, tariff, to_ts(start_at), to_ts(end_at)))
+    occupy_slots(to_ts(start_at), to_ts(end_at))
+    return cur.lastrowid
+
+@invalidates_profiles("telegram_id")
 def save_user(telegram_id, full_name, birth_date, phone, age, underage):
-    conn = sqlite3.connect("users.db")
-    c = conn.cursor()
+    c = get_db_connection()
     c.execute("""
-        INSERT OR REPLACE INTO users (telegram_id, full_name, birth_date, phone, age, underage)
+        INSERT OR REPLACE INTO users (telegram_id, full_name, birthdate, phone, age, underage)
         VALUES (?, ?, ?, ?, ?, ?)
     """, (telegram_id, full_name, birth_date, phone, age, underage))
-    conn.commit()
-    conn.close()
 
+@invalidates_profiles("telegram_id")
 def add_or_update_user(telegram_id: int, full_name: str, birthday: str, phone: str, underage: bool):
-    conn = sqlite3.connect("users.db")
-    cursor = conn.cursor()
-
-    cursor.execute("""
-        INSERT INTO users (telegram_id, full_name, birthday, phone, underage)
+    # Колонки birthday в схеме нет — дата рождения хранится в birthdate
+    c = get_db_connection()
+    c.execute("""
+        INSERT INTO users (telegram_id, full_name, birthdate, phone, underage)
         VALUES (?, ?, ?, ?, ?)
         ON CONFLICT(telegram_id) DO UPDATE SET
             full_name=excluded.full_name,
-            birthday=excluded.birthday,
+            birthdate=excluded.birthdate,
             phone=excluded.phone,
             underage=excluded.underage
     """, (telegram_id, full_name, birthday, phone, underage))
 
-    conn.commit()
-    conn.close()
-
-def get_db_connection():
-    return sqlite3.connect(DB_NAME)
-
 
+@invalidates_profiles("telegram_id")
 def add_user_after_register(telegram_id, full_name, birth_date, phone, age, underage):
-    conn = sqlite3.connect("users.db")
-    c = conn.cursor()
+    c = get_db_connection()
     c.execute("""
         UPDATE users
         SET full_name = ?, birthdate = ?, phone = ?, age = ?, underage = ?, is_registered = 1
         WHERE telegram_id = ?
     """, (full_name, birth_date, phone, age, underage, telegram_id))
-    conn.commit()
-    conn.close()
 
 
 
 
+@invalidates_profiles("referrer_id")
 def add_referral_reward(referrer_id: int):
-    conn = get_db_connection()
-    c = conn.cursor()
-    # Увеличим монеты и количество рефералов
-    c.execute("""
-        UPDATE users
-        SET coins = coins + 10,
-            referrals_count = referrals_count + 1
-        WHERE telegram_id = ?
-    """, (referrer_id,))
-    conn.commit()
-    conn.close()
+    with transaction() as c:
+        # Увеличим монеты и количество рефералов
+        row = c.execute("""
+            UPDATE users
+            SET coins = coins + ?,
+                referrals_count = referrals_count + 1
+            WHERE telegram_id = ?
+            RETURNING coins
+        """, (REFERRAL_BONUS, referrer_id)).fetchone()
+        if row:
+            record_coin_change(c, referrer_id, "referral", REFERRAL_BONUS, row[0], "Награда за реферала")
 
 
+@invalidates_profiles("telegram_id", "inviter_id")
 def set_invited_by(telegram_id: int, inviter_id: int):
-    conn = sqlite3.connect("users.db")
-    c = conn.cursor()
-    c.execute("SELECT invited_by FROM users WHERE telegram_id = ?", (telegram_id,))
-    result = c.fetchone()
+    with transaction() as c:
+        result = c.execute("SELECT invited_by FROM users WHERE telegram_id = ?", (telegram_id,)).fetchone()
 
-    if result and result[0] is None and inviter_id != telegram_id:
-        c.execute("UPDATE users SET invited_by = ? WHERE telegram_id = ?", (inviter_id, telegram_id))
+        if result and result[0] is None and inviter_id != telegram_id:
+            c.execute("UPDATE users SET invited_by = ? WHERE telegram_id = ?", (inviter_id, telegram_id))
 
-        # Попробуем начислить бонус
-        c.execute("SELECT invited_count FROM users WHERE telegram_id = ?", (inviter_id,))
-        row = c.fetchone()
-        if row:
-            current_count = row[0]
-            if current_count < 3:
-                c.execute("""
-                    UPDATE users
-                    SET invited_count = invited_count + 1,
-                        coins = coins + 10
-                    WHERE telegram_id = ?
-                """, (inviter_id,))
-
-        conn.commit()
-        conn.close()
-        return True
-    conn.close()
+            # Попробуем начислить бонус
+            credit_referral_bonus(c, inviter_id)
+            return True
     return False
 
 import random
 import string
-from datetime import datetime
 
 def generate_code():
     return f"{''.join(random.choices(string.ascii_uppercase + string.digits, k=5))}-" \
            f"{''.join(random.choices(string.ascii_uppercase + string.digits, k=5))}"
 
+@invalidates_profiles("user_id")
 def purchase_item(user_id, item_id):
-    conn = sqlite3.connect("users.db")
-    c = conn.cursor()
-
-    # Получим товар
-    c.execute("SELECT name, price, description FROM shop_items WHERE id = ?", (item_id,))
-    row = c.fetchone()
-    if not row:
-        conn.close()
-        return False, "❌ Товар не найден."
-
-    name, price, desc = row
-
-    # Проверим монеты
-    c.execute("SELECT coins FROM users WHERE telegram_id = ?", (user_id,))
-    user_row = c.fetchone()
-    if not user_row or user_row[0] < price:
-        conn.close()
-        return False, "❌ Недостаточно монет."
+    with transaction() as c:
+        # Получим товар
+        row = c.execute("SELECT name, price, description FROM shop_items WHERE id = ?", (item_id,)).fetchone()
+        if not row:
+            return False, "❌ Товар не найден."
+
+        name, price, desc = row
+
+        # Проверка, списание и запись в историю — один условный UPDATE, без гонки
+        if debit_coins(c, user_id, price, "purchase", f"Покупка: {name}") is None:
+            return False, "❌ Недостаточно монет."
+
+        # Добавим в покупки
+        code = generate_code()
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        c.execute("""
+            INSERT INTO purchases (telegram_id, shop_item_id, code, timestamp)
+            VALUES (?, ?, ?, ?)
+        """, (user_id, item_id, code, timestamp))
 
-    # Вычтем монеты
-    c.execute("UPDATE users SET coins = coins - ? WHERE telegram_id = ?", (price, user_id))
-
-    # Добавим в покупки
-    code = generate_code()
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    c.execute("""
-        INSERT INTO purchases (telegram_id, shop_item_id, code, timestamp)
-        VALUES (?, ?, ?, ?)
-    """, (user_id, item_id, code, timestamp))
-
-    # Добавим в историю
-    c.execute("""
-        INSERT INTO coin_history (telegram_id, action, amount, description, timestamp)
-        VALUES (?, 'purchase', ?, ?, ?)
-    """, (user_id, -price, f"Покупка: {name}", timestamp))
-
-    conn.commit()
-    conn.close()
     return True, f"✅ Вы купили '{name}' за {price} монет."
 
 
 def get_coin_history(user_id: int) -> list[dict]:
-    conn = sqlite3.connect("users.db")
-    conn.row_factory = sqlite3.Row  # Чтобы получить доступ к полям по имени
-    c = conn.cursor()
-
-    c.execute("""
+    c = get_db_connection()
+    rows = c.execute("""
         SELECT action, amount, description, timestamp
         FROM coin_history
         WHERE telegram_id = ?
-        ORDER BY timestamp DESC
-    """, (user_id,))
-    
-    rows = c.fetchall()
-    conn.close()
-
+        ORDER BY timestamp DESC, id DESC
+    """, (user_id,)).fetchall()
     return [dict(row) for row in rows]
 
 
 def get_active_purchases(user_id: int) -> list[dict]:
-    conn = sqlite3.connect("users.db")
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-
-    c.execute("""
+    c = get_db_connection()
+    rows = c.execute("""
         SELECT p.id, p.shop_item_id, p.code, p.status, p.timestamp, s.name, s.description
         FROM purchases p
         JOIN shop_items s ON p.shop_item_id = s.id
         WHERE p.telegram_id = ? AND p.status = 'active'
         ORDER BY p.timestamp DESC
-    """, (user_id,))
-
-    rows = c.fetchall()
-    conn.close()
-
+    """, (user_id,)).fetchall()
     return [dict(row) for row in rows]
 
 
 def get_all_shop_items() -> list[dict]:
-    conn = sqlite3.connect("users.db")
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-
-    c.execute("SELECT id, name, description, price FROM shop_items ORDER BY id")
-    rows = c.fetchall()
-    conn.close()
-
+    c = get_db_connection()
+    rows = c.execute("SELECT id, name, description, price FROM shop_items ORDER BY id").fetchall()
     return [dict(row) for row in rows]
 
 
 def get_user_by_username(username: str) -> dict | None:
-    conn = sqlite3.connect("users.db")
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT * FROM users WHERE username = ?", (username,))
-    result = c.fetchone()
-    conn.close()
+    c = get_db_connection()
+    result = c.execute("SELECT * FROM users WHERE username = ?", (username,)).fetchone()
     return dict(result) if result else None
 
 
 def get_user_bookings(telegram_id: int) -> list[dict]:
-    conn = sqlite3.connect("users.db")
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("""
-        SELECT * FROM bookings 
+    c = get_db_connection()
+    rows = c.execute("""
+        SELECT * FROM bookings
         WHERE telegram_id = ? AND confirmed != -1
         ORDER BY date, time_from
-    """, (telegram_id,))
-    rows = c.fetchall()
-    conn.close()
+    """, (telegram_id,)).fetchall()
     return [dict(row) for row in rows]
 
 
 def get_user_purchases(telegram_id: int) -> list[dict]:
-    conn = sqlite3.connect("users.db")
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("""
+    c = get_db_connection()
+    rows = c.execute("""
         SELECT p.id, p.shop_item_id, p.code, p.status, p.timestamp, s.name, s.description
         FROM purchases p
         JOIN shop_items s ON p.shop_item_id = s.id
         WHERE p.telegram_id = ?
         ORDER BY p.timestamp DESC
-    """, (telegram_id,))
-    rows = c.fetchall()
-    conn.close()
+    """, (telegram_id,)).fetchall()
     return [dict(row) for row in rows]
 
 
 def mark_purchase_as_used(purchase_id: int):
-    conn = sqlite3.connect("users.db")
-    c = conn.cursor()
+    c = get_db_connection()
     c.execute("""
         UPDATE purchases
         SET status = 'used'
         WHERE id = ?
     """, (purchase_id,))
-    conn.commit()
-    conn.close()
+
+
+# --- Записи: статусы (0 — ждёт подтверждения, 1 — подтверждена,
+# 2 — пришёл, 3 — ждёт отметки админа, -1 — отменена)
+
+def get_booking(booking_id: int) -> dict | None:
+    c = get_db_connection()
+    row = c.execute("SELECT * FROM bookings WHERE id = ?", (booking_id,)).fetchone()
+    return dict(row) if row else None
+
+
+def set_booking_status(booking_id: int, status: int, expected: int | None = None) -> bool:
+    # expected — сменить статус, только если он всё ещё такой (без гонки с пользователем)
+    c = get_db_connection()
+    if expected is None:
+        row = c.execute(
+            "UPDATE bookings SET confirmed = ? WHERE id = ? RETURNING start_at, end_at", (status, booking_id)
+        ).fetchone()
+    else:
+        row = c.execute(
+            "UPDATE bookings SET confirmed = ? WHERE id = ? AND confirmed = ? RETURNING start_at, end_at",
+            (status, booking_id, expected)
+        ).fetchone()
+    if row is None:
+        return False
+    if status == -1:
+        free_slots(*row)
+    elif expected is None or expected == -1:
+        # Запись могла быть отменённой — снова занимает свои часы
+        occupy_slots(*row)
+    return True
+
+
+def cancel_user_booking(booking_id: int, telegram_id: int) -> bool:
+    # Проверка владельца и отмена одним запросом
+    c = get_db_connection()
+    row = c.execute("""
+        UPDATE bookings SET confirmed = -1
+        WHERE id = ? AND telegram_id = ? AND confirmed >= 0
+        RETURNING start_at, end_at
+    """, (booking_id, telegram_id)).fetchone()
+    if row is None:
+        return False
+    free_slots(*row)
+    return True
+
+
+def get_user_bookings_by_status(telegram_id: int, status: str) -> list[dict]:
+    conditions = {
+        "active": "confirmed >= 0",
+        "cancelled": "confirmed = -1",
+        "past": "confirmed = 2",
+    }
+    c = get_db_connection()
+    rows = c.execute(f"""
+        SELECT id, date, time_from, time_to, start_at, end_at FROM bookings
+        WHERE telegram_id = ? AND {conditions[status]}
+        ORDER BY start_at
+    """, (telegram_id,)).fetchall()
+    return [dict(row) for row in rows]
+
+
+def get_upcoming_user_bookings(telegram_id: int, now: datetime) -> list[dict]:
+    c = get_db_connection()
+    rows = c.execute("""
+        SELECT id, date, time_from, time_to, start_at, end_at FROM bookings
+        WHERE telegram_id = ? AND confirmed >= 0 AND start_at > ?
+        ORDER BY start_at
+    """, (telegram_id, to_ts(now))).fetchall()
+    return [dict(row) for row in rows]
+
+
+def get_bookings_in_range(start: datetime, end: datetime) -> list[dict]:
+    # Активные записи, пересекающиеся с [start, end)
+    c = get_db_connection()
+    rows = c.execute("""
+        SELECT * FROM bookings
+        WHERE start_at >= ? AND start_at < ? AND end_at > ? AND confirmed != -1
+        ORDER BY start_at
+    """, (to_ts(start - timedelta(hours=MAX_BOOKING_HOURS)), to_ts(end), to_ts(start))).fetchall()
+    return [dict(row) for row in rows]
+
+
+def get_finished_confirmed_bookings(now: datetime) -> list[tuple]:
+    c = get_db_connection()
+    rows = c.execute("""
+        SELECT id, telegram_id, date, time_from, time_to
+        FROM bookings
+        WHERE confirmed = 1 AND end_at < ?
+    """, (to_ts(now),)).fetchall()
+    return [tuple(row) for row in rows]
+
+
+def get_last_booking_id() -> int:
+    c = get_db_connection()
+    return c.execute("SELECT COALESCE(MAX(id), 0) FROM bookings").fetchone()[0]
+
+
+def get_new_bookings(after_id: int, limit: int = 500) -> list[dict]:
+    # Записи, созданные после after_id (в том числе другими процессами бота)
+    c = get_db_connection()
+    rows = c.execute("""
+        SELECT * FROM bookings WHERE id > ? ORDER BY id LIMIT ?
+    """, (after_id, limit)).fetchall()
+    return [dict(row) for row in rows]
+
+
+def claim_notification(booking_id: int, kind: str) -> bool:
+    # True — уведомление ещё не отправлялось и теперь закреплено за нами
+    c = get_db_connection()
+    cur = c.execute("""
+        INSERT OR IGNORE INTO notification_log (booking_id, kind, sent_at) VALUES (?, ?, ?)
+    """, (booking_id, kind, datetime.now().strftime(TS_FORMAT)))
+    return cur.rowcount == 1
+
+
+def release_notification(booking_id: int, kind: str):
+    # Отправка не удалась — снимаем захват, чтобы уведомление можно было повторить
+    c = get_db_connection()
+    c.execute("DELETE FROM notification_log WHERE booking_id = ? AND kind = ?", (booking_id, kind))
+
+
+def get_future_records(today: str) -> list[tuple]:
+    c = get_read_connection()
+    rows = c.execute("""
+        SELECT b.date, b.time_from, b.time_to, b.tariff, b.confirmed, b.attended,
+               u.full_name, u.username, b.start_at
+        FROM bookings b
+        JOIN users u ON b.telegram_id = u.telegram_id
+        WHERE b.start_at >= ? AND b.confirmed != -1
+        ORDER BY b.start_at
+    """, (today,)).fetchall()
+    return [tuple(row) for row in rows]
+
+
+def get_past_records(today: str, since: str) -> list[tuple]:
+    c = get_read_connection()
+    rows = c.execute("""
+        SELECT b.date, b.time_from, b.time_to, b.tariff, b.confirmed, b.attended,
+               u.full_name, u.username, b.start_at
+        FROM bookings b
+        JOIN users u ON b.telegram_id = u.telegram_id
+        WHERE b.start_at < ? AND b.start_at >= ? AND b.confirmed != -1
+        ORDER BY b.start_at DESC
+    """, (today, since)).fetchall()
+    return [tuple(row) for row in rows]
+
+
+def get_statistics(since: str, until: str | None = None) -> dict:
+    # Дни [since, until] включительно (без until — и будущие записи):
+    # сумма строк daily_stats по первичному ключу
+    c = get_read_connection()
+    row = c.execute("""
+        SELECT COALESCE(SUM(new_users), 0), COALESCE(SUM(bookings), 0), COALESCE(SUM(cancelled), 0),
+               COALESCE(SUM(attended), 0), COALESCE(SUM(purchases), 0)
+        FROM daily_stats WHERE day BETWEEN ? AND ?
+    """, (since, until or "9999-12-31")).fetchone()
+    return dict(zip(("new_users", "total_bookings", "canceled", "attended", "bought"), row))
+
+
+def rebuild_daily_stats():
+    # Полный пересчёт сводки (например, после ручной правки таблиц в обход бота)
+    with transaction() as c:
+        migrations.rebuild_daily_stats(c)
+
+
+# --- Аренды (выбор лидера между процессами). Время — time.time(),
+# общее для процессов на одной машине с одной БД
+
+def acquire_lease(name: str, holder: str, ttl: float) -> bool:
+    # Взять свободную или просроченную аренду либо продлить свою — одним запросом
+    now = time.time()
+    c = get_db_connection()
+    cur = c.execute("""
+        INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?)
+        ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at
+        WHERE leases.holder = excluded.holder OR leases.expires_at < ?
+    """, (name, holder, now + ttl, now))
+    return cur.rowcount == 1
+
+
+def release_lease(name: str, holder: str):
+    c = get_db_connection()
+    c.execute("DELETE FROM leases WHERE name = ? AND holder = ?", (name, holder))
+
+
+# --- Рассылки (broadcast.py): задание с курсором по telegram_id получателей
+
+# Допустимые переходы статуса: новый статус -> из каких можно в него перейти
+BROADCAST_TRANSITIONS = {
+    "paused": ("running",),
+    "running": ("paused",),
+    "cancelled": ("running", "paused"),
+    "done": ("running",),
+}
+
+
+def count_audience(segment: str) -> int:
+    where, params = segments.sql_filter(segment, datetime.now())
+    c = get_read_connection()
+    return c.execute(
+        f"SELECT COUNT(*) FROM users u WHERE u.is_registered = 1 AND u.blocked_at IS NULL AND {where}", params
+    ).fetchone()[0]
+
+
+def create_broadcast(admin_id: int, text: str, status_chat_id: int, status_message_id: int,
+                     segment: str = "all", source_chat_id: int | None = None,
+                     source_message_id: int | None = None) -> dict:
+    # source_* — сообщение админа для copy_message (медиа); без него шлётся text
+    where, params = segments.sql_filter(segment, datetime.now())
+    with transaction() as c:
+        total = c.execute(
+            f"SELECT COUNT(*) FROM users u WHERE u.is_registered = 1 AND u.blocked_at IS NULL AND {where}", params
+        ).fetchone()[0]
+        cur = c.execute("""
+            INSERT INTO broadcasts (admin_id, text, total, status_chat_id, status_message_id, created_at,
+                                    segment, source_chat_id, source_message_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (admin_id, text, total, status_chat_id, status_message_id, to_ts(datetime.now()),
+              segment, source_chat_id, source_message_id))
+        return dict(c.execute("SELECT * FROM broadcasts WHERE id = ?", (cur.lastrowid,)).fetchone())
+
+
+def get_broadcast(broadcast_id: int) -> dict | None:
+    c = get_db_connection()
+    row = c.execute("SELECT * FROM broadcasts WHERE id = ?", (broadcast_id,)).fetchone()
+    return dict(row) if row else None
+
+
+def get_running_broadcasts() -> list[dict]:
+    c = get_db_connection()
+    return [dict(row) for row in c.execute("SELECT * FROM broadcasts WHERE status = 'running' ORDER BY id")]
+
+
+def get_broadcast_recipients(after_id: int, limit: int, segment: str = "all") -> list[int]:
+    # Keyset по первичному ключу: каждая пачка — короткий проход индекса,
+    # а не OFFSET и не весь список получателей в памяти
+    where, params = segments.sql_filter(segment, datetime.now())
+    c = get_read_connection()
+    return [row[0] for row in c.execute(f"""
+        SELECT u.telegram_id FROM users u
+        WHERE u.is_registered = 1 AND u.blocked_at IS NULL AND u.telegram_id > ? AND {where}
+        ORDER BY u.telegram_id LIMIT ?
+    """, (after_id, *params, limit))]
+
+
+def advance_broadcast(broadcast_id: int, cursor: int, sent: int, failed: int):
+    c = get_db_connection()
+    c.execute("""
+        UPDATE broadcasts SET cursor = ?, sent = sent + ?, failed = failed + ? WHERE id = ?
+    """, (cursor, sent, failed, broadcast_id))
+
+
+def set_broadcast_status(broadcast_id: int, status: str) -> bool:
+    # False — переход недопустим (рассылка уже завершена, отменена и т.п.)
+    allowed = BROADCAST_TRANSITIONS[status]
+    finished_at = to_ts(datetime.now()) if status in ("done", "cancelled") else None
+    c = get_db_connection()
+    cur = c.execute(f"""
+        UPDATE broadcasts SET status = ?, finished_at = ?
+        WHERE id = ? AND status IN ({", ".join("?" * len(allowed))})
+    """, (status, finished_at, broadcast_id, *allowed))
+    return cur.rowcount > 0
+
+
+# --- Магазин (админ)
+
+SHOP_ITEM_FIELDS = ("name", "description", "price")
+
+
+def add_shop_item(name: str, description: str, price: int):
+    c = get_db_connection()
+    c.execute("INSERT INTO shop_items (name, description, price) VALUES (?, ?, ?)", (name, description, price))
+
+
+def update_shop_item(item_id: int, field: str, value):
+    if field not in SHOP_ITEM_FIELDS:
+        raise ValueError(f"Unknown shop item field: {field}")
+    c = get_db_connection()
+    c.execute(f"UPDATE shop_items SET {field} = ? WHERE id = ?", (value, item_id))
+
+
+def delete_shop_item(item_id: int) -> str | None:
+    # Возвращает название удалённого товара или None, если его не было
+    with transaction() as c:
+        row = c.execute("SELECT name FROM shop_items WHERE id = ?", (item_id,)).fetchone()
+        if not row:
+            return None
+        c.execute("DELETE FROM shop_items WHERE id = ?", (item_id,))
+        return row[0]
+
+
+# --- Экспорт
+
+def get_table_version(table: str) -> int | None:
+    # Растёт с каждым изменением таблицы (триггеры миграции 12)
+    c = get_read_connection()
+    row = c.execute("SELECT version FROM table_versions WHERE name = ?", (table,)).fetchone()
+    return row[0] if row else None
+
+
+def get_export_watermark(table: str) -> int | None:
+    c = get_read_connection()
+    row = c.execute("SELECT last_id FROM export_watermarks WHERE name = ?", (table,)).fetchone()
+    return row[0] if row else None
+
+
+def set_export_watermark(table: str, last_id: int):
+    # Водяной знак только растёт: поздно дошедшая старая выгрузка его не откатит
+    c = get_db_connection()
+    c.execute("""
+        INSERT INTO export_watermarks (name, last_id, exported_at) VALUES (?, ?, ?)
+        ON CONFLICT(name) DO UPDATE SET last_id = excluded.last_id, exported_at = excluded.exported_at
+        WHERE excluded.last_id > export_watermarks.last_id
+    """, (table, last_id, to_ts(datetime.now())))
@@ -0,0 +1,108 @@
+import functools
+
+import storage
+from storage.base import Storage
+
+# Асинхронный фасад хранилища для хендлеров, клавиатур и notifier.
+# Каждая функция вызывает одноимённый метод текущего бэкенда
+# (storage.get_storage()), поэтому хранилище меняется без правки хендлеров:
+# STORAGE_BACKEND=memory или storage.use(...) до старта
+
+
+def _delegate(name: str):
+    @functools.wraps(getattr(Storage, name))
+    async def call(*args, **kwargs):
+        return await getattr(storage.get_storage(), name)(*args, **kwargs)
+    return call
+
+
+on_commit = _delegate("on_commit")
+begin_write = _delegate("begin_write")
+commit = _delegate("commit")
+
+
+async def init_db():
+    await storage.get_storage().init()
+
+
+async def checkpoint_loop():
+    await storage.get_storage().maintain()
+
+
+async def shutdown():
+    await storage.get_storage().close()
+
+
+# Пользователи
+get_user = _delegate("get_user")
+get_username_by_id = _delegate("get_username_by_id")
+user_exists = _delegate("user_exists")
+is_user_registered = _delegate("is_user_registered")
+start_user = _delegate("start_user")
+get_user_by_username = _delegate("get_user_by_username")
+add_user = _delegate("add_user")
+set_invited_by = _delegate("set_invited_by")
+add_user_after_register = _delegate("add_user_after_register")
+touch_users = _delegate("touch_users")
+mark_user_blocked = _delegate("mark_user_blocked")
+get_referral_count = _delegate("get_referral_count")
+add_referral_bonus = _delegate("add_referral_bonus")
+add_referral_reward = _delegate("add_referral_reward")
+
+# Монеты
+get_user_coins = _delegate("get_user_coins")
+update_user_coins = _delegate("update_user_coins")
+adjust_user_coins = _delegate("adjust_user_coins")
+apply_coin_operations = _delegate("apply_coin_operations")
+get_coin_history = _delegate("get_coin_history")
+
+# Записи
+get_booked_slots = _delegate("get_booked_slots")
+get_day_occupancy = _delegate("get_day_occupancy")
+add_booking = _delegate("add_booking")
+get_booking = _delegate("get_booking")
+get_user_bookings = _delegate("get_user_bookings")
+get_user_bookings_by_status = _delegate("get_user_bookings_by_status")
+set_booking_status = _delegate("set_booking_status")
+cancel_user_booking = _delegate("cancel_user_booking")
+get_upcoming_user_bookings = _delegate("get_upcoming_user_bookings")
+get_bookings_in_range = _delegate("get_bookings_in_range")
+get_finished_confirmed_bookings = _delegate("get_finished_confirmed_bookings")
+get_last_booking_id = _delegate("get_last_booking_id")
+get_new_bookings = _delegate("get_new_bookings")
+claim_notification = _delegate("claim_notification")
+release_notification = _delegate("release_notification")
+get_future_records = _delegate("get_future_records")
+get_past_records = _delegate("get_past_records")
+get_statistics = _delegate("get_statistics")
+rebuild_daily_stats = _delegate("rebuild_daily_stats")
+
+# Аренды
+acquire_lease = _delegate("acquire_lease")
+release_lease = _delegate("release_lease")
+
+# Рассылки
+count_audience = _delegate("count_audience")
+create_broadcast = _delegate("create_broadcast")
+get_broadcast = _delegate("get_broadcast")
+get_running_broadcasts = _delegate("get_running_broadcasts")
+get_broadcast_recipients = _delegate("get_broadcast_recipients")
+advance_broadcast = _delegate("advance_broadcast")
+set_broadcast_status = _delegate("set_broadcast_status")
+
+# Магазин и покупки
+get_all_shop_items = _delegate("get_all_shop_items")
+add_shop_item = _delegate("add_shop_item")
+update_shop_item = _delegate("update_shop_item")
+delete_shop_item = _delegate("delete_shop_item")
+purchase_item = _delegate("purchase_item")
+get_active_purchases = _delegate("get_active_purchases")
+get_user_purchases = _delegate("get_user_purchases")
+mark_purchase_as_used = _delegate("mark_purchase_as_used")
+
+# Экспорт
+export_table = _delegate("export_table")
+export_report = _delegate("export_report")
+get_table_version = _delegate("get_table_version")
+get_export_watermark = _delegate("get_export_watermark")
+set_export_watermark = _delegate("set_export_watermark")
@@ -0,0 +1,219 @@
+import csv
+import gzip
+import importlib.util
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import uuid
+
+# Выгрузки таблиц для админа. export_table и export_report выполняются
+# в рабочем процессе (workers.run): строки идут из курсора пачками прямо
+# в файл, поэтому память не зависит от размера таблицы, а event loop бота
+# не занят вовсе. Результат — словарь path / rows / last_id / cached
+
+# Таблица -> запрос. Имя из callback только выбирает запрос, в SQL не подставляется
+QUERIES = {
+    "users": "SELECT * FROM users ORDER BY telegram_id",
+    "bookings": "SELECT * FROM bookings ORDER BY id",
+    "purchases": "SELECT * FROM purchases ORDER BY id",
+    "coin_history": "SELECT * FROM coin_history ORDER BY id",
+}
+# Выгрузка "только новые": строки с id больше водяного знака прошлой выгрузки.
+# users такого ключа не имеют (telegram_id не растёт со временем)
+DELTA_QUERIES = {
+    "bookings": "SELECT * FROM bookings WHERE id > ? ORDER BY id",
+    "purchases": "SELECT * FROM purchases WHERE id > ? ORDER BY id",
+    "coin_history": "SELECT * FROM coin_history WHERE id > ? ORDER BY id",
+}
+# Отчёты: запрос с параметрами (начало, конец) по start_at и таблицы,
+# из которых берутся объявленные типы колонок
+REPORTS = {
+    "bookings_users": ("""
+        SELECT b.id, b.date, b.time_from, b.time_to, b.tariff, b.confirmed, b.attended,
+               b.telegram_id, u.full_name, u.username, u.phone
+        FROM bookings b
+        LEFT JOIN users u ON u.telegram_id = b.telegram_id
+        WHERE b.start_at >= ? AND b.start_at < ?
+        ORDER BY b.start_at
+    """, ("bookings", "users")),
+}
+# Формат -> (расширение, нужный модуль)
+FORMATS = {
+    "xlsx": (".xlsx", "openpyxl"),
+    "csv": (".csv.gz", None),
+    "parquet": (".parquet", "pyarrow"),
+}
+BATCH_SIZE = 5000
+XLSX_MAX_ROWS = 1_000_000  # на листе Excel не больше 1 048 576 строк — дальше новый лист
+EXPORT_DIR = os.getenv("EXPORT_DIR", os.path.join(tempfile.gettempdir(), "bot-exports"))
+# Полные выгрузки по версии данных таблицы (table_versions): пока таблица
+# не менялась, повторный запрос отдаёт готовый файл
+CACHE_DIR = os.path.join(EXPORT_DIR, "cache")
+
+
+def available_formats() -> list[str]:
+    return [fmt for fmt, (_, module) in FORMATS.items() if module is None or importlib.util.find_spec(module)]
+
+
+def _write_xlsx(path: str, columns: list[str], types: list[str], batches, title: str) -> int:
+    from openpyxl import Workbook
+
+    # write_only: строки сразу уходят в XML листа, книга в памяти не копится
+    wb = Workbook(write_only=True)
+    ws, count, sheet_rows = None, 0, XLSX_MAX_ROWS
+    for batch in batches:
+        for row in batch:
+            if sheet_rows == XLSX_MAX_ROWS:
+                ws = wb.create_sheet(title if ws is None else f"{title}_{count // XLSX_MAX_ROWS + 1}")
+                ws.append(columns)
+                sheet_rows = 0
+            ws.append(row)
+            sheet_rows += 1
+            count += 1
+    if ws is None:
+        wb.create_sheet(title).append(columns)
+    wb.save(path)
+    return count
+
+
+def _write_csv(path: str, columns: list[str], types: list[str], batches, title: str) -> int:
+    count = 0
+    # BOM — чтобы Excel открыл кириллицу без выбора кодировки
+    with gzip.open(path, "wt", encoding="utf-8-sig", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for batch in batches:
+            writer.writerows(batch)
+            count += len(batch)
+    return count
+
+
+def _write_parquet(path: str, columns: list[str], types: list[str], batches, title: str) -> int:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    # Схема — по объявленным типам колонок SQLite: у пачек она одна и та же,
+    # даже если в первой пачке колонка целиком NULL
+    arrow_types = {"INTEGER": pa.int64(), "REAL": pa.float64()}
+    schema = pa.schema([(c, arrow_types.get(t.upper(), pa.string())) for c, t in zip(columns, types)])
+    count = 0
+    with pq.ParquetWriter(path, schema) as writer:
+        for batch in batches:
+            arrays = []
+            for field, values in zip(schema, zip(*batch)):
+                if field.type == pa.string():
+                    values = [None if v is None else str(v) for v in values]
+                arrays.append(pa.array(values, type=field.type))
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            count += len(batch)
+    return count
+
+
+WRITERS = {"xlsx": _write_xlsx, "csv": _write_csv, "parquet": _write_parquet}
+
+
+def write_file(fmt: str, title: str, columns: list[str], batches, types: list[str] | None = None) -> tuple[str, int]:
+    """Пишет пачки строк в новый файл EXPORT_DIR, возвращает путь и число строк."""
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format: {fmt}")
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    path = os.path.join(EXPORT_DIR, f"{title}-{uuid.uuid4().hex[:8]}{FORMATS[fmt][0]}")
+    try:
+        count = WRITERS[fmt](path, columns, types or [""] * len(columns), batches, title)
+    except BaseException:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+    return path, count
+
+
+def _cache_name(table: str, fmt: str, version: int) -> str:
+    return f"{table}.v{version}{FORMATS[fmt][0]}"
+
+
+def cached_export(table: str, fmt: str, version: int) -> dict | None:
+    path = os.path.join(CACHE_DIR, _cache_name(table, fmt, version))
+    try:
+        with open(path + ".json") as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return None
+    if not os.path.exists(path):
+        return None
+    return {"path": path, "rows": meta["rows"], "last_id": meta["last_id"], "cached": True}
+
+
+def _store_cache(table: str, fmt: str, version: int, result: dict) -> dict:
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    name = _cache_name(table, fmt, version)
+    path = os.path.join(CACHE_DIR, name)
+    # Файл и его описание появляются атомарно (os.replace): параллельная
+    # выгрузка той же версии просто перезапишет их тем же содержимым
+    os.replace(result["path"], path)
+    with open(path + ".json.tmp", "w") as f:
+        json.dump({"rows": result["rows"], "last_id": result["last_id"]}, f)
+    os.replace(path + ".json.tmp", path + ".json")
+
+    # Устаревшие версии этой же выгрузки больше не понадобятся
+    stale = re.compile(rf"{re.escape(table)}\.v\d+{re.escape(FORMATS[fmt][0])}(\.json)?")
+    for other in os.listdir(CACHE_DIR):
+        if stale.fullmatch(other) and not other.startswith(name):
+            os.remove(os.path.join(CACHE_DIR, other))
+    return {**result, "path": path, "cached": True}
+
+
+def _declared_types(conn: sqlite3.Connection, tables) -> dict[str, str]:
+    declared = {}
+    for table in tables:
+        declared.update({row[1]: row[2] for row in conn.execute(f"PRAGMA table_info({table})")})
+    return declared
+
+
+def _write_cursor(fmt: str, title: str, cur: sqlite3.Cursor, declared: dict[str, str]) -> dict:
+    columns = [col[0] for col in cur.description]
+    last = {"id": None}
+
+    def batches():
+        for batch in iter(lambda: cur.fetchmany(BATCH_SIZE), []):
+            if "id" in columns:
+                last["id"] = batch[-1][columns.index("id")]
+            yield batch
+
+    path, rows = write_file(fmt, title, columns, batches(), [declared.get(c, "") for c in columns])
+    return {"path": path, "rows": rows, "last_id": last["id"], "cached": False}
+
+
+def export_table(db_path: str, table: str, fmt: str, after_id: int | None = None) -> dict:
+    """Выгрузка таблицы из файла БД: полная (с кэшем по версии данных)
+    или только строки с id > after_id. Запускается в рабочем процессе."""
+    if table not in QUERIES or (after_id is not None and table not in DELTA_QUERIES):
+        raise ValueError(f"Unknown table: {table}")
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        # Версия и строки — из одного снимка WAL; пишущих выгрузка не блокирует
+        conn.execute("BEGIN")
+        declared = _declared_types(conn, [table])
+        if after_id is not None:
+            return _write_cursor(fmt, f"{table}_new", conn.execute(DELTA_QUERIES[table], (after_id,)), declared)
+
+        version = conn.execute("SELECT version FROM table_versions WHERE name = ?", (table,)).fetchone()[0]
+        cached = cached_export(table, fmt, version)
+        if cached is not None:
+            return cached
+        return _store_cache(table, fmt, version, _write_cursor(fmt, table, conn.execute(QUERIES[table]), declared))
+    finally:
+        conn.close()
+
+
+def export_report(db_path: str, report: str, fmt: str, start: str, end: str) -> dict:
+    """Отчёт REPORTS за [start, end) по start_at. Запускается в рабочем процессе."""
+    if report not in REPORTS:
+        raise ValueError(f"Unknown report: {report}")
+    query, tables = REPORTS[report]
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        return _write_cursor(fmt, report, conn.execute(query, (start, end)), _declared_types(conn, tables))
+    finally:
+        conn.close()
@@ -1,13 +1,18 @@
-from aiogram import Router
+import functools
+
+from aiogram import Router, F
 from aiogram.types import Message, CallbackQuery
 from keyboards.booking_kb import get_tariff_inline_kb, get_date_selection_kb
 from aiogram.fsm.context import FSMContext
-from db import get_booked_slots, add_booking
+import occupancy
+from db_async import get_day_occupancy
+from storage import Storage
+from scheduler import reminders
+from db import booking_interval
 from aiogram.fsm.state import StatesGroup, State
 from keyboards.booking_kb import generate_hour_buttons 
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
-from db import get_booked_slots
-import sqlite3
+from db_async import set_booking_status, cancel_user_booking, get_user_bookings_by_status, get_upcoming_user_bookings, on_commit
 
 
 class BookingState(StatesGroup):
@@ -55,7 +60,7 @@ async def handle_date_choice(callback: CallbackQuery, state: FSMContext):
         parse_mode="HTML"
     )
 
-    slots_kb = generate_hour_buttons(date_str, tariff)
+    slots_kb = await generate_hour_buttons(date_str, tariff)
     await callback.message.answer("🕐 Выберите время начала:", reply_markup=slots_kb)
     await state.set_state(BookingState.time_from)
 
@@ -71,10 +76,7 @@ async def handle_time_from(callback: CallbackQuery, state: FSMContext):
     date = data.get("date")
 
     # Проверяем занятость
-    booked_ranges = get_booked_slots(date)
-    is_busy = any(int(start) <= from_hour < int(end) for start, end in booked_ranges)
-
-    if is_busy:
+    if occupancy.is_busy(await get_day_occupancy(date), from_hour):
         await callback.answer("❌ Это время уже занято! Выберите другое.", show_alert=True)
         return
 
@@ -100,7 +102,7 @@ async def handle_time_from(callback: CallbackQuery, state: FSMContext):
 
 
 @router.callback_query(lambda c: c.data.startswith("time_to|"))
-async def handle_time_to(callback: CallbackQuery, state: FSMContext):
+async def handle_time_to(callback: CallbackQuery, state: FSMContext, session: Storage):
     _, to_hour = callback.data.split("|")
     to_hour = int(to_hour)
 
@@ -110,8 +112,19 @@ async def handle_time_to(callback: CallbackQuery, state: FSMContext):
     tariff = data['tariff']
     user_id = callback.from_user.id
 
-    # Сохраняем
-    add_booking(user_id, date, str(from_hour), str(to_hour), tariff)
+    # Проверка и запись в одной транзакции записи: пока пользователь
+    # выбирал время, эти часы мог занять кто-то другой
+    await session.begin_write()
+    booked_ranges = await session.get_booked_slots(date)
+    if any(int(start) < to_hour and from_hour < int(end) for start, end in booked_ranges):
+        await callback.answer("❌ Это время уже занято! Выберите другое.", show_alert=True)
+        return
+
+    # Сохраняем; напоминания планировщик ставит после коммита апдейта,
+    # иначе откат оставил бы их для несуществующей записи
+    booking_id = await session.add_booking(user_id, date, str(from_hour), str(to_hour), tariff)
+    await session.on_commit(functools.partial(
+        reminders.booking_added, booking_id, *booking_interval(date, from_hour, to_hour)))
 
     await callback.message.answer(
         f"🎉 Вы успешно записались на <b>{date}</b>\n"
@@ -127,12 +140,12 @@ async def handle_time_to(callback: CallbackQuery, state: FSMContext):
 @router.callback_query(lambda c: c.data.startswith("confirm_booking|"))
 async def confirm_booking(callback: CallbackQuery):
     _, booking_id = callback.data.split("|")
-    conn = sqlite3.connect("users.db")
-    cursor = conn.cursor()
-    cursor.execute("UPDATE bookings SET confirmed = 1 WHERE id = ?", (booking_id,))
-    conn.commit()
-    conn.close()
-    await callback.message.answer("✅ Вы подтвердили свою запись.")
+    # Отменённую (в т.ч. автоотменой) запись подтверждение не воскрешает
+    if await set_booking_status(int(booking_id), 1, expected=0):
+        await on_commit(functools.partial(reminders.booking_confirmed, int(booking_id)))
+        await callback.message.answer("✅ Вы подтвердили свою запись.")
+    else:
+        await callback.message.answer("Запись уже отменена или подтверждена.")
     await callback.answer()
 
 
@@ -153,73 +166,52 @@ async def handle_booking_status(callback: CallbackQuery):
     user_id = callback.from_user.id
     status = callback.data.split("_")[1]
 
-    conn = sqlite3.connect("users.db")
-    cursor = conn.cursor()
-
     now = datetime.now()
 
     if status == "active":
-        cursor.execute("""
-            SELECT id, date, time_from, time_to FROM bookings
-            WHERE telegram_id = ? AND confirmed >= 0
-        """, (user_id,))
-        results = cursor.fetchall()
+        results = await get_upcoming_user_bookings(user_id, now)
 
         if not results:
             await callback.message.answer("<b>🟢 Ваши актуальные записи:</b>\n\nПока нет активных записей.", parse_mode="HTML")
         else:
             await callback.message.answer("<b>🟢 Ваши актуальные записи:</b>", parse_mode="HTML")
             for rec in results:
-                b_id, date, t_from, t_to = rec
-                dt_start = datetime.strptime(f"{date} {t_from}", "%Y-%m-%d %H")
-                if dt_start > now:
-                    text = f"📅 {date} | ⏰ {t_from}:00–{t_to}:00"
-                    keyboard = InlineKeyboardMarkup(
-                        inline_keyboard=[
-                            [InlineKeyboardButton(text="❌ Отменить", callback_data=f"cancel_{b_id}")]
-                        ]
-                    )
-                    await callback.message.answer(text, reply_markup=keyboard)
+                b_id, date, t_from, t_to = rec["id"], rec["date"], rec["time_from"], rec["time_to"]
+                text = f"📅 {date} | ⏰ {t_from}:00–{t_to}:00"
+                keyboard = InlineKeyboardMarkup(
+                    inline_keyboard=[
+                        [InlineKeyboardButton(text="❌ Отменить", callback_data=f"cancel_{b_id}")]
+                    ]
+                )
+                await callback.message.answer(text, reply_markup=keyboard)
 
     elif status == "cancelled":
-        cursor.execute("""
-            SELECT date, time_from, time_to FROM bookings
-            WHERE telegram_id = ? AND confirmed = -1
-        """, (user_id,))
-        results = cursor.fetchall()
+        results = await get_user_bookings_by_status(user_id, "cancelled")
         text = "<b>🔴 Отменённые записи:</b>\n\n"
         text += "\n".join(
-            [f"📅 {r[0]} | ⏰ {r[1]}:00–{r[2]}:00" for r in results]
+            [f"📅 {r['date']} | ⏰ {r['time_from']}:00–{r['time_to']}:00" for r in results]
         ) or "Нет отменённых записей."
         await callback.message.answer(text, parse_mode="HTML")
 
     elif status == "past":
-        cursor.execute("""
-            SELECT date, time_from, time_to FROM bookings
-            WHERE telegram_id = ? AND confirmed = 2
-        """, (user_id,))
-        results = cursor.fetchall()
+        results = await get_user_bookings_by_status(user_id, "past")
         text = "<b>⏳ Прошедшие записи:</b>\n\n"
         text += "\n".join(
-            [f"📅 {r[0]} | ⏰ {r[1]}:00–{r[2]}:00" for r in results]
+            [f"📅 {r['date']} | ⏰ {r['time_from']}:00–{r['time_to']}:00" for r in results]
         ) or "Нет прошедших записей."
         await callback.message.answer(text, parse_mode="HTML")
 
     else:
         await callback.message.answer("Неизвестный статус.")
 
-    conn.close()
     await callback.answer()
 
-@router.message(lambda m: m.text.startswith("/cancel_"))
+@router.message(F.text.startswith("/cancel_"))
 async def cancel_booking(message: Message):
     try:
         booking_id = int(message.text.replace("/cancel_", ""))
-        conn = sqlite3.connect("users.db")
-        c = conn.cursor()
-        c.execute("UPDATE bookings SET confirmed = -1 WHERE id = ?", (booking_id,))
-        conn.commit()
-        conn.close()
+        await set_booking_status(booking_id, -1)
+        await on_commit(functools.partial(reminders.booking_cancelled, booking_id))
         await message.answer("❌ Запись отменена.")
     except:
         await message.answer("Ошибка при отмене.")
@@ -228,11 +220,7 @@ async def cancel_booking(message: Message):
 @router.callback_query(lambda c: c.data.startswith("user_came|"))
 async def mark_user_came(callback: CallbackQuery):
     _, booking_id = callback.data.split("|")
-    conn = sqlite3.connect("users.db")
-    cursor = conn.cursor()
-    cursor.execute("UPDATE bookings SET confirmed = 2 WHERE id = ?", (booking_id,))
-    conn.commit()
-    conn.close()
+    await set_booking_status(int(booking_id), 2)
     await callback.message.edit_text("✅ Пользователь отмечен как пришедший!")
     await callback.answer()
 
@@ -241,24 +229,11 @@ async def handle_cancel_booking(callback: CallbackQuery):
     booking_id = int(callback.data.split("_")[1])
     user_id = callback.from_user.id
 
-    conn = sqlite3.connect("users.db")
-    cursor = conn.cursor()
-
-    # Проверим, принадлежит ли бронь пользователю и ещё не отменена
-    cursor.execute("""
-        SELECT id FROM bookings 
-        WHERE id = ? AND telegram_id = ? AND confirmed >= 0
-    """, (booking_id, user_id))
-    booking = cursor.fetchone()
-
-    if booking:
-        cursor.execute("""
-            UPDATE bookings SET confirmed = -1 WHERE id = ?
-        """, (booking_id,))
-        conn.commit()
+    # Проверка владельца и отмена — одним запросом
+    if await cancel_user_booking(booking_id, user_id):
+        await on_commit(functools.partial(reminders.booking_cancelled, booking_id))
         await callback.message.edit_text("❌ Запись успешно отменена.")
     else:
         await callback.answer("Эта запись уже отменена или не существует.", show_alert=True)
 
-    conn.close()
-    await callback.answer()
\ No newline at end of file
+    await callback.answer()
@@ -30,7 +30,7 @@ async def location_handler(message: Message):
 from aiogram import Router, F
 from aiogram.types import Message, CallbackQuery
 from datetime import datetime, timedelta, date
-from db import get_db_connection
+from db_async import get_future_records, get_past_records
 from keyboards.admin_kb import get_record_type_keyboard, get_record_period_keyboard
  
 
@@ -53,9 +53,6 @@ async def choose_record_period(callback: CallbackQuery):
 
 @router.callback_query(F.data.regexp(r"^(past|future)_\d+d$"))
 async def show_records(callback: CallbackQuery):
-    conn = get_db_connection()
-    c = conn.cursor()
-
     _, period = callback.data.split("_")
     days = int(period.replace("d", ""))
     since = datetime.now() - timedelta(days=days)
@@ -64,42 +61,25 @@ async def show_records(callback: CallbackQuery):
     is_future = callback.data.startswith("future")
 
     if is_future:
-        c.execute("""
-            SELECT b.date, b.time_from, b.time_to, b.tariff, b.confirmed, b.attended,
-                   u.full_name, u.username
-            FROM bookings b
-            JOIN users u ON b.telegram_id = u.telegram_id
-            WHERE DATE(b.date) >= ? AND b.confirmed != -1
-            ORDER BY b.date, b.time_from
-        """, (today.isoformat(),))
+        rows = await get_future_records(today.isoformat())
         label = "будущие"
     else:
-        c.execute("""
-            SELECT b.date, b.time_from, b.time_to, b.tariff, b.confirmed, b.attended,
-                   u.full_name, u.username
-            FROM bookings b
-            JOIN users u ON b.telegram_id = u.telegram_id
-            WHERE DATE(b.date) < ? AND DATE(b.date) >= ? AND b.confirmed != -1
-            ORDER BY b.date DESC, b.time_from
-        """, (today.isoformat(), (today - timedelta(days=days)).isoformat()))
+        rows = await get_past_records(today.isoformat(), (today - timedelta(days=days)).isoformat())
         label = "прошедшие"
 
-    rows = c.fetchall()
-    conn.close()
-
     if not rows:
         await callback.message.edit_text(f"📂 <b>Нет {label} записей за выбранный период.</b>", parse_mode="HTML")
         return
 
     text = f"📋 <b>{label.capitalize()} записи за {days} дн.:</b>\n\n"
-    for i, (date_, time_from, time_to, tariff, confirmed, attended, full_name, username) in enumerate(rows, start=1):
+    for i, (date_, time_from, time_to, tariff, confirmed, attended, full_name, username, start_at) in enumerate(rows, start=1):
         # Определяем статус
         if confirmed == 2 or attended == 1:
             status = "🎉 Пройдена"
         elif confirmed == 1:
             status = "✅ Подтверждена"
         elif confirmed == 0:
-            if datetime.strptime(date_, "%Y-%m-%d").date() >= today:
+            if start_at >= today.isoformat():
                 status = "⏳ В ожидании"
             else:
                 status = "❌ Отменена"
@@ -126,7 +106,7 @@ class CoinsFSM(StatesGroup):
 from aiogram import Router
 from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton
 from aiogram.fsm.context import FSMContext
-from db import get_user_coins, update_user_coins
+from db_async import get_user_coins, adjust_user_coins
 
 
 @router.message(lambda msg: msg.text == "🍓 Монеты")
@@ -138,7 +118,7 @@ async def handle_coins_button(message: Message, state: FSMContext):
 async def process_user_id(message: Message, state: FSMContext):
     try:
         user_id = int(message.text)
-        coins = get_user_coins(user_id)
+        coins = await get_user_coins(user_id)
         await state.update_data(user_id=user_id)
         await message.answer(
             f"У пользователя {user_id} сейчас {coins} STRAWBERRY Coin.\n"
@@ -173,12 +153,13 @@ async def process_amount(message: Message, state: FSMContext):
         data = await state.get_data()
         user_id = data["user_id"]
         action = data["action"]
-        current = get_user_coins(user_id)
-        if action == "➕ Увеличить":
-            new = current + amount
-        else:
-            new = max(0, current - amount)
-        update_user_coins(user_id, new)
+        # Атомарно относительно текущего баланса, а не "прочитать и записать"
+        delta = amount if action == "➕ Увеличить" else -amount
+        new = await adjust_user_coins(user_id, delta, clamp=True)
+        if new is None:
+            await message.answer("❌ Пользователь не найден.", reply_markup=admin_keyboard)
+            await state.clear()
+            return
         await message.answer(
             f"✅ У пользователя {user_id} теперь {new} STRAWBERRY Coin.",
             reply_markup=admin_keyboard
@@ -186,3 +167,46 @@ async def process_amount(message: Message, state: FSMContext):
         await state.clear()
     except:
         await message.answer("Ошибка. Введите целое число.")
+
+
+import asyncio
+import os
+from aiogram.filters import Command
+import ledger
+from html import escape as quote_html
+from supervisor import supervisor
+from db_async import rebuild_daily_stats
+
+ADMIN_ID = int(os.getenv("ADMIN_ID", 0))
+
+
+@router.message(Command("reconcile"))
+async def reconcile_coins(message: Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+    await message.answer("⏳ Сверяю балансы с историей монет...")
+    drift = await asyncio.to_thread(ledger.reconcile)
+    await message.answer(ledger.format_report(drift), parse_mode="HTML")
+
+
+@router.message(Command("health"))
+async def background_health(message: Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+    icons = {"running": "🟢", "backoff": "🟠", "starting": "⚪️", "finished": "⚪️", "stopped": "🔴"}
+    lines = ["<b>Фоновые задачи:</b>\n"]
+    for name, info in supervisor.health().items():
+        line = f"{icons.get(info['state'], '⚪️')} <b>{name}</b>: {info['state']}, перезапусков {info['restarts']}"
+        if info["last_error"]:
+            line += f"\n    <code>{quote_html(info['last_error'])}</code>"
+        lines.append(line)
+    await message.answer("\n".join(lines), parse_mode="HTML")
+
+
+@router.message(Command("rebuild_stats"))
+async def rebuild_stats(message: Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+    # Сводку ведут триггеры; пересчёт нужен только после правок БД в обход бота
+    await rebuild_daily_stats()
+    await message.answer("✅ Дневная статистика пересчитана.")
@@ -1,6 +1,6 @@
 from aiogram import Bot, types, Router
 from aiogram.types import Message
-from db import is_user_registered, get_referral_count
+from db_async import is_user_registered, get_referral_count
 
 router = Router()
 
@@ -8,7 +8,7 @@ router = Router()
 async def referral_link_handler(message: Message, bot: Bot):
     telegram_id = message.from_user.id
 
-    if not is_user_registered(telegram_id):
+    if not await is_user_registered(telegram_id):
         await message.answer("Пожалуйста, сначала пройдите регистрацию.")
         return
 
@@ -17,7 +17,7 @@ async def referral_link_handler(message: Message, bot: Bot):
     bot_username = bot_info.username
 
     invite_link = f"https://t.me/{bot_username}?start={telegram_id}"
-    invited_count = get_referral_count(telegram_id)
+    invited_count = await get_referral_count(telegram_id)
 
     await message.answer(
         f"Ваша реферальная ссылка:\n{invite_link}\n\n"
@@ -32,25 +32,73 @@ from aiogram import F, Router
 from aiogram.types import Message
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
-from db import get_db_connection
+from db_async import create_broadcast, set_broadcast_status, get_broadcast, count_audience, on_commit
 from aiogram.exceptions import TelegramAPIError
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery
+from broadcast import broadcasts, format_progress
+from keyboards.admin_kb import get_broadcast_keyboard, get_segment_keyboard
+import segments
 
 
 class MailingState(StatesGroup):
+    choosing_segment = State()
+    waiting_for_segment_value = State()
     waiting_for_text = State()
     waiting_for_confirmation = State()
 
 
 @router.message(F.text == "📨 Рассылка")
-async def ask_mailing_text(message: Message, state: FSMContext):
-    await message.answer("📬 <b>Введите текст рассылки:</b>", parse_mode="HTML")
+async def ask_mailing_segment(message: Message, state: FSMContext):
+    await message.answer("👥 <b>Кому отправить рассылку?</b>", reply_markup=get_segment_keyboard(), parse_mode="HTML")
+    await state.set_state(MailingState.choosing_segment)
+
+
+@router.callback_query(MailingState.choosing_segment, F.data.startswith("mailing_segment:"))
+async def choose_mailing_segment(callback: CallbackQuery, state: FSMContext):
+    kind = callback.data.split(":", 1)[1]
+    question = segments.SEGMENTS[kind][1]
+    if question:
+        await state.update_data(segment_kind=kind)
+        await callback.message.edit_text(question)
+        await state.set_state(MailingState.waiting_for_segment_value)
+    else:
+        await ask_mailing_text(callback.message, state, kind)
+    await callback.answer()
+
+
+@router.message(MailingState.waiting_for_segment_value)
+async def set_mailing_segment_value(message: Message, state: FSMContext):
+    kind = (await state.get_data())["segment_kind"]
+    try:
+        segment = segments.from_input(kind, message.text or "")
+    except ValueError:
+        await message.answer(f"Не понял. {segments.SEGMENTS[kind][1]}")
+        return
+    await ask_mailing_text(message, state, segment)
+
+
+async def ask_mailing_text(message: Message, state: FSMContext, segment: str):
+    # Размер аудитории — до того, как админ подготовит сообщение
+    audience = await count_audience(segment)
+    await state.update_data(segment=segment, audience=audience)
+    await message.answer(
+        f"👥 {segments.describe(segment)}\nПолучателей: <b>{audience}</b>\n\n"
+        "📬 <b>Отправьте сообщение для рассылки:</b> текст, фото, видео или файл с подписью",
+        parse_mode="HTML"
+    )
     await state.set_state(MailingState.waiting_for_text)
 
 
 @router.message(MailingState.waiting_for_text)
 async def ask_for_confirmation(message: Message, state: FSMContext):
-    await state.update_data(mailing_text=message.text)
+    # Рассылается копия этого сообщения (copy_message), поэтому сохраняем
+    # только его адрес, а текст — для превью и истории
+    await state.update_data(
+        mailing_text=message.html_text or "",
+        source_chat_id=message.chat.id,
+        source_message_id=message.message_id,
+    )
+    data = await state.get_data()
 
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [
@@ -59,8 +107,9 @@ async def ask_for_confirmation(message: Message, state: FSMContext):
         ]
     ])
 
-    await message.answer(
-        f"<b>Вы уверены, что хотите разослать это сообщение?</b>\n\n{message.text}",
+    await message.reply(
+        f"<b>Вы уверены, что хотите разослать это сообщение?</b>\n\n"
+        f"👥 {segments.describe(data['segment'])}\nПолучателей: <b>{data['audience']}</b>",
         reply_markup=kb,
         parse_mode="HTML"
     )
@@ -70,33 +119,44 @@ async def ask_for_confirmation(message: Message, state: FSMContext):
 @router.callback_query(F.data == "confirm_mailing")
 async def confirm_and_send(callback: CallbackQuery, state: FSMContext):
     data = await state.get_data()
-    mailing_text = data.get("mailing_text")
+    await state.clear()
+    if "source_message_id" not in data:
+        await callback.answer("Рассылка уже запущена или отменена.", show_alert=True)
+        return
 
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("SELECT telegram_id FROM users WHERE is_registered = 1")
-    users = c.fetchall()
-    conn.close()
+    # Рассылка идёт в фоне (broadcast.py), это сообщение показывает её ход
+    await callback.message.edit_text("🚀 Начинаю рассылку...")
+    broadcast = await create_broadcast(
+        callback.from_user.id, data["mailing_text"], callback.message.chat.id, callback.message.message_id,
+        segment=data["segment"], source_chat_id=data["source_chat_id"], source_message_id=data["source_message_id"],
+    )
+    # Задание видит рассылку только после коммита апдейта
+    await on_commit(broadcasts.wakeup)
+    await callback.message.edit_text(
+        format_progress(broadcast),
+        reply_markup=get_broadcast_keyboard(broadcast["id"], broadcast["status"]),
+        parse_mode="HTML"
+    )
+    await callback.answer()
 
-    success = 0
-    failed = 0
 
-    await callback.message.edit_text("🚀 Начинаю рассылку...")
+@router.callback_query(F.data.regexp(r"^broadcast_(pause|resume|cancel):\d+$"))
+async def control_broadcast(callback: CallbackQuery):
+    action, broadcast_id = callback.data.removeprefix("broadcast_").split(":")
+    status = {"pause": "paused", "resume": "running", "cancel": "cancelled"}[action]
 
-    for (user_id,) in users:
-        try:
-            await callback.bot.send_message(chat_id=user_id, text=mailing_text)
-            success += 1
-        except Exception:
-            failed += 1
-
-    await callback.message.answer(
-        f"📢 <b>Рассылка завершена!</b>\n\n"
-        f"✅ Отправлено: {success}\n"
-        f"❌ Ошибок: {failed}",
+    if not await set_broadcast_status(int(broadcast_id), status):
+        await callback.answer("Рассылка уже завершена или в другом состоянии.", show_alert=True)
+        return
+    await on_commit(broadcasts.wakeup)
+
+    # Идущая пачка ещё досылается; итог задание допишет само
+    broadcast = await get_broadcast(int(broadcast_id))
+    await callback.message.edit_text(
+        format_progress(broadcast),
+        reply_markup=get_broadcast_keyboard(broadcast["id"], broadcast["status"]),
         parse_mode="HTML"
     )
-    await state.clear()
     await callback.answer()
 
 
@@ -119,13 +179,13 @@ def get_user_shop_menu_kb():
 
 from aiogram import Router, F
 from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
-from db import get_user, get_coin_history, get_active_purchases, get_all_shop_items, purchase_item
+from db_async import get_user, get_coin_history, get_active_purchases, get_all_shop_items, purchase_item
 
 
 
 @router.message(F.text == "🛒 Магазин")
 async def user_shop_menu(message: Message):
-    if not is_user_registered(message.from_user.id):
+    if not await is_user_registered(message.from_user.id):
         await message.answer("❗ Вы не зарегистрированы. Пожалуйста, пройдите регистрацию, чтобы использовать магазин.")
         return
 
@@ -141,7 +201,7 @@ async def user_shop_menu(message: Message):
 
 @router.callback_query(F.data == "shop_history")
 async def show_coin_history(callback: CallbackQuery):
-    history = get_coin_history(callback.from_user.id)
+    history = await get_coin_history(callback.from_user.id)
 
     if not history:
         await callback.message.edit_text("📜 <b>У вас пока нет истории по монетам.</b>", parse_mode="HTML")
@@ -161,7 +221,7 @@ async def show_coin_history(callback: CallbackQuery):
 
 @router.callback_query(F.data == "shop_my_purchases")
 async def show_user_purchases(callback: CallbackQuery):
-    purchases = get_active_purchases(callback.from_user.id)
+    purchases = await get_active_purchases(callback.from_user.id)
 
     if not purchases:
         await callback.message.edit_text("🎁 <b>У вас пока нет активных покупок.</b>", parse_mode="HTML")
@@ -179,7 +239,7 @@ async def show_user_purchases(callback: CallbackQuery):
 
 @router.callback_query(F.data == "shop_items")
 async def show_shop_items(callback: CallbackQuery):
-    items = get_all_shop_items()
+    items = await get_all_shop_items()
 
     if not items:
         await callback.message.edit_text("🛒 <b>В магазине пока нет товаров.</b>", parse_mode="HTML")
@@ -203,7 +263,7 @@ async def show_shop_items(callback: CallbackQuery):
 @router.callback_query(F.data.startswith("buy_"))
 async def handle_buy(callback: CallbackQuery):
     item_id = int(callback.data.split("_")[1])
-    success, msg = purchase_item(callback.from_user.id, item_id)
+    success, msg = await purchase_item(callback.from_user.id, item_id)
     await callback.answer(msg, show_alert=True)
 
     if success:
@@ -4,7 +4,7 @@ from aiogram.types import Message, CallbackQuery
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
 from keyboards.register_kb import confirm_kb
-from db import add_user_after_register
+from db_async import add_user_after_register
 from datetime import datetime
 
 router = Router()
@@ -80,7 +80,7 @@ async def confirm_register(callback: CallbackQuery, state: FSMContext):
     underage = int(data['age'] < 14)
 
     # Добавляем пользователя в БД
-    add_user_after_register(
+    await add_user_after_register(
         telegram_id=telegram_id,
         full_name=data['full_name'],
         birth_date=data['birth_date'],
@@ -27,11 +27,11 @@ async def social_handler(message: Message):
         parse_mode="HTML"
     )
 
-from db import get_user_coins
+from db_async import get_user_coins
 @router.message(lambda msg: msg.text == "🍓 Мои монеты")
 async def my_coins_handler(message: Message):
     user_id = message.from_user.id
-    coins = get_user_coins(user_id)
+    coins = await get_user_coins(user_id)
     await message.answer(f"💰 У вас {coins} STRAWBERRY Coin 🍓")
 
 
@@ -39,8 +39,26 @@ async def my_coins_handler(message: Message):
 from aiogram import Router, types
 from aiogram.types import CallbackQuery, Message
 from datetime import datetime, timedelta
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
 from keyboards.admin_kb import get_statistics_period_keyboard
-from db import get_db_connection
+from db_async import get_statistics
+from db import parse_period
+
+
+class StatsPeriod(StatesGroup):
+    waiting_for_range = State()
+
+
+def format_statistics(title: str, stats: dict) -> str:
+    return (
+        f"📊 <b>Статистика {title}:</b>\n\n"
+        f"👤 <b>Новых пользователей:</b> {stats['new_users']}\n"
+        f"🎟 <b>Всего записей:</b> {stats['total_bookings']}\n"
+        f"✅ <b>Пришли:</b> {stats['attended']}\n"
+        f"❌ <b>Отменено:</b> {stats['canceled']}\n"
+        f"🛒 <b>Куплено товаров:</b> {stats['bought']}"
+    )
 
 @router.message(lambda m: m.text == "📊 Статистика")
 async def statistics_entry(message: Message):
@@ -61,39 +79,124 @@ async def show_statistics(callback: CallbackQuery):
 
     label, days = period_map.get(callback.data, ("Неизвестно", 1))
     since = (datetime.now() - timedelta(days=days)).date()
-    today = date.today()
 
-    conn = get_db_connection()
-    c = conn.cursor()
+    # Записи считаются по дню сессии, регистрации и покупки — по своей дате;
+    # как и раньше, в "последние N дней" входят и записи на будущие дни
+    stats = await get_statistics(since.isoformat())
+    await callback.message.edit_text(format_statistics(f"за последние {label}", stats), parse_mode="HTML")
+
+
+@router.callback_query(F.data == "statsrange")
+async def ask_statistics_range(callback: CallbackQuery, state: FSMContext):
+    await callback.message.edit_text(
+        "📝 Отправьте период: <code>01.09.2026-30.09.2026</code>", parse_mode="HTML"
+    )
+    await state.set_state(StatsPeriod.waiting_for_range)
+    await callback.answer()
+
+
+@router.message(StatsPeriod.waiting_for_range)
+async def show_statistics_range(message: Message, state: FSMContext):
+    try:
+        first, last = parse_period(message.text or "")
+    except ValueError:
+        await message.answer("Не понял даты. Пример: 01.09.2026-30.09.2026")
+        return
+    await state.clear()
+    stats = await get_statistics(first.isoformat(), last.isoformat())
+    await message.answer(
+        format_statistics(f"с {first:%d.%m.%Y} по {last:%d.%m.%Y}", stats), parse_mode="HTML"
+    )
+
+
+import analytics
+
 
-    # Новые пользователи
-    c.execute("SELECT COUNT(*) FROM users WHERE is_registered = 1 AND DATE(registration_date) >= ?", (since,))
-    new_users = c.fetchone()[0]
+@router.message(lambda m: m.text == "📈 Когорты")
+async def cohorts_report(message: Message):
+    await message.answer("⏳ Считаю когорты...")
+    report = await analytics.cohorts()
+    await message.answer(analytics.format_cohorts(report), parse_mode="HTML")
 
-    # Все записи
-    c.execute("SELECT COUNT(*) FROM bookings WHERE DATE(date) >= ?", (since,))
-    total_bookings = c.fetchone()[0]
 
-    # Отменено
-    c.execute("SELECT COUNT(*) FROM bookings WHERE confirmed = 0 AND DATE(date) < ? AND DATE(date) >= ?", (today, since))
-    canceled = c.fetchone()[0]
+import contextlib
+import logging
+from datetime import date
+from keyboards.admin_kb import get_heatmap_period_keyboard
 
-    # В ожидании
-    c.execute("SELECT COUNT(*) FROM bookings WHERE confirmed = 0 AND DATE(date) >= ? AND DATE(date) >= ?", (today, since))
-    pending = c.fetchone()[0]
+# file_id уже отправленных кэшированных картинок: пока записи не менялись,
+# та же картинка повторно не загружается в Telegram
+_sent_heatmaps: dict[str, str] = {}
 
-    bought = 0  # пока нет логики покупок
 
-    conn.close()
+class HeatmapPeriod(StatesGroup):
+    waiting_for_range = State()
 
-    text = (
-        f"📊 <b>Статистика за последние {label}:</b>\n\n"
-        f"👤 <b>Новых пользователей:</b> {new_users}\n"
-        f"🎟 <b>Всего записей:</b> {total_bookings}\n"  
-        f"🛒 <b>Куплено товаров:</b> {bought}"
+
+async def send_heatmap(message: Message, first: date, last: date):
+    if not analytics.heatmap_available():
+        await message.answer("⚠️ Для тепловой карты на сервере нужен matplotlib.")
+        return
+    try:
+        result = await analytics.heatmap(first.isoformat(), (last + timedelta(days=1)).isoformat())
+    except Exception as e:
+        logging.exception("Heatmap failed")
+        await message.answer(f"⚠️ Ошибка построения карты: {e}")
+        return
+    path = result["path"]
+    try:
+        file_id = _sent_heatmaps.get(path) if result["cached"] else None
+        sent = await message.answer_photo(
+            photo=file_id or FSInputFile(path),
+            caption=f"🔥 Загрузка студии {first:%d.%m.%Y} — {last:%d.%m.%Y}: % занятых часов"
+        )
+        if result["cached"]:
+            _sent_heatmaps[path] = sent.photo[-1].file_id
+    finally:
+        if not result["cached"]:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+
+
+@router.message(lambda m: m.text == "🔥 Загрузка")
+async def heatmap_entry(message: Message):
+    await message.answer(
+        "🔥 <b>Загрузка студии по дням недели и часам. За какой период?</b>",
+        reply_markup=get_heatmap_period_keyboard(),
+        parse_mode="HTML"
     )
 
-    await callback.message.edit_text(text, parse_mode="HTML")
+
+@router.callback_query(F.data.startswith("heatmap_"))
+async def show_heatmap(callback: CallbackQuery):
+    days = {"heatmap_7d": 7, "heatmap_30d": 30, "heatmap_90d": 90}.get(callback.data)
+    if days is None:
+        await callback.answer("Неизвестный период", show_alert=True)
+        return
+    # Рисование в рабочем процессе дольше, чем Telegram ждёт ответа на callback
+    await callback.answer("⏳ Строю карту...")
+    today = date.today()
+    await send_heatmap(callback.message, today - timedelta(days=days - 1), today)
+
+
+@router.callback_query(F.data == "heatmaprange")
+async def ask_heatmap_range(callback: CallbackQuery, state: FSMContext):
+    await callback.message.edit_text(
+        "📝 Отправьте период: <code>01.09.2026-30.09.2026</code>", parse_mode="HTML"
+    )
+    await state.set_state(HeatmapPeriod.waiting_for_range)
+    await callback.answer()
+
+
+@router.message(HeatmapPeriod.waiting_for_range)
+async def show_heatmap_range(message: Message, state: FSMContext):
+    try:
+        first, last = parse_period(message.text or "")
+    except ValueError:
+        await message.answer("Не понял даты. Пример: 01.09.2026-30.09.2026")
+        return
+    await state.clear()
+    await send_heatmap(message, first, last)
 
 
 
@@ -114,7 +217,7 @@ async def open_shop_settings(message: Message):
 
 from aiogram.fsm.context import FSMContext
 from fsm.shop_states import ShopCreate, ShopEdit
-from db import get_db_connection
+from db_async import get_all_shop_items, add_shop_item, update_shop_item, delete_shop_item
 
 @router.callback_query(lambda c: c.data == "shop_create")
 async def start_shop_create(callback: CallbackQuery, state: FSMContext):
@@ -142,13 +245,7 @@ async def shop_set_price(message: Message, state: FSMContext):
     await state.update_data(price=int(message.text))
     data = await state.get_data()
 
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("INSERT INTO shop_items (name, description, price) VALUES (?, ?, ?)", (
-        data["name"], data["description"], data["price"]
-    ))
-    conn.commit()
-    conn.close()
+    await add_shop_item(data["name"], data["description"], data["price"])
 
     await message.answer(
         f"✅ Товар <b>«{data['name']}»</b> успешно добавлен!\n"
@@ -160,22 +257,18 @@ async def shop_set_price(message: Message, state: FSMContext):
 
 @router.callback_query(lambda c: c.data == "shop_view")
 async def show_shop_items(callback: CallbackQuery):
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("SELECT id, name, description, price FROM shop_items")
-    items = c.fetchall()
-    conn.close()
+    items = await get_all_shop_items()
 
     if not items:
         await callback.message.edit_text("📦 В магазине пока нет товаров.")
         return
 
     text = "<b>📦 Список товаров:</b>\n\n"
-    for i, (item_id, name, description, price) in enumerate(items, start=1):
+    for i, item in enumerate(items, start=1):
         text += (
-            f"{i}. 🎁 <b>{name}</b>\n"
-            f"   💬 {description}\n"
-            f"   💰 <b>{price} STRAWBERRY Coin</b>\n\n"
+            f"{i}. 🎁 <b>{item['name']}</b>\n"
+            f"   💬 {item['description']}\n"
+            f"   💰 <b>{item['price']} STRAWBERRY Coin</b>\n\n"
         )
 
     await callback.message.edit_text(text.strip(), parse_mode="HTML")
@@ -194,11 +287,7 @@ def get_delete_item_keyboard(items):
 
 @router.callback_query(lambda c: c.data == "shop_delete")
 async def choose_item_to_delete(callback: CallbackQuery):
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("SELECT id, name FROM shop_items")
-    items = c.fetchall()
-    conn.close()
+    items = [(item["id"], item["name"]) for item in await get_all_shop_items()]
 
     if not items:
         await callback.message.edit_text("📦 В магазине пока нет товаров для удаления.")
@@ -214,28 +303,17 @@ async def choose_item_to_delete(callback: CallbackQuery):
 async def delete_item(callback: CallbackQuery):
     item_id = int(callback.data.split("_")[2])
 
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("SELECT name FROM shop_items WHERE id = ?", (item_id,))
-    row = c.fetchone()
+    name = await delete_shop_item(item_id)
 
-    if row:
-        name = row[0]
-        c.execute("DELETE FROM shop_items WHERE id = ?", (item_id,))
-        conn.commit()
+    if name is not None:
         await callback.message.edit_text(f"❌ Товар <b>«{quote_html(name)}»</b> удалён из магазина.", parse_mode="HTML")
     else:
         await callback.message.edit_text("⚠️ Товар не найден.")
-    conn.close()
 
 
 @router.callback_query(lambda c: c.data == "shop_edit")
 async def choose_item_to_edit(callback: CallbackQuery, state: FSMContext):
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("SELECT id, name FROM shop_items")
-    items = c.fetchall()
-    conn.close()
+    items = [(item["id"], item["name"]) for item in await get_all_shop_items()]
 
     if not items:
         await callback.message.edit_text("📦 В магазине пока нет товаров для редактирования.")
@@ -265,11 +343,7 @@ async def start_edit_item(callback: CallbackQuery, state: FSMContext):
 async def edit_name(message: Message, state: FSMContext):
     data = await state.get_data()
     if message.text.lower() != "пропустить":
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("UPDATE shop_items SET name = ? WHERE id = ?", (message.text, data['item_id']))
-        conn.commit()
-        conn.close()
+        await update_shop_item(data['item_id'], "name", message.text)
     await message.answer("💬 Введите <b>новое описание</b> или отправьте «Пропустить»", parse_mode="HTML")
     await state.set_state(ShopEdit.editing_description)
 
@@ -277,11 +351,7 @@ async def edit_name(message: Message, state: FSMContext):
 async def edit_description(message: Message, state: FSMContext):
     data = await state.get_data()
     if message.text.lower() != "пропустить":
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("UPDATE shop_items SET description = ? WHERE id = ?", (message.text, data['item_id']))
-        conn.commit()
-        conn.close()
+        await update_shop_item(data['item_id'], "description", message.text)
     await message.answer("💰 Введите <b>новую цену</b> или отправьте «Пропустить»", parse_mode="HTML")
     await state.set_state(ShopEdit.editing_price)
 
@@ -292,11 +362,7 @@ async def edit_price(message: Message, state: FSMContext):
         if not message.text.isdigit():
             await message.answer("❗ Пожалуйста, введите число или отправьте «Пропустить».")
             return
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("UPDATE shop_items SET price = ? WHERE id = ?", (int(message.text), data['item_id']))
-        conn.commit()
-        conn.close()
+        await update_shop_item(data['item_id'], "price", int(message.text))
 
     await message.answer("✅ Товар успешно обновлён!", parse_mode="HTML")
     await state.clear()
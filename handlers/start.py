@@ -1,15 +1,15 @@
-from aiogram import Router
+from aiogram import Router, F
 from aiogram.types import Message, FSInputFile
 from aiogram.utils.markdown import hbold, hitalic
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+import logging
 import os
 
 from keyboards.user_kb import get_user_keyboard
 from keyboards.admin_kb import admin_keyboard
-from db import user_exists, add_user, is_user_registered, get_username_by_id, add_referral_bonus
+from db_async import start_user
 from aiogram.types import CallbackQuery
 from dotenv import load_dotenv
-from db import set_invited_by
 
 router = Router()
 
@@ -17,9 +17,9 @@ load_dotenv()
 ADMIN_ID = int(os.getenv("ADMIN_ID", 0))
 
 
-@router.message(lambda msg: msg.text.startswith("/start"))
+@router.message(F.text.startswith("/start"))
 async def start_handler(message: Message):
-    print(f"[DEBUG] message.text = {message.text}")
+    logging.debug("Start: text %r", message.text)
 
     telegram_id = message.from_user.id
     full_name = message.from_user.full_name
@@ -39,7 +39,7 @@ async def start_handler(message: Message):
         except ValueError:
             inviter_id = None
 
-    print(f"[START] Пользователь {telegram_id} запустил бота. Пригласил: {inviter_id}")
+    logging.info("Start: user %s, inviter %s", telegram_id, inviter_id)
 
     # Приветствие для админа
     if telegram_id == ADMIN_ID:
@@ -50,32 +50,18 @@ async def start_handler(message: Message):
         )
         return
 
-    # Проверка: новый ли пользователь
-    is_new = not user_exists(telegram_id)
-    print(f"[START] Новый пользователь? {'Да' if is_new else 'Нет'}")
-
-    if is_new:
-        add_user(telegram_id, full_name, username, inviter_id)
-        print(f"[START] Пользователь {telegram_id} добавлен. Пригласивший: {inviter_id}")
-
-        if inviter_id:
-            inviter_username = get_username_by_id(inviter_id)
-            if inviter_username:
-                await message.answer(f"🎉 Вы пришли по приглашению от @{inviter_username}!")
-            else:
-                await message.answer("🎉 Вы пришли по приглашению!")
-    else:
-        if inviter_id:
-            was_set = set_invited_by(telegram_id, inviter_id)
-            print(f"[START] Попытка установить пригласившего: {inviter_id} → {'успешно' if was_set else 'уже был установлен'}")
-            if was_set:
-                inviter_username = get_username_by_id(inviter_id)
-                if inviter_username:
-                    await message.answer(f"🎉 Вы пришли по приглашению от @{inviter_username}!")
-                else:
-                    await message.answer("🎉 Вы пришли по приглашению!")
-
-    registered = is_user_registered(telegram_id)
+    # Создание/поиск пользователя и пригласивший — одним запросом
+    result = await start_user(telegram_id, full_name, username, inviter_id)
+    logging.info("Start: user %s, new=%s", telegram_id, result["is_new"])
+
+    if result["invited"]:
+        inviter_username = result["inviter_username"]
+        if inviter_username:
+            await message.answer(f"🎉 Вы пришли по приглашению от @{inviter_username}!")
+        else:
+            await message.answer("🎉 Вы пришли по приглашению!")
+
+    registered = result["user"]["is_registered"] == 1
 
     # Кнопка "Как работает бот"
     how_it_works_kb = InlineKeyboardMarkup(inline_keyboard=[
@@ -114,7 +100,7 @@ from aiogram.fsm.context import FSMContext
 from aiogram.filters import Command
 from aiogram.types import Message, CallbackQuery
 from keyboards.admin_kb import get_user_action_keyboard, get_purchase_action_keyboard
-from db import (
+from db_async import (
     get_user_by_username,
     get_user_bookings,
     get_user_purchases,
@@ -132,7 +118,7 @@ async def ask_for_username(msg: Message, state: FSMContext):
 @router.message(F.text.startswith("@"))
 async def handle_username_search(msg: Message):
     username = msg.text.strip("@")
-    user = get_user_by_username(username)
+    user = await get_user_by_username(username)
 
     if not user:
         await msg.answer("❌ Пользователь не найден.")
@@ -156,7 +142,7 @@ async def handle_username_search(msg: Message):
 @router.callback_query(F.data.startswith("user_records:"))
 async def show_user_bookings(callback: CallbackQuery):
     user_id = int(callback.data.split(":")[1])
-    bookings = get_user_bookings(user_id)
+    bookings = await get_user_bookings(user_id)
 
     if not bookings:
         await callback.message.answer("📅 У пользователя нет записей.")
@@ -176,7 +162,7 @@ async def show_user_bookings(callback: CallbackQuery):
 @router.callback_query(F.data.startswith("user_purchases:"))
 async def show_user_purchases(callback: CallbackQuery):
     user_id = int(callback.data.split(":")[1])
-    purchases = get_user_purchases(user_id)
+    purchases = await get_user_purchases(user_id)
 
     if not purchases:
         await callback.message.answer("🛒 У пользователя нет покупок.")
@@ -202,17 +188,35 @@ async def show_user_purchases(callback: CallbackQuery):
 @router.callback_query(F.data.startswith("activate_purchase:"))
 async def activate_purchase(callback: CallbackQuery):
     purchase_id = int(callback.data.split(":")[1])
-    mark_purchase_as_used(purchase_id)
+    await mark_purchase_as_used(purchase_id)
     await callback.message.edit_reply_markup(reply_markup=None)
     await callback.answer("✅ Покупка активирована")
 
 
 
-import pandas as pd
-from io import BytesIO
-import sqlite3
+import contextlib
+from datetime import datetime, timedelta
+from aiogram.fsm.state import State, StatesGroup
+import exporter
+from db_async import export_table, export_report, get_export_watermark, set_export_watermark
+from db import parse_period
+
+EXPORT_TITLES = {
+    "users": "👤 Пользователи",
+    "bookings": "📅 Записи",
+    "purchases": "🛒 Покупки",
+    "coin_history": "🍓 История монет",
+}
+FORMAT_TITLES = {"xlsx": "📗 Excel", "csv": "📄 CSV (gzip)", "parquet": "🧱 Parquet"}
+REPORT_PERIODS = {"7d": 7, "30d": 30, "90d": 90}
+
+# file_id уже отправленных кэшированных выгрузок: тот же файл повторно
+# не загружается в Telegram
+_sent_exports: dict[str, str] = {}
 
 
+class ExportReport(StatesGroup):
+    waiting_for_period = State()
 
 
 def get_export_keyboard():
@@ -224,59 +228,161 @@ def get_export_keyboard():
         [
             InlineKeyboardButton(text="🛒 Покупки", callback_data="export_purchases"),
             InlineKeyboardButton(text="🍓 История монет", callback_data="export_coin_history")
-        ]
+        ],
+        [InlineKeyboardButton(text="📊 Записи с пользователями за период", callback_data="exportreport")]
     ])
 
-@router.message(F.text == "📤 Экспорт Excel")
-async def export_menu(msg: Message):
-    await msg.answer("Что вы хотите экспортировать?", reply_markup=get_export_keyboard())
 
+def get_export_format_keyboard(table: str):
+    rows = [[
+        InlineKeyboardButton(text=FORMAT_TITLES[fmt], callback_data=f"exportfmt:{table}:{fmt}:full")
+        for fmt in exporter.available_formats()
+    ]]
+    if table in exporter.DELTA_QUERIES:
+        rows.append([
+            InlineKeyboardButton(text=f"🆕 {FORMAT_TITLES[fmt]}", callback_data=f"exportfmt:{table}:{fmt}:delta")
+            for fmt in exporter.available_formats()
+        ])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
 
-@router.callback_query(F.data.startswith("export_"))
-async def export_table(callback: CallbackQuery):
-    table = callback.data.replace("export_", "")
-    db_path = "users.db"
 
-    try:
-        conn = sqlite3.connect(db_path)
-        df = pd.read_sql_query(f"SELECT * FROM {table}", conn)
-        conn.close()
+def get_report_format_keyboard(start: str, end: str):
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text=FORMAT_TITLES[fmt], callback_data=f"exportrep:{start}:{end}:{fmt}")
+        for fmt in exporter.available_formats()
+    ]])
 
-        if df.empty:
-            await callback.message.answer("❌ Таблица пуста.")
-            return
 
-        buffer = BytesIO()
-        df.to_excel(buffer, index=False)
-        buffer.seek(0)
-
-        from aiogram.types import BufferedInputFile
-
-        file = BufferedInputFile(buffer.read(), filename=f"{table}.xlsx")
-        await callback.message.answer_document(
-            document=file,
-            caption=f"📄 Таблица: {table}"
+async def send_export_file(callback: CallbackQuery, result: dict, filename: str, caption: str):
+    path = result["path"]
+    try:
+        if not result["rows"]:
+            await callback.message.answer("❌ Нет строк для выгрузки.")
+            return
+        file_id = _sent_exports.get(path) if result["cached"] else None
+        sent = await callback.message.answer_document(
+            document=file_id or FSInputFile(path, filename=filename),
+            caption=f"{caption} ({result['rows']} строк)"
         )
-        await callback.answer()
-
-    except Exception as e:
-        await callback.message.answer(f"⚠️ Ошибка экспорта: {e}")
+        if result["cached"]:
+            _sent_exports[path] = sent.document.file_id
+    finally:
+        # Кэшированный файл живёт до следующей версии таблицы, остальные — разовые
+        if not result["cached"]:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
 
+@router.message(F.text == "📤 Экспорт Excel")
+async def export_menu(msg: Message):
+    await msg.answer("Что вы хотите экспортировать?", reply_markup=get_export_keyboard())
 
 
+@router.callback_query(F.data.startswith("export_"))
+async def choose_export_format(callback: CallbackQuery):
+    table = callback.data.removeprefix("export_")
+    if table not in EXPORT_TITLES:
+        await callback.answer("Неизвестная таблица", show_alert=True)
+        return
+    text = f"{EXPORT_TITLES[table]}: в каком формате?"
+    if table in exporter.DELTA_QUERIES:
+        text += "\n🆕 — только строки, добавленные после прошлой выгрузки"
+    await callback.message.edit_text(text, reply_markup=get_export_format_keyboard(table))
+    await callback.answer()
 
 
+@router.callback_query(F.data.startswith("exportfmt:"))
+async def send_export(callback: CallbackQuery):
+    _, table, fmt, mode = callback.data.split(":")
+    delta = mode == "delta"
+    if (table not in EXPORT_TITLES or fmt not in exporter.available_formats()
+            or (delta and table not in exporter.DELTA_QUERIES)):
+        await callback.answer("Неизвестная выгрузка", show_alert=True)
+        return
 
+    # Выгрузка большой таблицы идёт дольше, чем Telegram ждёт ответа на callback
+    await callback.answer("⏳ Готовлю файл...")
+    try:
+        # Полная выгрузка неизменившейся таблицы отдаётся из кэша, иначе
+        # файл собирается в рабочем процессе потоково и отправляется с диска
+        after_id = (await get_export_watermark(table) or 0) if delta else None
+        result = await export_table(table, fmt, after_id)
+        extension = exporter.FORMATS[fmt][0]
+        if delta:
+            await send_export_file(callback, result, f"{table}_new{extension}",
+                                   f"🆕 {table}: новые после id {after_id}")
+        else:
+            await send_export_file(callback, result, f"{table}{extension}", f"📄 Таблица: {table}")
+        # Следующая выгрузка "только новые" начнётся после этой
+        if result["rows"] and result["last_id"] is not None:
+            await set_export_watermark(table, result["last_id"])
 
+    except Exception as e:
+        logging.exception("Export of %s failed", table)
+        await callback.message.answer(f"⚠️ Ошибка экспорта: {e}")
 
 
+@router.callback_query(F.data == "exportreport")
+async def choose_report_period(callback: CallbackQuery, state: FSMContext):
+    kb = InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text=f"{days} дней", callback_data=f"exportperiod:{key}")
+        for key, days in REPORT_PERIODS.items()
+    ]])
+    await callback.message.edit_text(
+        "📊 За какой период? Выберите или отправьте даты: <code>01.09.2026-30.09.2026</code>",
+        reply_markup=kb,
+        parse_mode="HTML"
+    )
+    await state.set_state(ExportReport.waiting_for_period)
+    await callback.answer()
 
 
+@router.callback_query(F.data.startswith("exportperiod:"))
+async def report_period_chosen(callback: CallbackQuery, state: FSMContext):
+    days = REPORT_PERIODS.get(callback.data.split(":", 1)[1])
+    if days is None:
+        await callback.answer("Неизвестный период", show_alert=True)
+        return
+    await state.clear()
+    end = datetime.now().date() + timedelta(days=1)
+    start = end - timedelta(days=days)
+    await callback.message.edit_text(
+        f"📊 {start:%d.%m.%Y}–{end - timedelta(days=1):%d.%m.%Y}: в каком формате?",
+        reply_markup=get_report_format_keyboard(start.isoformat(), end.isoformat())
+    )
+    await callback.answer()
 
 
+@router.message(ExportReport.waiting_for_period)
+async def report_period_entered(msg: Message, state: FSMContext):
+    try:
+        first, last = parse_period(msg.text or "")
+    except ValueError:
+        await msg.answer("Не понял даты. Пример: 01.09.2026-30.09.2026")
+        return
+    await state.clear()
+    await msg.answer(
+        f"📊 {first:%d.%m.%Y}–{last:%d.%m.%Y}: в каком формате?",
+        reply_markup=get_report_format_keyboard(first.isoformat(), (last + timedelta(days=1)).isoformat())
+    )
 
 
+@router.callback_query(F.data.startswith("exportrep:"))
+async def send_report(callback: CallbackQuery):
+    _, start, end, fmt = callback.data.split(":")
+    if fmt not in exporter.available_formats():
+        await callback.answer("Неизвестный формат", show_alert=True)
+        return
 
+    await callback.answer("⏳ Готовлю отчёт...")
+    try:
+        # Границы — даты ISO: сравниваются со start_at как строки, по индексу
+        result = await export_report("bookings_users", fmt, start, end)
+        last = datetime.fromisoformat(end) - timedelta(days=1)
+        await send_export_file(callback, result, f"bookings_{start}_{last:%Y-%m-%d}{exporter.FORMATS[fmt][0]}",
+                               f"📊 Записи с пользователями {start} — {last:%Y-%m-%d}")
+    except Exception as e:
+        logging.exception("Report export failed")
+        await callback.message.answer(f"⚠️ Ошибка экспорта: {e}")
 
 
 
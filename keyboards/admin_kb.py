@@ -5,7 +5,8 @@ admin_keyboard = ReplyKeyboardMarkup(
         [KeyboardButton(text="📊 Статистика"), KeyboardButton(text="📁 Все записи")],
         [KeyboardButton(text="📨 Рассылка"), KeyboardButton(text="🍓 Монеты")],
         [KeyboardButton(text="📤 Экспорт Excel"), KeyboardButton(text="👥 Пользователи")],
-        [KeyboardButton(text="🛍️ Магазин")],
+        [KeyboardButton(text="🛍️ Магазин"), KeyboardButton(text="📈 Когорты")],
+        [KeyboardButton(text="🔥 Загрузка")],
     ],
     resize_keyboard=True
 )
@@ -19,7 +20,19 @@ def get_statistics_period_keyboard():
             InlineKeyboardButton(text="📅 1 день", callback_data="stats_1d"),
             InlineKeyboardButton(text="📆 Неделя", callback_data="stats_7d"),
             InlineKeyboardButton(text="🗓 Месяц", callback_data="stats_30d")
-        ]
+        ],
+        [InlineKeyboardButton(text="📝 Свой период", callback_data="statsrange")]
+    ])
+
+
+def get_heatmap_period_keyboard():
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [
+            InlineKeyboardButton(text="📆 Неделя", callback_data="heatmap_7d"),
+            InlineKeyboardButton(text="🗓 Месяц", callback_data="heatmap_30d"),
+            InlineKeyboardButton(text="🗂 3 месяца", callback_data="heatmap_90d")
+        ],
+        [InlineKeyboardButton(text="📝 Свой период", callback_data="heatmaprange")]
     ])
 
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
@@ -72,3 +85,27 @@ def get_purchase_action_keyboard(purchase_id: int):
         [InlineKeyboardButton(text="✅ Активировать", callback_data=f"activate_purchase:{purchase_id}")]
     ])
 
+
+
+def get_broadcast_keyboard(broadcast_id: int, status: str):
+    if status == "running":
+        buttons = [
+            InlineKeyboardButton(text="⏸ Пауза", callback_data=f"broadcast_pause:{broadcast_id}"),
+            InlineKeyboardButton(text="⛔ Отменить", callback_data=f"broadcast_cancel:{broadcast_id}")
+        ]
+    elif status == "paused":
+        buttons = [
+            InlineKeyboardButton(text="▶️ Продолжить", callback_data=f"broadcast_resume:{broadcast_id}"),
+            InlineKeyboardButton(text="⛔ Отменить", callback_data=f"broadcast_cancel:{broadcast_id}")
+        ]
+    else:
+        return None
+    return InlineKeyboardMarkup(inline_keyboard=[buttons])
+
+from segments import SEGMENTS
+
+def get_segment_keyboard():
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=title, callback_data=f"mailing_segment:{kind}")]
+        for kind, (title, _, _) in SEGMENTS.items()
+    ])
@@ -1,7 +1,8 @@
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from datetime import datetime, timedelta
 import locale
-from db import get_booked_slots
+import occupancy
+from db_async import get_day_occupancy
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 
 
@@ -40,12 +41,12 @@ def get_date_selection_kb(tariff_type: str) -> InlineKeyboardMarkup:
 
 from datetime import datetime, timedelta
 
-def generate_hour_buttons(date_str: str, tariff: str) -> InlineKeyboardMarkup:
+async def generate_hour_buttons(date_str: str, tariff: str) -> InlineKeyboardMarkup:
     now = datetime.now()
     today = now.strftime("%Y-%m-%d") == date_str
 
-    booked = get_booked_slots(date_str)
-    booked_ranges = [(int(f), int(t)) for f, t in booked]
+    # Маска занятости дня из индекса в памяти — без запроса к БД
+    busy = await get_day_occupancy(date_str)
 
     if tariff == "hourly":
         start_hour, end_hour = 10, 22
@@ -61,8 +62,7 @@ def generate_hour_buttons(date_str: str, tariff: str) -> InlineKeyboardMarkup:
             continue  # пропустить прошедшее
 
         # Проверка занятости
-        is_busy = any(start <= h < end for start, end in booked_ranges)
-        emoji = "❌" if is_busy else "✅"
+        emoji = "❌" if occupancy.is_busy(busy, h) else "✅"
         cb_data = f"time_from|{h}"
 
         buttons.append([InlineKeyboardButton(text=f"{emoji} {time_str}", callback_data=cb_data)])
@@ -0,0 +1,78 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from typing import Awaitable, Callable
+
+from db_async import acquire_lease, release_lease
+
+LEASE_TTL = 30  # секунд без продления — и лидером становится другой процесс
+
+
+class LeaderLease:
+    """Аренда в таблице leases: задачу выполняет только её держатель.
+
+    Каждый процесс раз в треть срока аренды пытается взять или продлить аренду.
+    Лидер запускает задачу; если продлить не удаётся дольше срока аренды
+    (процесс завис, БД недоступна), задача останавливается, а аренду после
+    истечения забирает другой процесс. Ошибка задачи выходит из run(), чтобы
+    перезапуск с задержкой и /health вёл supervisor; аренда при этом отдаётся.
+    """
+
+    def __init__(self, name: str, ttl: float = LEASE_TTL):
+        self.name = name
+        self.ttl = ttl
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._expires = 0.0  # до какого момента аренда точно наша (по нашим часам)
+
+    @property
+    def is_leader(self) -> bool:
+        return time.time() < self._expires
+
+    async def _heartbeat(self):
+        started = time.time()
+        try:
+            acquired = await acquire_lease(self.name, self.holder, self.ttl)
+        except Exception:
+            logging.exception("Lease %s heartbeat failed", self.name)
+            return
+        if acquired:
+            self._expires = started + self.ttl
+        else:
+            self._expires = 0.0
+
+    async def run(self, job: Callable[[], Awaitable[None]]):
+        task: asyncio.Task | None = None
+        try:
+            while True:
+                await self._heartbeat()
+                if self.is_leader and task is None:
+                    logging.info("Lease %s acquired by %s", self.name, self.holder)
+                    task = asyncio.create_task(job())
+                elif not self.is_leader and task is not None:
+                    logging.warning("Lease %s lost by %s", self.name, self.holder)
+                    task.cancel()
+                    task = None
+                if task is None:
+                    await asyncio.sleep(self.ttl / 3)
+                    continue
+                # Ждём такт продления или конец задачи — что раньше
+                await asyncio.wait({task}, timeout=self.ttl / 3)
+                if task.done():
+                    finished, task = task, None
+                    if not finished.cancelled() and finished.exception() is not None:
+                        raise finished.exception()
+                    # Задача завершилась сама — перезапустим на следующем такте
+                    await asyncio.sleep(self.ttl / 3)
+        finally:
+            if task is not None:
+                task.cancel()
+            if self._expires:
+                # Отдаём аренду сразу, не дожидаясь её истечения
+                self._expires = 0.0
+                try:
+                    await release_lease(self.name, self.holder)
+                except Exception:
+                    logging.exception("Lease %s release failed", self.name)
@@ -0,0 +1,58 @@
+import sqlite3
+
+import pandas as pd
+
+import db
+
+# Сверка users.coins с историей монет. Запускается админом командой
+# /reconcile вне event loop (asyncio.to_thread)
+
+
+def reconcile(db_path: str | None = None) -> pd.DataFrame:
+    """Пересчитывает балансы из coin_history и сравнивает с users.coins.
+
+    Возвращает только расхождения: колонки coins (баланс в users),
+    ledger (сумма истории), last_balance (balance_after последней строки)
+    и drift = coins - ledger.
+    """
+    conn = sqlite3.connect(f"file:{db_path or db.DB_NAME}?mode=ro", uri=True)
+    try:
+        # Свёртка миллионов строк истории — один проход GROUP BY внутри SQLite,
+        # в Python приходит по строке на пользователя
+        ledger = pd.read_sql_query("""
+            SELECT h.telegram_id, h.ledger, l.balance_after AS last_balance
+            FROM (
+                SELECT telegram_id, SUM(amount) AS ledger, MAX(id) AS last_id
+                FROM coin_history
+                GROUP BY telegram_id
+            ) h
+            LEFT JOIN coin_history l ON l.id = h.last_id
+        """, conn, index_col="telegram_id")
+        users = pd.read_sql_query("SELECT telegram_id, coins FROM users", conn, index_col="telegram_id")
+    finally:
+        conn.close()
+
+    report = users.join(ledger, how="outer")
+    report["coins"] = report["coins"].fillna(0).astype("int64")
+    report["ledger"] = report["ledger"].fillna(0).astype("int64")
+    report["drift"] = report["coins"] - report["ledger"]
+
+    mismatch = (report["drift"] != 0) | (
+        report["last_balance"].notna() & (report["last_balance"] != report["coins"])
+    )
+    return report[mismatch]
+
+
+def format_report(drift: pd.DataFrame, limit: int = 20) -> str:
+    if drift.empty:
+        return "✅ Балансы сходятся с историей монет."
+
+    lines = [f"⚠️ Расхождения у {len(drift)} пользователей (всего {int(drift['drift'].sum())} монет):\n"]
+    for telegram_id, row in drift.head(limit).iterrows():
+        lines.append(
+            f"<code>{telegram_id}</code>: баланс {int(row['coins'])}, по истории {int(row['ledger'])} "
+            f"(разница {int(row['drift']):+d})"
+        )
+    if len(drift) > limit:
+        lines.append(f"… и ещё {len(drift) - limit}")
+    return "\n".join(lines)
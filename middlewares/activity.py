@@ -0,0 +1,65 @@
+import asyncio
+import logging
+from datetime import datetime
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, User
+
+import db
+from db_async import touch_users
+
+FLUSH_INTERVAL = 30
+MAX_PENDING = 5000  # при таком размере буфер сбрасывается досрочно
+
+
+class ActivityMiddleware(BaseMiddleware):
+    """Актуальные username, имя и время последней активности пользователей.
+
+    Апдейт только кладёт данные в буфер (последняя запись на пользователя
+    побеждает), а run() периодически пишет накопленное одной пачкой через
+    executemany — без синхронной записи на каждое сообщение.
+    """
+
+    def __init__(self, interval: float = FLUSH_INTERVAL):
+        self.interval = interval
+        self._pending: dict[int, tuple[str | None, str | None, str]] = {}
+        self._wakeup = asyncio.Event()
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        user: User | None = data.get("event_from_user")
+        if user is not None and not user.is_bot:
+            self._pending[user.id] = (user.username, user.full_name, db.to_ts(datetime.now()))
+            if len(self._pending) >= MAX_PENDING:
+                self._wakeup.set()
+        return await handler(event, data)
+
+    async def flush(self):
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        rows = [(user_id, *values) for user_id, values in batch.items()]
+        try:
+            await touch_users(rows)
+        except Exception:
+            # Вернём в буфер то, что не перезаписано более свежими апдейтами
+            for user_id, values in batch.items():
+                self._pending.setdefault(user_id, values)
+            raise
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logging.exception("Activity flush failed")
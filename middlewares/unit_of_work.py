@@ -0,0 +1,26 @@
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+import storage
+
+
+class UnitOfWorkMiddleware(BaseMiddleware):
+    """Одна сессия хранилища на апдейт.
+
+    Хендлер получает её параметром session (можно и не объявлять: вызовы
+    db_async внутри апдейта всё равно идут через неё). Изменения
+    фиксируются перед запросами к Telegram и после хендлера, при
+    исключении незафиксированное откатывается (см. db.Session).
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        async with storage.get_storage().session() as session:
+            data["session"] = session
+            return await handler(event, data)
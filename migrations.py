@@ -0,0 +1,438 @@
+import logging
+import sqlite3
+
+# Версия схемы хранится в PRAGMA user_version. Миграции применяются строго
+# по порядку при старте, каждая — в своей транзакции вместе с новой версией.
+# Новые изменения схемы — только новой миграцией в конце списка.
+
+
+def _base_schema(c: sqlite3.Connection):
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            telegram_id INTEGER PRIMARY KEY,
+            full_name TEXT,
+            username TEXT,
+            birth_date TEXT,
+            phone TEXT,
+            birthdate TEXT,
+            age INTEGER,
+            underage INTEGER DEFAULT 0,
+            coins INTEGER DEFAULT 0,
+            invited_by INTEGER,
+            invited_count INTEGER DEFAULT 0,
+            is_registered INTEGER DEFAULT 0,
+            referrals_count INTEGER DEFAULT 0,
+            registration_date TEXT
+        )
+    """)
+
+    # Таблица магазина
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS shop_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT,
+            description TEXT,
+            price INTEGER
+        )
+    """)
+
+    # Таблица записей
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS bookings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER,
+            date TEXT,
+            time_from TEXT,
+            time_to TEXT,
+            tariff TEXT,
+            confirmed INTEGER DEFAULT 0,
+            attended INTEGER DEFAULT 0
+        )
+    """)
+
+    # История монет
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS coin_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER,
+            action TEXT,
+            amount INTEGER,
+            description TEXT,
+            timestamp TEXT
+        )
+    """)
+
+    # Покупки пользователя
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS purchases (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER,
+            shop_item_id INTEGER,
+            code TEXT,
+            status TEXT DEFAULT 'active',
+            timestamp TEXT
+        )
+    """)
+
+
+def _columns(c: sqlite3.Connection, table: str) -> set[str]:
+    return {row[1] for row in c.execute(f"PRAGMA table_info({table})")}
+
+
+def add_column(c: sqlite3.Connection, table: str, column: str, decl: str):
+    # ALTER TABLE ADD COLUMN не поддерживает IF NOT EXISTS
+    if column not in _columns(c, table):
+        c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+def _fix_schema_drift(c: sqlite3.Connection):
+    # Базы, созданные старыми версиями бота, могут не иметь части колонок
+    for column, decl in [
+        ("full_name", "TEXT"),
+        ("username", "TEXT"),
+        ("birth_date", "TEXT"),
+        ("phone", "TEXT"),
+        ("birthdate", "TEXT"),
+        ("age", "INTEGER"),
+        ("underage", "INTEGER DEFAULT 0"),
+        ("coins", "INTEGER DEFAULT 0"),
+        ("invited_by", "INTEGER"),
+        ("invited_count", "INTEGER DEFAULT 0"),
+        ("is_registered", "INTEGER DEFAULT 0"),
+        ("referrals_count", "INTEGER DEFAULT 0"),
+        ("registration_date", "TEXT"),
+    ]:
+        add_column(c, "users", column, decl)
+    add_column(c, "bookings", "attended", "INTEGER DEFAULT 0")
+    add_column(c, "purchases", "status", "TEXT DEFAULT 'active'")
+
+    # Дата рождения писалась то в birth_date, то в birthdate — рабочая колонка birthdate
+    c.execute("""
+        UPDATE users SET birthdate = birth_date
+        WHERE birthdate IS NULL AND birth_date IS NOT NULL
+    """)
+
+
+def _hot_query_indexes(c: sqlite3.Connection):
+    # get_booked_slots: покрывающий индекс, таблица не читается вовсе
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_bookings_date
+        ON bookings(date, confirmed, time_from, time_to)
+    """)
+    # get_user_bookings, handle_booking_status
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_bookings_user
+        ON bookings(telegram_id, confirmed, date, time_from)
+    """)
+    # get_user_by_username
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_username ON users(username)")
+    # get_referral_count
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_invited_by ON users(invited_by)")
+    # get_coin_history: поиск и сортировка по индексу
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_coin_history_user_ts
+        ON coin_history(telegram_id, timestamp)
+    """)
+    # get_active_purchases, get_user_purchases
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_purchases_user_status
+        ON purchases(telegram_id, status, timestamp)
+    """)
+
+
+def _booking_timestamps(c: sqlite3.Connection):
+    # Абсолютные начало и конец сессии. Ночной тариф хранит часы 22–30,
+    # поэтому 22:00–03:00 честно переходит на следующие сутки
+    add_column(c, "bookings", "start_at", "TEXT")
+    add_column(c, "bookings", "end_at", "TEXT")
+    c.execute("""
+        UPDATE bookings
+        SET start_at = datetime(date, '+' || CAST(time_from AS INTEGER) || ' hours'),
+            end_at = datetime(date, '+' || CAST(time_to AS INTEGER) || ' hours')
+        WHERE start_at IS NULL
+    """)
+    # Занятость и напоминания — диапазонные запросы по start_at
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_bookings_start
+        ON bookings(start_at, end_at, confirmed)
+    """)
+    # Завершившиеся подтверждённые записи для отметки админом
+    c.execute("CREATE INDEX IF NOT EXISTS idx_bookings_status_end ON bookings(confirmed, end_at)")
+    # Поиск по текстовой дате больше не используется
+    c.execute("DROP INDEX IF EXISTS idx_bookings_date")
+
+
+def _coin_ledger(c: sqlite3.Connection):
+    # Баланс после каждой операции. Раньше бонусы и правки админа меняли
+    # users.coins без записи в истории — закрываем разницу одной строкой
+    # "opening_balance", чтобы сумма истории сходилась с балансом
+    add_column(c, "coin_history", "balance_after", "INTEGER")
+    c.execute("""
+        INSERT INTO coin_history (telegram_id, action, amount, description, timestamp, balance_after)
+        SELECT u.telegram_id, 'opening_balance', u.coins - COALESCE(h.total, 0),
+               'Начальный баланс', datetime('now', 'localtime'), u.coins
+        FROM users u
+        LEFT JOIN (
+            SELECT telegram_id, SUM(amount) AS total FROM coin_history GROUP BY telegram_id
+        ) h ON h.telegram_id = u.telegram_id
+        WHERE u.coins != COALESCE(h.total, 0)
+    """)
+
+
+def _last_seen(c: sqlite3.Connection):
+    # Последняя активность пользователя — пишется пачками (ActivityMiddleware)
+    add_column(c, "users", "last_seen", "TEXT")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_last_seen ON users(last_seen)")
+
+
+def _notification_log(c: sqlite3.Connection):
+    # Отправленные уведомления по записям: вставка строки — захват отправки,
+    # поэтому каждое напоминание уходит один раз, в том числе после рестарта
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS notification_log (
+            booking_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            sent_at TEXT NOT NULL,
+            PRIMARY KEY (booking_id, kind)
+        ) WITHOUT ROWID
+    """)
+
+
+def _leases(c: sqlite3.Connection):
+    # Аренды для выбора лидера между процессами бота (leader.py)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            holder TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        ) WITHOUT ROWID
+    """)
+
+
+def _broadcasts(c: sqlite3.Connection):
+    # Рассылки как задания: cursor — последний обработанный telegram_id,
+    # поэтому после паузы или рестарта рассылка продолжается с того же места
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            cursor INTEGER NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            status_chat_id INTEGER,
+            status_message_id INTEGER,
+            created_at TEXT NOT NULL,
+            finished_at TEXT
+        )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_broadcasts_status ON broadcasts(status)")
+
+
+def _broadcast_segments(c: sqlite3.Connection):
+    # Аудитория рассылки (segments.py) и исходное сообщение админа, которое
+    # рассылается copy_message: медиа загружено в Telegram один раз
+    add_column(c, "broadcasts", "segment", "TEXT NOT NULL DEFAULT 'all'")
+    add_column(c, "broadcasts", "source_chat_id", "INTEGER")
+    add_column(c, "broadcasts", "source_message_id", "INTEGER")
+    # Сегменты "с будущими записями" / "давно не записывались"
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_bookings_user_start
+        ON bookings(telegram_id, start_at, confirmed)
+    """)
+    # Сегмент по балансу
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_coins ON users(coins)")
+
+
+def _deliverability(c: sqlite3.Connection):
+    # Когда Telegram окончательно отказал в доставке (бот заблокирован,
+    # аккаунт удалён); NULL — пользователь достижим
+    add_column(c, "users", "blocked_at", "TEXT")
+    # Получатели рассылок: is_registered = 1 AND blocked_at IS NULL по индексу,
+    # в порядке telegram_id (rowid в конце ключа) — для курсора
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_deliverable ON users(is_registered, blocked_at)")
+
+
+# Таблицы выгрузок, версию данных которых ведут триггеры
+VERSIONED_TABLES = ("users", "bookings", "purchases", "coin_history")
+
+
+def _table_versions(c: sqlite3.Connection):
+    # Версия данных таблицы растёт с каждым изменением: готовая выгрузка
+    # той же версии отдаётся из кэша, а не собирается заново
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS table_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    """)
+    for table in VERSIONED_TABLES:
+        c.execute("INSERT OR IGNORE INTO table_versions (name) VALUES (?)", (table,))
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            c.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS trg_{table}_version_{event.lower()}
+                AFTER {event} ON {table} FOR EACH ROW
+                BEGIN
+                    UPDATE table_versions SET version = version + 1 WHERE name = '{table}';
+                END
+            """)
+    # До какого id админ уже выгрузил таблицу — для выгрузки "только новые"
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS export_watermarks (
+            name TEXT PRIMARY KEY,
+            last_id INTEGER NOT NULL,
+            exported_at TEXT NOT NULL
+        ) WITHOUT ROWID
+    """)
+
+
+def _bump_daily_stats(day: str, **deltas: str) -> str:
+    # Прибавить выражения deltas к строке дня day (для тел триггеров)
+    columns = ", ".join(deltas)
+    values = ", ".join(deltas.values())
+    updates = ", ".join(f"{col} = {col} + excluded.{col}" for col in deltas)
+    return f"""
+        INSERT INTO daily_stats (day, {columns}) VALUES ({day}, {values})
+        ON CONFLICT(day) DO UPDATE SET {updates};
+    """
+
+
+def rebuild_daily_stats(c: sqlite3.Connection):
+    """Пересчёт daily_stats из исходных таблиц одним проходом с GROUP BY.
+
+    Дни те же, что у триггеров: регистрации — по registration_date,
+    записи, отмены и посещения — по дню сессии (start_at), покупки — по
+    timestamp. Поэтому пересчёт и накопленное триггерами совпадают.
+    """
+    c.execute("DELETE FROM daily_stats")
+    c.execute("""
+        INSERT INTO daily_stats (day, new_users, bookings, cancelled, attended, purchases)
+        SELECT day, SUM(new_users), SUM(bookings), SUM(cancelled), SUM(attended), SUM(purchases)
+        FROM (
+            SELECT DATE(registration_date) AS day, 1 AS new_users, 0 AS bookings, 0 AS cancelled,
+                   0 AS attended, 0 AS purchases
+            FROM users WHERE is_registered = 1
+            UNION ALL
+            SELECT DATE(start_at), 0, 1, confirmed IS -1, confirmed IS 2, 0 FROM bookings
+            UNION ALL
+            SELECT DATE(timestamp), 0, 0, 0, 0, 1 FROM purchases
+        )
+        WHERE day IS NOT NULL
+        GROUP BY day
+    """)
+
+
+def _daily_stats(c: sqlite3.Connection):
+    # Счётчики по дням: экраны статистики суммируют несколько десятков строк
+    # по первичному ключу вместо COUNT(*) по исходным таблицам. Поддерживаются
+    # триггерами в тех же транзакциях, что и сами изменения; строки без даты
+    # (NULL start_at / timestamp) не учитываются ни триггерами, ни пересчётом
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            day TEXT PRIMARY KEY,
+            new_users INTEGER NOT NULL DEFAULT 0,
+            bookings INTEGER NOT NULL DEFAULT 0,
+            cancelled INTEGER NOT NULL DEFAULT 0,
+            attended INTEGER NOT NULL DEFAULT 0,
+            purchases INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    """)
+    registered_day = "COALESCE(DATE(NEW.registration_date), DATE('now', 'localtime'))"
+    triggers = {
+        "trg_daily_users_insert": (
+            "AFTER INSERT ON users WHEN NEW.is_registered IS 1",
+            _bump_daily_stats(registered_day, new_users="1"),
+        ),
+        "trg_daily_users_register": (
+            "AFTER UPDATE OF is_registered ON users WHEN (NEW.is_registered IS 1) != (OLD.is_registered IS 1)",
+            _bump_daily_stats(registered_day, new_users="(NEW.is_registered IS 1) - (OLD.is_registered IS 1)"),
+        ),
+        "trg_daily_bookings_insert": (
+            "AFTER INSERT ON bookings WHEN NEW.start_at IS NOT NULL",
+            _bump_daily_stats("DATE(NEW.start_at)", bookings="1", cancelled="NEW.confirmed IS -1",
+                              attended="NEW.confirmed IS 2"),
+        ),
+        "trg_daily_bookings_status": (
+            "AFTER UPDATE OF confirmed ON bookings WHEN NEW.confirmed IS NOT OLD.confirmed AND NEW.start_at IS NOT NULL",
+            _bump_daily_stats("DATE(NEW.start_at)",
+                              cancelled="(NEW.confirmed IS -1) - (OLD.confirmed IS -1)",
+                              attended="(NEW.confirmed IS 2) - (OLD.confirmed IS 2)"),
+        ),
+        "trg_daily_bookings_delete": (
+            "AFTER DELETE ON bookings WHEN OLD.start_at IS NOT NULL",
+            _bump_daily_stats("DATE(OLD.start_at)", bookings="-1", cancelled="-(OLD.confirmed IS -1)",
+                              attended="-(OLD.confirmed IS 2)"),
+        ),
+        "trg_daily_purchases_insert": (
+            "AFTER INSERT ON purchases WHEN NEW.timestamp IS NOT NULL",
+            _bump_daily_stats("DATE(NEW.timestamp)", purchases="1"),
+        ),
+        "trg_daily_purchases_delete": (
+            "AFTER DELETE ON purchases WHEN OLD.timestamp IS NOT NULL",
+            _bump_daily_stats("DATE(OLD.timestamp)", purchases="-1"),
+        ),
+    }
+    for name, (event, body) in triggers.items():
+        c.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {event} BEGIN {body} END")
+    rebuild_daily_stats(c)
+
+
+def _cohort_version(c: sqlite3.Connection):
+    # Версия users растёт и от last_seen (touch_users раз в полминуты), а когортам
+    # важны только регистрация и приглашение — им своя, более узкая версия
+    c.execute("INSERT OR IGNORE INTO table_versions (name) VALUES ('user_cohorts')")
+    bump = "UPDATE table_versions SET version = version + 1 WHERE name = 'user_cohorts';"
+    triggers = {
+        "trg_user_cohorts_insert": "AFTER INSERT ON users",
+        "trg_user_cohorts_update": "AFTER UPDATE OF is_registered, registration_date, invited_by ON users",
+        "trg_user_cohorts_delete": "AFTER DELETE ON users",
+    }
+    for name, event in triggers.items():
+        c.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {event} FOR EACH ROW BEGIN {bump} END")
+
+
+MIGRATIONS = [
+    (1, "base schema", _base_schema),
+    (2, "fix schema drift", _fix_schema_drift),
+    (3, "hot query indexes", _hot_query_indexes),
+    (4, "booking start/end timestamps", _booking_timestamps),
+    (5, "coin ledger balances", _coin_ledger),
+    (6, "users last_seen", _last_seen),
+    (7, "notification log", _notification_log),
+    (8, "leases", _leases),
+    (9, "broadcasts", _broadcasts),
+    (10, "broadcast segments", _broadcast_segments),
+    (11, "users deliverability", _deliverability),
+    (12, "table versions and export watermarks", _table_versions),
+    (13, "daily stats rollup", _daily_stats),
+    (14, "user cohorts version", _cohort_version),
+]
+
+
+def schema_version(c: sqlite3.Connection) -> int:
+    return c.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(c: sqlite3.Connection) -> int:
+    """Применяет недостающие миграции, возвращает итоговую версию схемы."""
+    current = schema_version(c)
+    for version, name, apply in MIGRATIONS:
+        if version <= current:
+            continue
+        logging.info("Applying migration %s: %s", version, name)
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            apply(c)
+            c.execute(f"PRAGMA user_version = {version}")
+        except BaseException:
+            c.execute("ROLLBACK")
+            raise
+        c.execute("COMMIT")
+        current = version
+
+    if current > MIGRATIONS[-1][0]:
+        logging.warning("Database schema %s is newer than this code (%s)", current, MIGRATIONS[-1][0])
+    c.execute("PRAGMA optimize")
+    return current
@@ -1,97 +1,148 @@
 import asyncio
-import sqlite3
+import functools
+import logging
 from datetime import datetime, timedelta
 from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 from dotenv import load_dotenv
 import os
+import db
+from db_async import (
+    get_finished_confirmed_bookings, set_booking_status, claim_notification, release_notification,
+    get_username_by_id, get_user,
+)
+from scheduler import reminders
+import outbound
+from cache import TTLCache
 
 load_dotenv()
-TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_ID = int(os.getenv("ADMIN_ID"))
 
-bot = Bot(token=TOKEN)
-
-async def check_bookings_loop():
-    while True:
-        now = datetime.now()
-        conn = sqlite3.connect("users.db")
-        cursor = conn.cursor()
-
-        # Получаем все записи
-        cursor.execute("""
-            SELECT id, telegram_id, date, time_from, time_to, confirmed
-            FROM bookings
-        """)
-        rows = cursor.fetchall()
-
-        for row in rows:
-            booking_id, user_id, date_str, time_from, time_to, confirmed = row
-            dt_start = datetime.strptime(f"{date_str} {time_from}", "%Y-%m-%d %H")
-            dt_end = datetime.strptime(f"{date_str} {time_to}", "%Y-%m-%d %H")
-            diff = dt_start - now
-
-            # --- Уведомление за 24 часа ---
-            if confirmed >= 0 and 23.9 < diff.total_seconds() / 3600 < 24.1:
-                await bot.send_message(
-                    user_id,
-                    f"📅 До вашей записи осталось 24 часа!\nДата: {date_str}, Время: {time_from}:00–{time_to}:00"
-                )
-
-            # --- Подтверждение за 1 час ---
-            elif confirmed == 0 and 0.9 < diff.total_seconds() / 3600 < 1.1:
-                kb = InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="✅ Я приду", callback_data=f"confirm_booking|{booking_id}")]
-                ])
-                await bot.send_message(
-                    user_id,
-                    f"⏰ Ваша сессия скоро начнётся!\nПодтвердите, что вы придёте.",
-                    reply_markup=kb
-                )
-
-            # --- Автоотмена за 10 минут до начала ---
-            elif confirmed == 0 and 0 < diff.total_seconds() < 600:
-                cursor.execute("UPDATE bookings SET confirmed = -1 WHERE id = ?", (booking_id,))
-                conn.commit()
-                await bot.send_message(
-                    user_id,
-                    "❌ Ваша запись была отменена, так как вы не подтвердили участие за 10 минут до начала."
-                )
-
-        # --- Админ: отметка "Пришёл" для завершённых ---
-        cursor.execute("""
-            SELECT id, telegram_id, date, time_from, time_to
-            FROM bookings
-            WHERE confirmed = 1
-        """)
-        passed = cursor.fetchall()
-
-        for b_id, user_id, date_str, t_from, t_to in passed:
-            dt_end = datetime.strptime(f"{date_str} {t_to}", "%Y-%m-%d %H")
-            if dt_end < now:
-                # пометим как "ожидает отметки"
-                cursor.execute("UPDATE bookings SET confirmed = 3 WHERE id = ?", (b_id,))
-                conn.commit()
-
-                try:
-                    user = await bot.get_chat(user_id)
-                    username = f"@{user.username}" if user.username else f"id:{user.id}"
-                except:
-                    username = f"id:{user_id}"
-
-                kb = InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="✅ Пришёл", callback_data=f"user_came|{b_id}")]
-                ])
-                await bot.send_message(
-                    chat_id=ADMIN_ID,
-                    text=(
-                        f"📌 <b>Прошла запись пользователя</b> {username}\n"
-                        f"📅 {date_str} ⏰ {t_from}:00–{t_to}:00\n\n"
-                        f"Нажмите, если он <b>пришёл</b> ⬇️"
-                    ),
-                    reply_markup=kb,
-                    parse_mode="HTML"
-                )
-
-        conn.close()
-        await asyncio.sleep(60)  # повтор каждые 60 секунд
+
+def _start(booking: dict) -> datetime:
+    return datetime.strptime(booking["start_at"], db.TS_FORMAT)
+
+
+# Имена для отметок админу: users.username, затем кэш ответов get_chat,
+# и только в крайнем случае сам get_chat — не больше GET_CHAT_CONCURRENCY разом
+GET_CHAT_CONCURRENCY = 3
+_chat_usernames = TTLCache(maxsize=5000, ttl=6 * 3600)  # "" — username у чата нет
+_get_chat_limit = asyncio.Semaphore(GET_CHAT_CONCURRENCY)
+
+
+async def resolve_username(bot: Bot, user_id: int) -> str:
+    username = await get_username_by_id(user_id)
+    if username:
+        return f"@{username}"
+
+    username = _chat_usernames.get(user_id)
+    if username is None:
+        try:
+            async with _get_chat_limit:
+                chat = await bot.get_chat(user_id)
+        except TelegramAPIError as e:
+            logging.warning("get_chat(%s) failed: %s", user_id, e)
+            return f"id:{user_id}"
+        username = chat.username or ""
+        _chat_usernames.set(user_id, username)
+    return f"@{username}" if username else f"id:{user_id}"
+
+
+async def _send_once(bot: Bot, booking: dict, kind: str, chat_id: int, text: str, **kwargs) -> bool:
+    # Захват в notification_log до отправки: повторный вызов (рестарт,
+    # догоняющая загрузка) ничего не шлёт. Не ушло — захват снимается
+    if chat_id == booking["telegram_id"]:
+        # Заблокировавшему бота не пишем; отметка снимается его же /start
+        user = await get_user(chat_id)
+        if user is not None and user["blocked_at"] is not None:
+            return False
+    if not await claim_notification(booking["id"], kind):
+        return False
+    try:
+        await bot.send_message(chat_id, text, **kwargs)
+    except BaseException:
+        await release_notification(booking["id"], kind)
+        raise
+    return True
+
+
+# --- Уведомление за 24 часа ---
+async def remind_24h(bot: Bot, booking: dict):
+    if booking["confirmed"] not in (0, 1) or datetime.now() >= _start(booking):
+        return
+    await _send_once(
+        bot, booking, "remind_24h", booking["telegram_id"],
+        f"📅 До вашей записи осталось 24 часа!\nДата: {booking['date']}, "
+        f"Время: {booking['time_from']}:00–{booking['time_to']}:00"
+    )
+
+
+# --- Подтверждение за 1 час ---
+async def confirm_1h(bot: Bot, booking: dict):
+    if booking["confirmed"] != 0 or datetime.now() >= _start(booking) - timedelta(minutes=10):
+        return
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="✅ Я приду", callback_data=f"confirm_booking|{booking['id']}")]
+    ])
+    await _send_once(
+        bot, booking, "confirm_1h", booking["telegram_id"],
+        f"⏰ Ваша сессия скоро начнётся!\nПодтвердите, что вы придёте.",
+        reply_markup=kb
+    )
+
+
+# --- Автоотмена за 10 минут до начала ---
+async def auto_cancel(bot: Bot, booking: dict):
+    if datetime.now() >= _start(booking):
+        return
+    # Только если пользователь так и не подтвердил — проверка в самом UPDATE
+    if not await set_booking_status(booking["id"], -1, expected=0):
+        return
+    await _send_once(
+        bot, booking, "auto_cancel", booking["telegram_id"],
+        "❌ Ваша запись была отменена, так как вы не подтвердили участие за 10 минут до начала."
+    )
+
+
+# --- Админ: отметка "Пришёл" для завершённых ---
+async def attendance(bot: Bot, booking: dict):
+    if booking["confirmed"] != 1:
+        return
+    username = await resolve_username(bot, booking["telegram_id"])
+
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="✅ Пришёл", callback_data=f"user_came|{booking['id']}")]
+    ])
+    await _send_once(
+        bot, booking, "attendance", ADMIN_ID,
+        (
+            f"📌 <b>Прошла запись пользователя</b> {username}\n"
+            f"📅 {booking['date']} ⏰ {booking['time_from']}:00–{booking['time_to']}:00\n\n"
+            f"Нажмите, если он <b>пришёл</b> ⬇️"
+        ),
+        reply_markup=kb,
+        parse_mode="HTML"
+    )
+    # пометим как "ожидает отметки" — уже после отправки, иначе при ошибке
+    # запись осталась бы без отметки навсегда
+    await set_booking_status(booking["id"], 3, expected=1)
+
+
+async def check_bookings_loop(bot: Bot):
+    # Уведомления — своя полоса: не вперёд ответов пользователям
+    outbound.lane.set("notify")
+
+    for kind, handler in (
+        ("remind_24h", remind_24h),
+        ("confirm_1h", confirm_1h),
+        ("auto_cancel", auto_cancel),
+        ("attendance", attendance),
+    ):
+        reminders.on(kind, functools.partial(handler, bot))
+
+    # Завершённые записи, которые не отметили, пока бот был выключен
+    for b_id, *_ in await get_finished_confirmed_bookings(datetime.now()):
+        reminders.push(b_id, "attendance")
+
+    await reminders.run()
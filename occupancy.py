@@ -0,0 +1,105 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+# Занятость часов по дням для выбора времени записи. День — битовая маска
+# по сетке 0–30 (db.BOOKING_DAY_HOURS): бит h — час h занят. Маска строится
+# из db.get_booked_slots при первом обращении, дальше хендлеры проверяют часы
+# без похода в БД. Новая запись дописывает свои биты, отмена сбрасывает день
+# целиком (его перечитает следующее обращение). Записи и отмены других
+# процессов сюда не доходят, поэтому маска живёт TTL секунд, а затем
+# сверяется с версией bookings (table_versions) и перечитывается, только
+# если таблица менялась
+
+DAY_HOURS = 30  # = db.BOOKING_DAY_HOURS
+DAY_FORMAT = "%Y-%m-%d"
+TTL = 15  # секунд без сверки с БД
+
+
+def to_mask(ranges) -> int:
+    """Маска дня из диапазонов (от, до) относительно его полуночи."""
+    mask = 0
+    for start, end in ranges:
+        start, end = max(int(start), 0), min(int(end), DAY_HOURS)
+        if start < end:
+            mask |= ((1 << (end - start)) - 1) << start
+    return mask
+
+
+def is_busy(mask: int, hour: int) -> bool:
+    return 0 <= hour < DAY_HOURS and bool(mask >> hour & 1)
+
+
+def day_masks(start_at: datetime, end_at: datetime) -> dict[str, int]:
+    """Биты записи [start_at, end_at) в сетках всех дней, которые она задевает:
+    ночная сессия видна и в сетке своего дня (24–30), и в утре следующего."""
+    masks = {}
+    day = datetime.combine((start_at - timedelta(hours=DAY_HOURS)).date(), datetime.min.time())
+    while day < end_at:
+        mask = to_mask([((start_at - day) // timedelta(hours=1), (end_at - day) // timedelta(hours=1))])
+        if mask:
+            masks[day.strftime(DAY_FORMAT)] = mask
+        day += timedelta(days=1)
+    return masks
+
+
+class OccupancyIndex:
+    """Потокобезопасный LRU масок занятости по дате "YYYY-MM-DD".
+
+    Поколение дня растёт при каждом изменении и не сбрасывается: маска,
+    прочитанная из БД до чужого коммита, в индекс уже не попадёт (store
+    с устаревшим поколением игнорируется). Запись дня — [маска, версия
+    bookings при загрузке, время сверки].
+    """
+
+    def __init__(self, maxsize: int = 400, ttl: float = TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._masks = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def get(self, day: str) -> int | None:
+        """Маска, сверенная с БД не дольше ttl назад, иначе None."""
+        with self._lock:
+            entry = self._masks.get(day)
+            if entry is None or time.monotonic() - entry[2] >= self.ttl:
+                return None
+            self._masks.move_to_end(day)
+            return entry[0]
+
+    def lookup(self, day: str) -> tuple[int, int | None] | None:
+        # Маска и её версия без учёта возраста — для сверки с версией в БД
+        with self._lock:
+            entry = self._masks.get(day)
+            return (entry[0], entry[1]) if entry is not None else None
+
+    def generation(self, day: str) -> int:
+        with self._lock:
+            return self._generations.get(day, 0)
+
+    def store(self, day: str, mask: int, generation: int, version: int | None = None):
+        with self._lock:
+            if self._generations.get(day, 0) != generation:
+                return
+            self._masks[day] = [mask, version, time.monotonic()]
+            self._masks.move_to_end(day)
+            while len(self._masks) > self.maxsize:
+                self._masks.popitem(last=False)
+
+    def occupy(self, masks: dict[str, int]):
+        with self._lock:
+            for day, bits in masks.items():
+                self._generations[day] = self._generations.get(day, 0) + 1
+                if day in self._masks:
+                    self._masks[day][0] |= bits
+
+    def invalidate(self, *days):
+        with self._lock:
+            for day in days:
+                self._masks.pop(day, None)
+                self._generations[day] = self._generations.get(day, 0) + 1
+
+
+slots = OccupancyIndex()
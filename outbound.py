@@ -0,0 +1,197 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import time
+from contextlib import contextmanager
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import (
+    TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter, TelegramServerError,
+)
+from aiogram.methods.base import Response, TelegramMethod, TelegramType
+
+from cache import TTLCache
+from db_async import commit, mark_user_blocked
+
+# Лимиты Telegram: ~30 сообщений в секунду на бота, ~1 в секунду в личный
+# чат и 20 в минуту в группу
+GLOBAL_RATE = 30
+PRIVATE_CHAT_RATE = 1
+GROUP_CHAT_RATE = 20 / 60
+CHAT_BURST = 3
+
+# Полосы: меньше — важнее. Ответы пользователю не ждут за рассылкой
+# и уведомлениями; массовым полосам оставлен запас глобального лимита
+LANES = {"interactive": 0, "notify": 1, "bulk": 2}
+LANE_RATES = {"notify": 20, "bulk": 20}
+
+MAX_RETRIES = 5
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 30.0
+
+# Лимитируются отправки и правки сообщений; getUpdates, getChat и ответы
+# на callback проходят без очереди
+LIMITED_METHODS = ("Send", "Copy", "Forward", "Edit")
+
+lane: contextvars.ContextVar[str] = contextvars.ContextVar("outbound_lane", default="interactive")
+
+
+@contextmanager
+def priority(name: str):
+    """Отправки внутри блока идут в полосе name."""
+    if name not in LANES:
+        raise ValueError(f"Unknown lane: {name}")
+    token = lane.set(name)
+    try:
+        yield
+    finally:
+        lane.reset(token)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def delay(self) -> float:
+        # Через сколько секунд будет доступен токен (0 — уже есть)
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        while (wait := self.delay()) > 0:
+            await asyncio.sleep(wait)
+        self.take()
+
+
+class PriorityGate:
+    """Общий лимит с очередью по приоритету: свободный токен получает
+    самый важный из ожидающих, а не первый пришедший."""
+
+    def __init__(self, bucket: TokenBucket):
+        self.bucket = bucket
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._pump: asyncio.Task | None = None
+
+    async def acquire(self, prio: int):
+        if not self._waiters and self.bucket.delay() == 0:
+            self.bucket.take()
+            return
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (prio, next(self._seq), fut))
+        if self._pump is None or self._pump.done():
+            self._pump = asyncio.create_task(self._run())
+        await fut
+
+    async def _run(self):
+        while self._waiters:
+            if (wait := self.bucket.delay()) > 0:
+                await asyncio.sleep(wait)
+                continue
+            _, _, fut = heapq.heappop(self._waiters)
+            if not fut.done():  # ожидающего могли отменить
+                self.bucket.take()
+                fut.set_result(None)
+
+
+class OutboundDispatcher(BaseRequestMiddleware):
+    """Все исходящие запросы бота: лимиты Telegram, полосы приоритета,
+    повтор при 429 / 5xx / сетевых ошибках и учёт недоступных пользователей.
+
+    Подключается к сессии единственного Bot (bot.session.middleware), поэтому
+    действует и на ответы хендлеров, и на notifier, и на рассылки. Полоса
+    берётся из контекста: with outbound.priority("bulk"): ...
+    """
+
+    def __init__(self):
+        self._global = PriorityGate(TokenBucket(GLOBAL_RATE, GLOBAL_RATE))
+        self._lanes = {name: TokenBucket(rate, rate) for name, rate in LANE_RATES.items()}
+        self._chats = TTLCache(maxsize=10000, ttl=60)  # простаивающий бакет и так полон
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            is_private = isinstance(chat_id, int) and chat_id > 0
+            bucket = TokenBucket(PRIVATE_CHAT_RATE if is_private else GROUP_CHAT_RATE, CHAT_BURST)
+            self._chats.set(chat_id, bucket)
+        return bucket
+
+    @staticmethod
+    async def _undeliverable(chat_id):
+        # Личный чат, куда Telegram больше не доставляет: помечаем пользователя,
+        # чтобы рассылки и напоминания его пропускали
+        if not (isinstance(chat_id, int) and chat_id > 0):
+            return
+        try:
+            await mark_user_blocked(chat_id)
+        except Exception:
+            logging.exception("Failed to mark %s as blocked", chat_id)
+
+    async def _acquire(self, lane_name: str, chat_id):
+        if chat_id is not None:
+            await self._chat_bucket(chat_id).acquire()
+        if lane_name in self._lanes:
+            await self._lanes[lane_name].acquire()
+        await self._global.acquire(LANES[lane_name])
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        # Записи апдейта фиксируются до сети: блокировку записи БД
+        # не держат ни лимиты, ни ответ Telegram
+        await commit()
+        if not type(method).__name__.startswith(LIMITED_METHODS):
+            return await make_request(bot, method)
+
+        lane_name = lane.get()
+        chat_id = getattr(method, "chat_id", None)
+        for attempt in range(MAX_RETRIES + 1):
+            await self._acquire(lane_name, chat_id)
+            try:
+                return await make_request(bot, method)
+            except TelegramForbiddenError:
+                # Бот заблокирован, аккаунт удалён — повторять бессмысленно
+                await self._undeliverable(chat_id)
+                raise
+            except TelegramBadRequest as e:
+                if "chat not found" in e.message:
+                    await self._undeliverable(chat_id)
+                raise
+            except TelegramRetryAfter as e:
+                if attempt == MAX_RETRIES:
+                    raise
+                logging.warning("Flood control on %s (%s), retry in %ss", type(method).__name__, chat_id, e.retry_after)
+                # Ждать будут все, кто идёт в этот чат или в эту полосу,
+                # а не только повторяющий запрос
+                if chat_id is not None:
+                    self._chat_bucket(chat_id).block(e.retry_after)
+                if lane_name in self._lanes:
+                    self._lanes[lane_name].block(e.retry_after)
+                if chat_id is None and lane_name not in self._lanes:
+                    await asyncio.sleep(e.retry_after)
+            except (TelegramServerError, TelegramNetworkError) as e:
+                if attempt == MAX_RETRIES:
+                    raise
+                delay = min(BACKOFF_BASE * 2 ** attempt, BACKOFF_MAX)
+                logging.warning("%s failed: %s, retry in %.0fs", type(method).__name__, e, delay)
+                await asyncio.sleep(delay)
@@ -0,0 +1,174 @@
+import asyncio
+import heapq
+import itertools
+import logging
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable
+
+import db
+from db_async import get_booking, get_bookings_in_range, get_last_booking_id, get_new_bookings
+from supervisor import supervisor
+
+# События записи: вид -> (от чего отсчитываем, смещение, слать ли с опозданием).
+# Опоздавшее событие — запись сделана позже его срока или бот был выключен:
+# просьбу подтвердить и отметку админу отправляем сразу, а напоминание
+# "за 24 часа" и автоотмену без предупреждения — пропускаем
+EVENTS = {
+    "remind_24h": ("start_at", timedelta(hours=-24), False),
+    "confirm_1h": ("start_at", timedelta(hours=-1), True),
+    "auto_cancel": ("start_at", timedelta(minutes=-10), False),
+    "attendance": ("end_at", timedelta(0), True),
+}
+# События, которые теряют смысл после подтверждения записи
+UNCONFIRMED_ONLY = ("confirm_1h", "auto_cancel")
+
+WINDOW = timedelta(hours=6)  # сколько вперёд держим в очереди
+LOOKBACK = timedelta(hours=1)  # при старте подхватываем пропущенное за простой
+MAX_LEAD = timedelta(hours=24)  # раньше всех срабатывает напоминание за сутки
+# Записи, созданные другими процессами бота, хуки этого процесса не видят —
+# подбираем их запросом по id с таким интервалом
+NEW_BOOKINGS_POLL = timedelta(seconds=30)
+
+Handler = Callable[[dict], Awaitable[None]]
+
+
+class ReminderScheduler:
+    """Очередь событий по записям на куче, а не периодический скан таблицы.
+
+    В памяти — только события ближайшего окна WINDOW; окно сдвигается
+    запросом по индексу start_at, когда до его края доходит время.
+    Хендлеры сообщают об изменениях сразу (booking_added / booking_confirmed
+    / booking_cancelled), а цикл спит ровно до следующего события.
+    Перед вызовом обработчика запись перечитывается: решение о рассылке
+    принимается по её текущему статусу.
+    """
+
+    def __init__(self, window: timedelta = WINDOW):
+        self.window = window
+        self._heap: list[tuple[datetime, int, int, str]] = []
+        self._queued: set[tuple[int, str]] = set()  # отмена — ленивым удалением
+        self._handlers: dict[str, Handler] = {}
+        self._seq = itertools.count()
+        self._loaded_until: datetime | None = None
+        self._last_id = 0
+        self._polled_at = datetime.min
+        self._wakeup = asyncio.Event()
+
+    def on(self, kind: str, handler: Handler):
+        if kind not in EVENTS:
+            raise ValueError(f"Unknown event kind: {kind}")
+        self._handlers[kind] = handler
+
+    def _push(self, due: datetime, booking_id: int, kind: str):
+        if (booking_id, kind) in self._queued:
+            return
+        self._queued.add((booking_id, kind))
+        heapq.heappush(self._heap, (due, next(self._seq), booking_id, kind))
+        if self._heap[0][2:] == (booking_id, kind):
+            self._wakeup.set()
+
+    def _schedule(self, booking_id: int, times: dict[str, datetime], since: datetime, until: datetime):
+        now = datetime.now()
+        for kind, (anchor, offset, late_ok) in EVENTS.items():
+            due = times[anchor] + offset
+            if since < due <= until and (late_ok or due > now):
+                self._push(due, booking_id, kind)
+
+    # --- Хуки для хендлеров
+
+    def booking_added(self, booking_id: int, start_at: datetime, end_at: datetime):
+        if self._loaded_until is None:
+            return  # планировщик не запущен, запись подхватит первая загрузка
+        since = datetime.now() - LOOKBACK
+        self._schedule(booking_id, {"start_at": start_at, "end_at": end_at}, since, self._loaded_until)
+
+    def booking_confirmed(self, booking_id: int):
+        for kind in UNCONFIRMED_ONLY:
+            self._queued.discard((booking_id, kind))
+
+    def booking_cancelled(self, booking_id: int):
+        for kind in EVENTS:
+            self._queued.discard((booking_id, kind))
+
+    def push(self, booking_id: int, kind: str, due: datetime | None = None):
+        # Внеочередное событие, например догоняющая отметка после простоя
+        self._push(due or datetime.now(), booking_id, kind)
+
+    # --- Цикл
+
+    async def _extend(self, until: datetime):
+        since = self._loaded_until
+        # Граница сдвигается до запроса: хуки, сработавшие пока он идёт,
+        # сразу кладут события в новое окно, а дубли отсекает _queued
+        self._loaded_until = until
+        for b in await get_bookings_in_range(since, until + MAX_LEAD):
+            times = {anchor: datetime.strptime(b[anchor], db.TS_FORMAT) for anchor in ("start_at", "end_at")}
+            self._schedule(b["id"], times, since, until)
+
+    async def _poll_new(self):
+        # Повторно поставленное событие своей же записи не разошлётся дважды:
+        # отправку закрепляет notification_log
+        since = datetime.now() - LOOKBACK
+        while rows := await get_new_bookings(self._last_id):
+            for b in rows:
+                times = {anchor: datetime.strptime(b[anchor], db.TS_FORMAT) for anchor in ("start_at", "end_at")}
+                self._schedule(b["id"], times, since, self._loaded_until)
+            self._last_id = rows[-1]["id"]
+        self._polled_at = datetime.now()
+
+    async def _fire(self, booking_id: int, kind: str):
+        handler = self._handlers.get(kind)
+        if handler is None:
+            return
+        booking = await get_booking(booking_id)
+        if booking is None or booking["confirmed"] == -1:
+            return
+        await handler(booking)
+
+    async def run(self):
+        try:
+            await self._run()
+        finally:
+            # Остановлен (например, процесс потерял лидерство): следующий
+            # запуск начнёт с чистой очереди, а хуки до тех пор ничего не копят
+            self._loaded_until = None
+            self._heap.clear()
+            self._queued.clear()
+
+    async def _run(self):
+        now = datetime.now()
+        self._last_id = await get_last_booking_id()
+        self._loaded_until = now - LOOKBACK
+        await self._extend(now + self.window)
+        self._polled_at = now
+
+        while True:
+            now = datetime.now()
+            if now + self.window / 2 >= self._loaded_until:
+                await self._extend(now + self.window)
+            if now >= self._polled_at + NEW_BOOKINGS_POLL:
+                await self._poll_new()
+
+            while self._heap and self._heap[0][0] <= now:
+                _, _, booking_id, kind = heapq.heappop(self._heap)
+                if (booking_id, kind) not in self._queued:
+                    continue
+                self._queued.discard((booking_id, kind))
+                # Ошибка одной записи (пользователь заблокировал бота и т.п.)
+                # не останавливает очередь; начатая отправка доживёт до конца
+                # даже при остановке бота
+                try:
+                    await supervisor.track(self._fire(booking_id, kind))
+                except Exception:
+                    logging.exception("Reminder %s for booking %s failed", kind, booking_id)
+
+            next_due = self._heap[0][0] if self._heap else self._loaded_until
+            wake_at = min(next_due, self._loaded_until - self.window / 2, self._polled_at + NEW_BOOKINGS_POLL)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max((wake_at - datetime.now()).total_seconds(), 0))
+            except asyncio.TimeoutError:
+                pass
+
+
+reminders = ReminderScheduler()
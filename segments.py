@@ -0,0 +1,96 @@
+from datetime import datetime, timedelta
+
+import db
+
+# Аудитории рассылок. Сегмент хранится строкой "вид[:параметр...]",
+# например "coins:100:500", и превращается в условие на users u для
+# запроса получателей с курсором по telegram_id (db.get_broadcast_recipients)
+# и для подсчёта аудитории до подтверждения.
+# Вид -> (название, вопрос о параметре или None, число параметров)
+SEGMENTS = {
+    "all": ("👥 Все зарегистрированные", None, 0),
+    "upcoming": ("📅 С будущими записями", None, 0),
+    "inactive": ("💤 Давно не записывались", "Сколько дней без записей? Например: 30", 1),
+    "coins": ("🍓 Баланс монет", "Диапазон баланса через дефис, например: 100-500", 2),
+    "underage": ("🧒 Несовершеннолетние", None, 0),
+    "adults": ("🧑 Совершеннолетние", None, 0),
+    "referred": ("🤝 Пришли по приглашению", None, 0),
+    "referred_by": ("🔗 Приглашённые пользователем", "Telegram ID пригласившего", 1),
+}
+
+
+def parse(segment: str) -> tuple[str, tuple[int, ...]]:
+    kind, *args = segment.split(":")
+    if kind not in SEGMENTS or len(args) != SEGMENTS[kind][2]:
+        raise ValueError(f"Unknown segment: {segment}")
+    return kind, tuple(int(a) for a in args)
+
+
+def from_input(kind: str, text: str) -> str:
+    """Сегмент из вида и ответа админа на вопрос о параметре; ValueError — неверный ввод."""
+    values = [int(v) for v in text.replace(" ", "").split("-")]
+    if len(values) != SEGMENTS[kind][2] or any(v < 0 for v in values):
+        raise ValueError(text)
+    if kind == "coins" and values[0] > values[1]:
+        raise ValueError(text)
+    return ":".join([kind, *map(str, values)])
+
+
+def describe(segment: str) -> str:
+    kind, args = parse(segment)
+    title = SEGMENTS[kind][0]
+    if kind == "inactive":
+        return f"{title}: {args[0]} дн."
+    if kind == "coins":
+        return f"{title}: {args[0]}–{args[1]}"
+    if kind == "referred_by":
+        return f"{title}: {args[0]}"
+    return title
+
+
+def sql_filter(segment: str, now: datetime) -> tuple[str, tuple]:
+    """Условие на users u (без is_registered) и его параметры.
+
+    Записи проверяются подзапросом по idx_bookings_user_start, баланс —
+    по idx_users_coins, приглашения — по idx_users_invited_by.
+    """
+    kind, args = parse(segment)
+    if kind == "upcoming":
+        return ("""EXISTS (SELECT 1 FROM bookings b WHERE b.telegram_id = u.telegram_id
+                   AND b.start_at >= ? AND b.confirmed != -1)""", (db.to_ts(now),))
+    if kind == "inactive":
+        return ("""NOT EXISTS (SELECT 1 FROM bookings b WHERE b.telegram_id = u.telegram_id
+                   AND b.start_at >= ?)""", (db.to_ts(now - timedelta(days=args[0])),))
+    if kind == "coins":
+        return "u.coins BETWEEN ? AND ?", args
+    if kind == "underage":
+        return "u.underage = 1", ()
+    if kind == "adults":
+        return "u.underage = 0", ()
+    if kind == "referred":
+        return "u.invited_by IS NOT NULL", ()
+    if kind == "referred_by":
+        return "u.invited_by = ?", args
+    return "1", ()
+
+
+def matches(segment: str, user: dict, bookings: list[dict], now: datetime) -> bool:
+    """То же условие для хранилища в памяти; bookings — записи пользователя."""
+    kind, args = parse(segment)
+    if kind == "upcoming":
+        now_ts = db.to_ts(now)
+        return any(b["start_at"] >= now_ts and b["confirmed"] != -1 for b in bookings)
+    if kind == "inactive":
+        since = db.to_ts(now - timedelta(days=args[0]))
+        return not any(b["start_at"] >= since for b in bookings)
+    if kind == "coins":
+        return user["coins"] is not None and args[0] <= user["coins"] <= args[1]
+    if kind == "underage":
+        return user["underage"] == 1
+    if kind == "adults":
+        return user["underage"] == 0
+    if kind == "referred":
+        return user["invited_by"] is not None
+    if kind == "referred_by":
+        return user["invited_by"] == args[0]
+    return True
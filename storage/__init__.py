@@ -0,0 +1,34 @@
+import importlib
+import os
+
+from storage.base import Storage
+
+# Реализации хранилища: имя -> "модуль:класс". Импортируются лениво,
+# чтобы memory-бэкенд не поднимал пулы потоков SQLite
+BACKENDS = {
+    "sqlite": "storage.sqlite:SQLiteStorage",
+    "memory": "storage.memory:MemoryStorage",
+}
+
+_current: Storage | None = None
+
+
+def create(name: str) -> Storage:
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown storage backend: {name}")
+    module, cls = BACKENDS[name].split(":")
+    return getattr(importlib.import_module(module), cls)()
+
+
+def use(backend: str | Storage) -> Storage:
+    """Выбрать хранилище: имя из BACKENDS или готовый экземпляр.
+    Вызывается до init(), например из нагрузочного теста."""
+    global _current
+    _current = create(backend) if isinstance(backend, str) else backend
+    return _current
+
+
+def get_storage() -> Storage:
+    if _current is None:
+        use(os.getenv("STORAGE_BACKEND", "sqlite"))
+    return _current
@@ -0,0 +1,253 @@
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+
+class Storage:
+    """Хранилище бота: пользователи, монеты, записи, магазин и покупки.
+
+    Все методы — корутины; форматы возвращаемых значений совпадают
+    с функциями db.py, поэтому хендлеры не зависят от реализации.
+    """
+
+    name = "base"
+
+    async def init(self):
+        pass
+
+    async def maintain(self):
+        # Фоновое обслуживание хранилища (контрольные точки WAL и т.п.)
+        pass
+
+    async def close(self):
+        pass
+
+    @asynccontextmanager
+    async def session(self):
+        """Единица работы на апдейт: вызовы внутри фиксируются вместе
+        при выходе (или раньше, в commit()) и откатываются при исключении.
+        По умолчанию каждый вызов атомарен сам по себе и отдельной
+        транзакции нет."""
+        yield self
+
+    async def on_commit(self, callback):
+        """Вызвать callback после фиксации текущей сессии (при откате — нет);
+        вне сессии — сразу. Например, разбудить фоновую задачу, которая
+        читает записанное другим соединением."""
+        callback()
+
+    async def begin_write(self):
+        """Открыть транзакцию записи сессии сейчас, до первой записи:
+        чтения после неё видят то же состояние, в которое пишет хендлер.
+        Нужна перед чтением, от которого зависит запись."""
+
+    async def commit(self):
+        """Зафиксировать записанное сессией и отпустить блокировку записи;
+        сессия продолжается. Вызывается перед запросами к Telegram."""
+
+    # --- Пользователи
+
+    async def get_user(self, user_id: int) -> dict | None:
+        raise NotImplementedError
+
+    async def get_username_by_id(self, user_id: int) -> str | None:
+        user = await self.get_user(user_id)
+        return user["username"] if user else None
+
+    async def user_exists(self, telegram_id: int) -> bool:
+        return await self.get_user(telegram_id) is not None
+
+    async def is_user_registered(self, telegram_id: int) -> bool:
+        user = await self.get_user(telegram_id)
+        return bool(user and user["is_registered"] == 1)
+
+    async def start_user(self, telegram_id: int, full_name: str, username: str,
+                         inviter_id: int | None = None) -> dict:
+        raise NotImplementedError
+
+    async def get_user_by_username(self, username: str) -> dict | None:
+        raise NotImplementedError
+
+    async def add_user(self, telegram_id, full_name, username, invited_by=None):
+        raise NotImplementedError
+
+    async def set_invited_by(self, telegram_id: int, inviter_id: int) -> bool:
+        raise NotImplementedError
+
+    async def add_user_after_register(self, telegram_id, full_name, birth_date, phone, age, underage):
+        raise NotImplementedError
+
+    async def touch_users(self, rows: list[tuple[int, str | None, str | None, str]]):
+        # Пачка (telegram_id, username, full_name, last_seen) от ActivityMiddleware
+        raise NotImplementedError
+
+    async def mark_user_blocked(self, telegram_id: int):
+        raise NotImplementedError
+
+    async def get_referral_count(self, referrer_id: int) -> int:
+        raise NotImplementedError
+
+    async def add_referral_bonus(self, inviter_id: int) -> bool:
+        raise NotImplementedError
+
+    async def add_referral_reward(self, referrer_id: int):
+        raise NotImplementedError
+
+    # --- Монеты
+
+    async def get_user_coins(self, user_id: int) -> int:
+        user = await self.get_user(user_id)
+        return user["coins"] if user else 0
+
+    async def update_user_coins(self, user_id, new_amount):
+        raise NotImplementedError
+
+    async def adjust_user_coins(self, user_id: int, delta: int, clamp: bool = False,
+                                action: str = "admin", description: str = "Изменение администратором") -> int | None:
+        raise NotImplementedError
+
+    async def apply_coin_operations(self, operations: list[tuple[int, int, str]], action: str = "batch") -> list[int]:
+        raise NotImplementedError
+
+    async def get_coin_history(self, user_id: int) -> list[dict]:
+        raise NotImplementedError
+
+    # --- Записи
+
+    async def get_booked_slots(self, date: str) -> list[tuple[int, int]]:
+        raise NotImplementedError
+
+    async def get_day_occupancy(self, date: str) -> int:
+        """Маска занятых часов дня по сетке 0–30 (occupancy.to_mask)."""
+        raise NotImplementedError
+
+    async def add_booking(self, telegram_id: int, date: str, time_from: str, time_to: str, tariff: str) -> int:
+        raise NotImplementedError
+
+    async def get_booking(self, booking_id: int) -> dict | None:
+        raise NotImplementedError
+
+    async def get_user_bookings(self, telegram_id: int) -> list[dict]:
+        raise NotImplementedError
+
+    async def get_user_bookings_by_status(self, telegram_id: int, status: str) -> list[dict]:
+        raise NotImplementedError
+
+    async def set_booking_status(self, booking_id: int, status: int, expected: int | None = None) -> bool:
+        raise NotImplementedError
+
+    async def cancel_user_booking(self, booking_id: int, telegram_id: int) -> bool:
+        raise NotImplementedError
+
+    async def get_upcoming_user_bookings(self, telegram_id: int, now: datetime) -> list[dict]:
+        raise NotImplementedError
+
+    async def get_bookings_in_range(self, start: datetime, end: datetime) -> list[dict]:
+        raise NotImplementedError
+
+    async def get_finished_confirmed_bookings(self, now: datetime) -> list[tuple]:
+        raise NotImplementedError
+
+    async def get_last_booking_id(self) -> int:
+        raise NotImplementedError
+
+    async def get_new_bookings(self, after_id: int, limit: int = 500) -> list[dict]:
+        raise NotImplementedError
+
+    async def claim_notification(self, booking_id: int, kind: str) -> bool:
+        raise NotImplementedError
+
+    async def release_notification(self, booking_id: int, kind: str):
+        raise NotImplementedError
+
+    async def get_future_records(self, today: str) -> list[tuple]:
+        raise NotImplementedError
+
+    async def get_past_records(self, today: str, since: str) -> list[tuple]:
+        raise NotImplementedError
+
+    async def get_statistics(self, since: str, until: str | None = None) -> dict:
+        raise NotImplementedError
+
+    async def rebuild_daily_stats(self):
+        raise NotImplementedError
+
+    # --- Аренды для выбора лидера между процессами
+
+    async def acquire_lease(self, name: str, holder: str, ttl: float) -> bool:
+        raise NotImplementedError
+
+    async def release_lease(self, name: str, holder: str):
+        raise NotImplementedError
+
+    # --- Рассылки
+
+    async def count_audience(self, segment: str) -> int:
+        raise NotImplementedError
+
+    async def create_broadcast(self, admin_id: int, text: str, status_chat_id: int, status_message_id: int,
+                               segment: str = "all", source_chat_id: int | None = None,
+                               source_message_id: int | None = None) -> dict:
+        raise NotImplementedError
+
+    async def get_broadcast(self, broadcast_id: int) -> dict | None:
+        raise NotImplementedError
+
+    async def get_running_broadcasts(self) -> list[dict]:
+        raise NotImplementedError
+
+    async def get_broadcast_recipients(self, after_id: int, limit: int, segment: str = "all") -> list[int]:
+        raise NotImplementedError
+
+    async def advance_broadcast(self, broadcast_id: int, cursor: int, sent: int, failed: int):
+        raise NotImplementedError
+
+    async def set_broadcast_status(self, broadcast_id: int, status: str) -> bool:
+        raise NotImplementedError
+
+    # --- Магазин и покупки
+
+    async def get_all_shop_items(self) -> list[dict]:
+        raise NotImplementedError
+
+    async def add_shop_item(self, name: str, description: str, price: int):
+        raise NotImplementedError
+
+    async def update_shop_item(self, item_id: int, field: str, value):
+        raise NotImplementedError
+
+    async def delete_shop_item(self, item_id: int) -> str | None:
+        raise NotImplementedError
+
+    async def purchase_item(self, user_id, item_id) -> tuple[bool, str]:
+        raise NotImplementedError
+
+    async def get_active_purchases(self, user_id: int) -> list[dict]:
+        raise NotImplementedError
+
+    async def get_user_purchases(self, telegram_id: int) -> list[dict]:
+        raise NotImplementedError
+
+    async def mark_purchase_as_used(self, purchase_id: int):
+        raise NotImplementedError
+
+    # --- Экспорт
+
+    async def export_table(self, table: str, fmt: str, after_id: int | None = None) -> dict:
+        """Файл выгрузки (exporter.FORMATS): path, rows, last_id и cached.
+
+        after_id — только строки с id больше него. Файл с cached=False
+        удаляет вызывающий, кэшированный живёт до следующей версии таблицы.
+        """
+        raise NotImplementedError
+
+    async def export_report(self, report: str, fmt: str, start: str, end: str) -> dict:
+        raise NotImplementedError
+
+    async def get_table_version(self, table: str) -> int | None:
+        raise NotImplementedError
+
+    async def get_export_watermark(self, table: str) -> int | None:
+        raise NotImplementedError
+
+    async def set_export_watermark(self, table: str, last_id: int):
+        raise NotImplementedError
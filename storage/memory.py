@@ -0,0 +1,564 @@
+import asyncio
+import bisect
+import itertools
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import db
+import exporter
+import occupancy
+import segments
+from storage.base import Storage
+
+# Колонки таблиц в том же порядке, что и в SQLite (для выгрузок)
+USER_COLUMNS = (
+    "telegram_id", "full_name", "username", "birth_date", "phone", "birthdate", "age", "underage",
+    "coins", "invited_by", "invited_count", "is_registered", "referrals_count", "registration_date",
+    "last_seen", "blocked_at",
+)
+BOOKING_COLUMNS = (
+    "id", "telegram_id", "date", "time_from", "time_to", "tariff", "confirmed", "attended", "start_at", "end_at",
+)
+PURCHASE_COLUMNS = ("id", "telegram_id", "shop_item_id", "code", "status", "timestamp")
+HISTORY_COLUMNS = ("id", "telegram_id", "action", "amount", "description", "timestamp", "balance_after")
+
+# Верхняя граница для диапазонов start_at "до бесконечности"
+_END_OF_TIME = "9999-12-31 23:59:59"
+
+
+class MemoryStorage(Storage):
+    """Хранилище в памяти процесса на словарях с индексами.
+
+    Для нагрузочных тестов и прогона notifier без диска: методы выполняются
+    прямо в event loop и не содержат await, поэтому каждый из них атомарен.
+    Данные не переживают перезапуск.
+    """
+
+    name = "memory"
+
+    def __init__(self):
+        self.users: dict[int, dict] = {}
+        self.bookings: dict[int, dict] = {}
+        self.shop_items: dict[int, dict] = {}
+        self.purchases: dict[int, dict] = {}
+        self.coin_history: list[dict] = []
+        self.notification_log: dict[tuple[int, str], str] = {}
+        self.leases: dict[str, tuple[str, float]] = {}
+        self.broadcasts: dict[int, dict] = {}
+        self.export_watermarks: dict[str, int] = {}
+
+        # Индексы
+        self._by_username: dict[str, int] = {}
+        self._invitees: dict[int, set[int]] = defaultdict(set)
+        self._user_bookings: dict[int, list[int]] = defaultdict(list)
+        self._bookings_by_start: list[tuple[str, int]] = []  # (start_at, id), отсортирован
+        self._user_purchases: dict[int, list[int]] = defaultdict(list)
+        self._user_history: dict[int, list[dict]] = defaultdict(list)
+
+        self._ids = defaultdict(int)
+
+    def _next_id(self, table: str) -> int:
+        self._ids[table] += 1
+        return self._ids[table]
+
+    # --- Пользователи
+
+    def _insert_user(self, telegram_id: int, **fields) -> dict:
+        user = dict.fromkeys(USER_COLUMNS)
+        user.update(telegram_id=telegram_id, underage=0, coins=0, invited_count=0,
+                    is_registered=0, referrals_count=0)
+        user.update(fields)
+        self.users[telegram_id] = user
+        if user["username"]:
+            self._by_username[user["username"]] = telegram_id
+        if user["invited_by"] is not None:
+            self._invitees[user["invited_by"]].add(telegram_id)
+        return user
+
+    def _set_inviter(self, user: dict, inviter_id: int):
+        user["invited_by"] = inviter_id
+        self._invitees[inviter_id].add(user["telegram_id"])
+
+    async def get_user(self, user_id: int) -> dict | None:
+        user = self.users.get(user_id)
+        return dict(user) if user else None
+
+    async def start_user(self, telegram_id: int, full_name: str, username: str,
+                         inviter_id: int | None = None) -> dict:
+        result = {"is_new": False, "invited": False, "inviter_username": None}
+        user = self.users.get(telegram_id)
+        if user is None:
+            user = self._insert_user(telegram_id, full_name=full_name, username=username,
+                                     registration_date=datetime.now().date().isoformat())
+            result["is_new"] = True
+        else:
+            user["blocked_at"] = None  # /start от заблокировавшего бота — он снова доступен
+
+        if inviter_id and inviter_id != telegram_id and user["invited_by"] is None:
+            self._set_inviter(user, inviter_id)
+            result["invited"] = True
+            self._credit_referral_bonus(inviter_id)
+            inviter = self.users.get(inviter_id)
+            result["inviter_username"] = inviter["username"] if inviter else None
+
+        result["user"] = dict(user)
+        return result
+
+    async def get_user_by_username(self, username: str) -> dict | None:
+        user_id = self._by_username.get(username)
+        return await self.get_user(user_id) if user_id is not None else None
+
+    async def add_user(self, telegram_id, full_name, username, invited_by=None):
+        if telegram_id in self.users:
+            return
+        self._insert_user(telegram_id, full_name=full_name, username=username, invited_by=invited_by,
+                          registration_date=datetime.now().date().isoformat())
+        if invited_by and invited_by != telegram_id:
+            self._credit_referral_bonus(invited_by)
+
+    async def set_invited_by(self, telegram_id: int, inviter_id: int) -> bool:
+        user = self.users.get(telegram_id)
+        if user and user["invited_by"] is None and inviter_id != telegram_id:
+            self._set_inviter(user, inviter_id)
+            self._credit_referral_bonus(inviter_id)
+            return True
+        return False
+
+    async def add_user_after_register(self, telegram_id, full_name, birth_date, phone, age, underage):
+        user = self.users.get(telegram_id)
+        if user:
+            user.update(full_name=full_name, birthdate=birth_date, phone=phone, age=age,
+                        underage=underage, is_registered=1)
+
+    async def touch_users(self, rows: list[tuple[int, str | None, str | None, str]]):
+        for telegram_id, username, full_name, last_seen in rows:
+            user = self.users.get(telegram_id)
+            if not user:
+                continue
+            if user["username"] != username:
+                if self._by_username.get(user["username"]) == telegram_id:
+                    del self._by_username[user["username"]]
+                if username:
+                    self._by_username[username] = telegram_id
+            user.update(username=username, full_name=full_name, last_seen=last_seen, blocked_at=None)
+
+    async def mark_user_blocked(self, telegram_id: int):
+        user = self.users.get(telegram_id)
+        if user and user["blocked_at"] is None:
+            user["blocked_at"] = db.to_ts(datetime.now())
+
+    async def get_referral_count(self, referrer_id: int) -> int:
+        return len(self._invitees.get(referrer_id, ()))
+
+    async def add_referral_bonus(self, inviter_id: int) -> bool:
+        return self._credit_referral_bonus(inviter_id) is not None
+
+    async def add_referral_reward(self, referrer_id: int):
+        user = self.users.get(referrer_id)
+        if user:
+            user["referrals_count"] += 1
+            self._change_coins(user, db.REFERRAL_BONUS, "referral", "Награда за реферала")
+
+    # --- Монеты: те же правила, что в движке монет db.py
+
+    def _change_coins(self, user: dict, amount: int, action: str, description: str) -> int:
+        user["coins"] += amount
+        if amount:
+            row = {
+                "id": self._next_id("coin_history"),
+                "telegram_id": user["telegram_id"],
+                "action": action,
+                "amount": amount,
+                "description": description,
+                "timestamp": datetime.now().strftime(db.TS_FORMAT),
+                "balance_after": user["coins"],
+            }
+            self.coin_history.append(row)
+            self._user_history[user["telegram_id"]].append(row)
+        return user["coins"]
+
+    def _credit(self, user_id: int, amount: int, action: str, description: str) -> int | None:
+        user = self.users.get(user_id)
+        return self._change_coins(user, amount, action, description) if user else None
+
+    def _debit(self, user_id: int, amount: int, action: str, description: str) -> int | None:
+        user = self.users.get(user_id)
+        if not user or user["coins"] < amount:
+            return None
+        return self._change_coins(user, -amount, action, description)
+
+    def _credit_referral_bonus(self, inviter_id: int) -> int | None:
+        user = self.users.get(inviter_id)
+        if not user or user["invited_count"] >= db.REFERRAL_LIMIT:
+            return None
+        user["invited_count"] += 1
+        return self._change_coins(user, db.REFERRAL_BONUS, "referral", "Бонус за приглашённого друга")
+
+    async def update_user_coins(self, user_id, new_amount):
+        user = self.users.get(user_id)
+        if user:
+            self._change_coins(user, new_amount - user["coins"], "admin", "Изменение администратором")
+
+    async def adjust_user_coins(self, user_id: int, delta: int, clamp: bool = False,
+                                action: str = "admin", description: str = "Изменение администратором") -> int | None:
+        if delta >= 0:
+            return self._credit(user_id, delta, action, description)
+        if clamp:
+            user = self.users.get(user_id)
+            if not user:
+                return None
+            return self._debit(user_id, min(-delta, user["coins"]), action, description)
+        return self._debit(user_id, -delta, action, description)
+
+    async def apply_coin_operations(self, operations: list[tuple[int, int, str]], action: str = "batch") -> list[int]:
+        # Всё или ничего: сначала проверяем, что каждая операция пройдёт
+        projected = {}
+        for user_id, delta, _ in operations:
+            if user_id not in self.users:
+                raise db.InsufficientCoins(user_id)
+            balance = projected.get(user_id, self.users[user_id]["coins"]) + delta
+            if balance < 0:
+                raise db.InsufficientCoins(user_id)
+            projected[user_id] = balance
+        return [
+            self._change_coins(self.users[user_id], delta, action, description)
+            for user_id, delta, description in operations
+        ]
+
+    async def get_coin_history(self, user_id: int) -> list[dict]:
+        rows = sorted(self._user_history.get(user_id, ()), key=lambda r: (r["timestamp"], r["id"]), reverse=True)
+        return [{k: row[k] for k in ("action", "amount", "description", "timestamp")} for row in rows]
+
+    # --- Записи
+
+    def _bookings_starting(self, start: str, end: str):
+        # Записи с start_at в [start, end) по отсортированному индексу
+        lo = bisect.bisect_left(self._bookings_by_start, (start,))
+        hi = bisect.bisect_left(self._bookings_by_start, (end,))
+        for _, booking_id in self._bookings_by_start[lo:hi]:
+            yield self.bookings[booking_id]
+
+    async def get_booked_slots(self, date: str) -> list[tuple[int, int]]:
+        day = datetime.strptime(date, "%Y-%m-%d")
+        lo = db.to_ts(day - timedelta(hours=db.MAX_BOOKING_HOURS))
+        hi = db.to_ts(day + timedelta(hours=db.BOOKING_DAY_HOURS))
+        slots = []
+        for b in self._bookings_starting(lo, hi):
+            if b["end_at"] > db.to_ts(day) and b["confirmed"] != -1:
+                start = datetime.strptime(b["start_at"], db.TS_FORMAT) - day
+                end = datetime.strptime(b["end_at"], db.TS_FORMAT) - day
+                slots.append((round(start.total_seconds() / 3600), round(end.total_seconds() / 3600)))
+        return slots
+
+    async def get_day_occupancy(self, date: str) -> int:
+        return occupancy.to_mask(await self.get_booked_slots(date))
+
+    async def add_booking(self, telegram_id: int, date: str, time_from: str, time_to: str, tariff: str) -> int:
+        start_at, end_at = db.booking_interval(date, time_from, time_to)
+        booking = {
+            "id": self._next_id("bookings"),
+            "telegram_id": telegram_id,
+            "date": date,
+            "time_from": time_from,
+            "time_to": time_to,
+            "tariff": tariff,
+            "confirmed": 0,
+            "attended": 0,
+            "start_at": db.to_ts(start_at),
+            "end_at": db.to_ts(end_at),
+        }
+        self.bookings[booking["id"]] = booking
+        self._user_bookings[telegram_id].append(booking["id"])
+        bisect.insort(self._bookings_by_start, (booking["start_at"], booking["id"]))
+        return booking["id"]
+
+    async def get_booking(self, booking_id: int) -> dict | None:
+        booking = self.bookings.get(booking_id)
+        return dict(booking) if booking else None
+
+    def _user_booking_rows(self, telegram_id: int):
+        return (self.bookings[i] for i in self._user_bookings.get(telegram_id, ()))
+
+    @staticmethod
+    def _short(booking: dict) -> dict:
+        return {k: booking[k] for k in ("id", "date", "time_from", "time_to", "start_at", "end_at")}
+
+    async def get_user_bookings(self, telegram_id: int) -> list[dict]:
+        rows = [b for b in self._user_booking_rows(telegram_id) if b["confirmed"] != -1]
+        return [dict(b) for b in sorted(rows, key=lambda b: (b["date"], b["time_from"]))]
+
+    async def get_user_bookings_by_status(self, telegram_id: int, status: str) -> list[dict]:
+        conditions = {
+            "active": lambda s: s >= 0,
+            "cancelled": lambda s: s == -1,
+            "past": lambda s: s == 2,
+        }
+        matches = conditions[status]
+        rows = [b for b in self._user_booking_rows(telegram_id) if matches(b["confirmed"])]
+        return [self._short(b) for b in sorted(rows, key=lambda b: b["start_at"])]
+
+    async def set_booking_status(self, booking_id: int, status: int, expected: int | None = None) -> bool:
+        booking = self.bookings.get(booking_id)
+        if not booking or (expected is not None and booking["confirmed"] != expected):
+            return False
+        booking["confirmed"] = status
+        return True
+
+    async def cancel_user_booking(self, booking_id: int, telegram_id: int) -> bool:
+        booking = self.bookings.get(booking_id)
+        if not booking or booking["telegram_id"] != telegram_id or booking["confirmed"] < 0:
+            return False
+        booking["confirmed"] = -1
+        return True
+
+    async def get_upcoming_user_bookings(self, telegram_id: int, now: datetime) -> list[dict]:
+        now_ts = db.to_ts(now)
+        rows = [b for b in self._user_booking_rows(telegram_id) if b["confirmed"] >= 0 and b["start_at"] > now_ts]
+        return [self._short(b) for b in sorted(rows, key=lambda b: b["start_at"])]
+
+    async def get_bookings_in_range(self, start: datetime, end: datetime) -> list[dict]:
+        lo = db.to_ts(start - timedelta(hours=db.MAX_BOOKING_HOURS))
+        start_ts = db.to_ts(start)
+        return [
+            dict(b) for b in self._bookings_starting(lo, db.to_ts(end))
+            if b["end_at"] > start_ts and b["confirmed"] != -1
+        ]
+
+    async def get_finished_confirmed_bookings(self, now: datetime) -> list[tuple]:
+        now_ts = db.to_ts(now)
+        return [
+            (b["id"], b["telegram_id"], b["date"], b["time_from"], b["time_to"])
+            for b in self.bookings.values()
+            if b["confirmed"] == 1 and b["end_at"] < now_ts
+        ]
+
+    async def get_last_booking_id(self) -> int:
+        return self._ids["bookings"]
+
+    async def get_new_bookings(self, after_id: int, limit: int = 500) -> list[dict]:
+        ids = sorted(i for i in self.bookings if i > after_id)[:limit]
+        return [dict(self.bookings[i]) for i in ids]
+
+    async def claim_notification(self, booking_id: int, kind: str) -> bool:
+        if (booking_id, kind) in self.notification_log:
+            return False
+        self.notification_log[booking_id, kind] = datetime.now().strftime(db.TS_FORMAT)
+        return True
+
+    async def release_notification(self, booking_id: int, kind: str):
+        self.notification_log.pop((booking_id, kind), None)
+
+    def _record(self, b: dict) -> tuple | None:
+        user = self.users.get(b["telegram_id"])
+        if not user:
+            return None
+        return (b["date"], b["time_from"], b["time_to"], b["tariff"], b["confirmed"], b["attended"],
+                user["full_name"], user["username"], b["start_at"])
+
+    async def get_future_records(self, today: str) -> list[tuple]:
+        rows = (self._record(b) for b in self._bookings_starting(today, _END_OF_TIME) if b["confirmed"] != -1)
+        return [r for r in rows if r]
+
+    async def get_past_records(self, today: str, since: str) -> list[tuple]:
+        rows = (self._record(b) for b in self._bookings_starting(since, today) if b["confirmed"] != -1)
+        return [r for r in rows if r][::-1]
+
+    async def get_statistics(self, since: str, until: str | None = None) -> dict:
+        # Те же дни, что у daily_stats в SQLite, но прямым подсчётом
+        until = until or "9999-12-30"
+        end = db.to_ts(datetime.strptime(until, "%Y-%m-%d") + timedelta(days=1))
+        sessions = list(self._bookings_starting(since, end))
+        return {
+            "new_users": sum(
+                1 for u in self.users.values()
+                if u["is_registered"] == 1 and since <= (u["registration_date"] or "")[:10] <= until
+            ),
+            "total_bookings": len(sessions),
+            "canceled": sum(1 for b in sessions if b["confirmed"] == -1),
+            "attended": sum(1 for b in sessions if b["confirmed"] == 2),
+            "bought": sum(1 for p in self.purchases.values() if since <= p["timestamp"][:10] <= until),
+        }
+
+    async def rebuild_daily_stats(self):
+        pass  # сводки нет, статистика считается по данным
+
+    # --- Аренды: в памяти одного процесса конкурентов нет, но семантика та же
+
+    async def acquire_lease(self, name: str, holder: str, ttl: float) -> bool:
+        now = time.time()
+        current = self.leases.get(name)
+        if current and current[0] != holder and current[1] >= now:
+            return False
+        self.leases[name] = (holder, now + ttl)
+        return True
+
+    async def release_lease(self, name: str, holder: str):
+        if self.leases.get(name, (None,))[0] == holder:
+            del self.leases[name]
+
+    # --- Рассылки
+
+    def _audience(self, segment: str, after_id: int = 0):
+        now = datetime.now()
+        for telegram_id in sorted(self.users):
+            user = self.users[telegram_id]
+            if telegram_id <= after_id or user["is_registered"] != 1 or user["blocked_at"] is not None:
+                continue
+            if segments.matches(segment, user, [self.bookings[i] for i in self._user_bookings.get(telegram_id, ())], now):
+                yield telegram_id
+
+    async def count_audience(self, segment: str) -> int:
+        return sum(1 for _ in self._audience(segment))
+
+    async def create_broadcast(self, admin_id: int, text: str, status_chat_id: int, status_message_id: int,
+                               segment: str = "all", source_chat_id: int | None = None,
+                               source_message_id: int | None = None) -> dict:
+        broadcast_id = self._next_id("broadcasts")
+        self.broadcasts[broadcast_id] = {
+            "id": broadcast_id, "admin_id": admin_id, "text": text, "status": "running", "cursor": 0,
+            "total": await self.count_audience(segment),
+            "sent": 0, "failed": 0, "status_chat_id": status_chat_id, "status_message_id": status_message_id,
+            "created_at": db.to_ts(datetime.now()), "finished_at": None,
+            "segment": segment, "source_chat_id": source_chat_id, "source_message_id": source_message_id,
+        }
+        return dict(self.broadcasts[broadcast_id])
+
+    async def get_broadcast(self, broadcast_id: int) -> dict | None:
+        broadcast = self.broadcasts.get(broadcast_id)
+        return dict(broadcast) if broadcast else None
+
+    async def get_running_broadcasts(self) -> list[dict]:
+        return [dict(b) for _, b in sorted(self.broadcasts.items()) if b["status"] == "running"]
+
+    async def get_broadcast_recipients(self, after_id: int, limit: int, segment: str = "all") -> list[int]:
+        return list(itertools.islice(self._audience(segment, after_id), limit))
+
+    async def advance_broadcast(self, broadcast_id: int, cursor: int, sent: int, failed: int):
+        broadcast = self.broadcasts.get(broadcast_id)
+        if broadcast:
+            broadcast["cursor"] = cursor
+            broadcast["sent"] += sent
+            broadcast["failed"] += failed
+
+    async def set_broadcast_status(self, broadcast_id: int, status: str) -> bool:
+        broadcast = self.broadcasts.get(broadcast_id)
+        if not broadcast or broadcast["status"] not in db.BROADCAST_TRANSITIONS[status]:
+            return False
+        broadcast["status"] = status
+        broadcast["finished_at"] = db.to_ts(datetime.now()) if status in ("done", "cancelled") else None
+        return True
+
+    # --- Магазин и покупки
+
+    async def get_all_shop_items(self) -> list[dict]:
+        return [dict(item) for item in self.shop_items.values()]
+
+    async def add_shop_item(self, name: str, description: str, price: int):
+        item_id = self._next_id("shop_items")
+        self.shop_items[item_id] = {"id": item_id, "name": name, "description": description, "price": price}
+
+    async def update_shop_item(self, item_id: int, field: str, value):
+        if field not in db.SHOP_ITEM_FIELDS:
+            raise ValueError(f"Unknown shop item field: {field}")
+        if item_id in self.shop_items:
+            self.shop_items[item_id][field] = value
+
+    async def delete_shop_item(self, item_id: int) -> str | None:
+        item = self.shop_items.pop(item_id, None)
+        return item["name"] if item else None
+
+    async def purchase_item(self, user_id, item_id) -> tuple[bool, str]:
+        item = self.shop_items.get(item_id)
+        if not item:
+            return False, "❌ Товар не найден."
+        name, price = item["name"], item["price"]
+        if self._debit(user_id, price, "purchase", f"Покупка: {name}") is None:
+            return False, "❌ Недостаточно монет."
+
+        purchase = {
+            "id": self._next_id("purchases"),
+            "telegram_id": user_id,
+            "shop_item_id": item_id,
+            "code": db.generate_code(),
+            "status": "active",
+            "timestamp": datetime.now().strftime(db.TS_FORMAT),
+        }
+        self.purchases[purchase["id"]] = purchase
+        self._user_purchases[user_id].append(purchase["id"])
+        return True, f"✅ Вы купили '{name}' за {price} монет."
+
+    def _purchases_with_items(self, telegram_id: int, active_only: bool) -> list[dict]:
+        rows = []
+        for purchase_id in self._user_purchases.get(telegram_id, ()):
+            p = self.purchases[purchase_id]
+            item = self.shop_items.get(p["shop_item_id"])
+            if not item or (active_only and p["status"] != "active"):
+                continue
+            rows.append({
+                "id": p["id"], "shop_item_id": p["shop_item_id"], "code": p["code"], "status": p["status"],
+                "timestamp": p["timestamp"], "name": item["name"], "description": item["description"],
+            })
+        return sorted(rows, key=lambda r: r["timestamp"], reverse=True)
+
+    async def get_active_purchases(self, user_id: int) -> list[dict]:
+        return self._purchases_with_items(user_id, active_only=True)
+
+    async def get_user_purchases(self, telegram_id: int) -> list[dict]:
+        return self._purchases_with_items(telegram_id, active_only=False)
+
+    async def mark_purchase_as_used(self, purchase_id: int):
+        purchase = self.purchases.get(purchase_id)
+        if purchase:
+            purchase["status"] = "used"
+
+    # --- Экспорт
+
+    def _fetch_table(self, table: str) -> tuple[list[str], list[tuple]]:
+        sources = {
+            "users": (USER_COLUMNS, self.users.values()),
+            "bookings": (BOOKING_COLUMNS, self.bookings.values()),
+            "purchases": (PURCHASE_COLUMNS, self.purchases.values()),
+            "coin_history": (HISTORY_COLUMNS, self.coin_history),
+        }
+        if table not in sources:
+            raise ValueError(f"Unknown table: {table}")
+        columns, rows = sources[table]
+        return list(columns), [tuple(row[c] for c in columns) for row in rows]
+
+    async def _export(self, fmt: str, title: str, columns: list[str], rows: list[tuple]) -> dict:
+        # Снимок строк берётся в event loop, файл пишется в потоке; кэша
+        # по версиям здесь нет — данные и так в памяти
+        path, count = await asyncio.to_thread(exporter.write_file, fmt, title, columns, [rows])
+        last_id = rows[-1][columns.index("id")] if rows and "id" in columns else None
+        return {"path": path, "rows": count, "last_id": last_id, "cached": False}
+
+    async def export_table(self, table: str, fmt: str, after_id: int | None = None) -> dict:
+        if after_id is not None and table not in exporter.DELTA_QUERIES:
+            raise ValueError(f"Unknown table: {table}")
+        columns, rows = self._fetch_table(table)
+        if after_id is not None:
+            rows = [row for row in rows if row[0] > after_id]
+            table = f"{table}_new"
+        return await self._export(fmt, table, columns, rows)
+
+    async def export_report(self, report: str, fmt: str, start: str, end: str) -> dict:
+        if report not in exporter.REPORTS:
+            raise ValueError(f"Unknown report: {report}")
+        columns = ["id", "date", "time_from", "time_to", "tariff", "confirmed", "attended",
+                   "telegram_id", "full_name", "username", "phone"]
+        rows = []
+        for b in self._bookings_starting(start, end):
+            user = self.users.get(b["telegram_id"]) or {}
+            rows.append(tuple(b[c] for c in columns[:8]) + tuple(user.get(c) for c in columns[8:]))
+        return await self._export(fmt, report, columns, rows)
+
+    async def get_table_version(self, table: str) -> int | None:
+        return None
+
+    async def get_export_watermark(self, table: str) -> int | None:
+        return self.export_watermarks.get(table)
+
+    async def set_export_watermark(self, table: str, last_id: int):
+        if last_id > self.export_watermarks.get(table, 0):
+            self.export_watermarks[table] = last_id
@@ -0,0 +1,294 @@
+import asyncio
+import contextvars
+import functools
+import logging
+import os
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+import exporter
+import workers
+import occupancy
+from cache import profiles
+from storage.base import Storage
+
+# Вся работа с SQLite выполняется в отдельном потоке с долгоживущим
+# соединением, поэтому event loop не ждёт диск ни в хендлерах, ни в notifier
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+
+# Тяжёлое чтение (выгрузки, статистика, списки записей) — отдельный пул
+# read-only соединений, чтобы не стоять в очереди с записями пользователей
+READ_POOL_SIZE = int(os.getenv("DB_READ_POOL_SIZE", 2))
+_readers = ThreadPoolExecutor(max_workers=READ_POOL_SIZE, thread_name_prefix="db-read")
+
+# Запросы сессий апдейтов (db.Session) идут в свой пул, а не в общий поток
+# записи. Блокировку записи сессия берёт только перед первой записью и держит
+# до конца хендлера; ждут её в event loop (SQLiteStorage._write_lock),
+# а не в busy-wait SQLite на потоке пула
+SESSION_POOL_SIZE = int(os.getenv("DB_SESSION_POOL_SIZE", 4))
+_sessions = ThreadPoolExecutor(max_workers=SESSION_POOL_SIZE, thread_name_prefix="db-session")
+
+CHECKPOINT_INTERVAL = 60
+
+
+async def _run(executor, func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    call = functools.partial(ctx.run, func, *args, **kwargs)
+    return await loop.run_in_executor(executor, call)
+
+
+async def run_db(func, *args, **kwargs):
+    session = db.current_session.get()
+    if session is None:
+        return await _run(_executor, func, *args, **kwargs)
+    session.calls_in_flight += 1
+    try:
+        return await _run(_sessions, func, *args, **kwargs)
+    finally:
+        session.calls_in_flight -= 1
+
+
+async def run_read(func, *args, **kwargs):
+    return await _run(_readers, func, *args, **kwargs)
+
+
+def _write_in_session(session: db.Session, func, *args, **kwargs):
+    session.begin_write()
+    return func(*args, **kwargs)
+
+
+def _query(func):
+    # Чтение через соединение записи (в сессии — её снимок), без блокировки записи
+    @functools.wraps(func)
+    async def method(self, *args, **kwargs):
+        return await run_db(func, *args, **kwargs)
+    return method
+
+
+def _write(func):
+    # Метод хранилища, который пишет: под блокировкой записи процесса
+    @functools.wraps(func)
+    async def method(self, *args, **kwargs):
+        return await self.run_write(func, *args, **kwargs)
+    return method
+
+
+def _read(func):
+    @functools.wraps(func)
+    async def method(self, *args, **kwargs):
+        return await run_read(func, *args, **kwargs)
+    return method
+
+
+class SQLiteStorage(Storage):
+    """Хранилище по умолчанию: db.py поверх SQLite в WAL."""
+
+    name = "sqlite"
+
+    def __init__(self):
+        # Пишет одна сессия (или один запрос вне сессии) за раз: остальные
+        # ждут здесь, не занимая потоков пулов и не упираясь в таймаут SQLite
+        self._write_lock = asyncio.Lock()
+
+    async def run_write(self, func, *args, **kwargs):
+        session = db.current_session.get()
+        if session is None:
+            async with self._write_lock:
+                return await _run(_executor, func, *args, **kwargs)
+        session.calls_in_flight += 1
+        try:
+            if session.write_lock is None:
+                # Захват — отдельной задачей: параллельные вызовы одной сессии ждут его же
+                session.write_lock = asyncio.ensure_future(self._write_lock.acquire())
+            await asyncio.shield(session.write_lock)
+            return await _run(_sessions, _write_in_session, session, func, *args, **kwargs)
+        finally:
+            session.calls_in_flight -= 1
+
+    def _release_write(self, lock: asyncio.Future | None):
+        if lock is None:
+            return
+        if not lock.done():
+            lock.cancel()
+        elif not lock.cancelled() and lock.exception() is None:
+            self._write_lock.release()
+
+    async def init(self):
+        await run_db(db.init_db)
+
+    async def maintain(self, interval: int = CHECKPOINT_INTERVAL):
+        # Периодический PASSIVE checkpoint в потоке записи: не ждёт читателей
+        # и не попадает на пользовательские коммиты
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                busy, log, done = await run_db(db.checkpoint)
+                logging.debug("WAL checkpoint: busy=%s log=%s done=%s", busy, log, done)
+            except Exception:
+                logging.exception("WAL checkpoint failed")
+
+    async def close(self):
+        await asyncio.to_thread(self.shutdown)
+
+    @asynccontextmanager
+    async def session(self):
+        session = db.Session()
+        token = db.current_session.set(session)
+        try:
+            yield self
+        except BaseException:
+            if session.conn is not None:
+                await _run(_sessions, session.close, False)
+            raise
+        else:
+            # Апдейт, обошедшийся кэшем и пулом чтения, не берёт ни соединения, ни коммита
+            if session.conn is not None:
+                await _run(_sessions, session.close, True)
+            for callback in session.committed_callbacks:
+                callback()
+        finally:
+            # Блокировка записи отпускается только после COMMIT/ROLLBACK
+            lock, session.write_lock = session.write_lock, None
+            self._release_write(lock)
+            db.current_session.reset(token)
+
+    async def begin_write(self):
+        if db.current_session.get() is not None:
+            await self.run_write(lambda: None)
+
+    async def commit(self):
+        session = db.current_session.get()
+        # Пока идёт запрос той же сессии, соединение занято — зафиксирует close()
+        if session is None or not session.writing or session.calls_in_flight:
+            return
+        # Новые записи сессии встанут в очередь за блокировкой, пока идёт COMMIT
+        lock, session.write_lock = session.write_lock, None
+        try:
+            await _run(_sessions, session.close, True)
+        finally:
+            self._release_write(lock)
+        callbacks, session.committed_callbacks = session.committed_callbacks, []
+        for callback in callbacks:
+            callback()
+
+    async def on_commit(self, callback):
+        session = db.current_session.get()
+        if session is None:
+            callback()
+        else:
+            session.committed_callbacks.append(callback)
+
+    def shutdown(self):
+        # Дожидаемся уже поставленных в очередь запросов и закрываем соединение
+        _readers.shutdown(wait=True)
+        _sessions.shutdown(wait=True)
+        _executor.submit(db.checkpoint, "TRUNCATE")
+        _executor.submit(db.close_db_connection)
+        _executor.shutdown(wait=True)
+
+    # Пользователи. Профиль из кэша отдаётся прямо в event loop, без похода
+    # в поток БД; промах кэша заполняет его там же, где идут записи
+    async def get_user(self, user_id: int) -> dict | None:
+        cached = profiles.get(user_id)
+        if cached is not None:
+            return dict(cached)
+        return await run_db(db.get_user, user_id)
+
+    async def start_user(self, telegram_id: int, full_name: str, username: str,
+                         inviter_id: int | None = None) -> dict:
+        # Вернувшийся пользователь без реферальной ссылки — ноль запросов
+        cached = profiles.get(telegram_id)
+        if cached is not None and not inviter_id and cached["blocked_at"] is None:
+            return {"is_new": False, "invited": False, "inviter_username": None, "user": dict(cached)}
+        return await self.run_write(db.start_user, telegram_id, full_name, username, inviter_id)
+
+    get_user_by_username = _query(db.get_user_by_username)
+    add_user = _write(db.add_user)
+    set_invited_by = _write(db.set_invited_by)
+    add_user_after_register = _write(db.add_user_after_register)
+    touch_users = _write(db.touch_users)
+    mark_user_blocked = _write(db.mark_user_blocked)
+    get_referral_count = _query(db.get_referral_count)
+    add_referral_bonus = _write(db.add_referral_bonus)
+    add_referral_reward = _write(db.add_referral_reward)
+
+    # Монеты
+    update_user_coins = _write(db.update_user_coins)
+    adjust_user_coins = _write(db.adjust_user_coins)
+    apply_coin_operations = _write(db.apply_coin_operations)
+    get_coin_history = _query(db.get_coin_history)
+
+    # Записи. Занятость дня из индекса отдаётся прямо в event loop;
+    # промах строит маску на read-only соединении
+    async def get_day_occupancy(self, date: str) -> int:
+        if db.occupancy_shared():
+            mask = occupancy.slots.get(date)
+            if mask is not None:
+                return mask
+            return await run_read(db.get_day_occupancy, date)
+        return await run_db(db.get_day_occupancy, date)
+
+    # Перед add_booking хендлер берёт begin_write(): проверка и вставка
+    # в одной транзакции записи
+    get_booked_slots = _query(db.get_booked_slots)
+    add_booking = _write(db.add_booking)
+    get_booking = _query(db.get_booking)
+    get_user_bookings = _query(db.get_user_bookings)
+    get_user_bookings_by_status = _query(db.get_user_bookings_by_status)
+    set_booking_status = _write(db.set_booking_status)
+    cancel_user_booking = _write(db.cancel_user_booking)
+    get_upcoming_user_bookings = _query(db.get_upcoming_user_bookings)
+    get_bookings_in_range = _query(db.get_bookings_in_range)
+    get_finished_confirmed_bookings = _query(db.get_finished_confirmed_bookings)
+    get_last_booking_id = _query(db.get_last_booking_id)
+    get_new_bookings = _query(db.get_new_bookings)
+    claim_notification = _write(db.claim_notification)
+    release_notification = _write(db.release_notification)
+    get_future_records = _read(db.get_future_records)
+    get_past_records = _read(db.get_past_records)
+    get_statistics = _read(db.get_statistics)
+    rebuild_daily_stats = _write(db.rebuild_daily_stats)
+
+    # Аренды
+    acquire_lease = _write(db.acquire_lease)
+    release_lease = _write(db.release_lease)
+
+    # Рассылки
+    count_audience = _read(db.count_audience)
+    create_broadcast = _write(db.create_broadcast)
+    get_broadcast = _query(db.get_broadcast)
+    get_running_broadcasts = _query(db.get_running_broadcasts)
+    get_broadcast_recipients = _read(db.get_broadcast_recipients)
+    advance_broadcast = _write(db.advance_broadcast)
+    set_broadcast_status = _write(db.set_broadcast_status)
+
+    # Магазин и покупки
+    get_all_shop_items = _query(db.get_all_shop_items)
+    add_shop_item = _write(db.add_shop_item)
+    update_shop_item = _write(db.update_shop_item)
+    delete_shop_item = _write(db.delete_shop_item)
+    purchase_item = _write(db.purchase_item)
+    get_active_purchases = _query(db.get_active_purchases)
+    get_user_purchases = _query(db.get_user_purchases)
+    mark_purchase_as_used = _write(db.mark_purchase_as_used)
+
+    # Экспорт
+    get_table_version = _read(db.get_table_version)
+    get_export_watermark = _read(db.get_export_watermark)
+    set_export_watermark = _write(db.set_export_watermark)
+
+    async def export_table(self, table: str, fmt: str, after_id: int | None = None) -> dict:
+        if after_id is None:
+            # Таблица не менялась с прошлой выгрузки — готовый файл, без рабочего процесса
+            version = await self.get_table_version(table)
+            cached = exporter.cached_export(table, fmt, version) if version is not None else None
+            if cached is not None:
+                return cached
+        # Свой процесс со своим read-only соединением: курсор, кодирование
+        # и сжатие не делят GIL с event loop
+        return await workers.run(exporter.export_table, db.DB_NAME, table, fmt, after_id)
+
+    async def export_report(self, report: str, fmt: str, start: str, end: str) -> dict:
+        return await workers.run(exporter.export_report, db.DB_NAME, report, fmt, start, end)
@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Coroutine
+
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+HEALTHY_AFTER = 60.0  # проработала столько без ошибок — backoff сбрасывается
+SHUTDOWN_TIMEOUT = 10.0
+
+
+class _Job:
+    def __init__(self, name: str, factory: Callable[[], Awaitable[None]]):
+        self.name = name
+        self.factory = factory
+        self.task: asyncio.Task | None = None
+        self.state = "starting"
+        self.restarts = 0
+        self.last_error: str | None = None
+        self.started_at: float | None = None
+
+
+class Supervisor:
+    """Фоновые задачи бота под присмотром.
+
+    spawn() перезапускает упавшую задачу с экспоненциальной задержкой,
+    track() отмечает единицу работы в процессе (отправку, запись), которую
+    при остановке надо довести до конца, а не оборвать. shutdown() сначала
+    останавливает циклы, затем ждёт незавершённую работу не дольше таймаута.
+    """
+
+    def __init__(self):
+        self._jobs: dict[str, _Job] = {}
+        self._inflight: set[asyncio.Task] = set()
+        self._stopping = False
+
+    def spawn(self, name: str, factory: Callable[[], Awaitable[None]]):
+        if name in self._jobs:
+            raise ValueError(f"Job {name} is already running")
+        job = self._jobs[name] = _Job(name, factory)
+        job.task = asyncio.create_task(self._supervise(job), name=f"supervised:{name}")
+
+    async def _supervise(self, job: _Job):
+        failures = 0
+        while not self._stopping:
+            job.state = "running"
+            job.started_at = time.monotonic()
+            try:
+                await job.factory()
+            except asyncio.CancelledError:
+                job.state = "stopped"
+                raise
+            except Exception as e:
+                if time.monotonic() - job.started_at >= HEALTHY_AFTER:
+                    failures = 0
+                failures += 1
+                job.restarts += 1
+                job.last_error = f"{type(e).__name__}: {e}"
+                delay = min(BACKOFF_BASE * 2 ** (failures - 1), BACKOFF_MAX)
+                logging.exception("Job %s crashed, restarting in %.0fs", job.name, delay)
+                job.state = "backoff"
+                await asyncio.sleep(delay)
+            else:
+                job.state = "finished"
+                return
+
+    def track(self, coro: Coroutine[Any, Any, Any]) -> Awaitable[Any]:
+        # Отмена ожидающего не прерывает саму работу: её дождётся shutdown()
+        task = asyncio.create_task(coro)
+        self._inflight.add(task)
+        task.add_done_callback(self._inflight.discard)
+        return asyncio.shield(task)
+
+    def health(self) -> dict[str, dict]:
+        now = time.monotonic()
+        return {
+            name: {
+                "state": job.state,
+                "restarts": job.restarts,
+                "last_error": job.last_error,
+                "uptime": round(now - job.started_at) if job.state == "running" else 0,
+            }
+            for name, job in self._jobs.items()
+        }
+
+    async def shutdown(self, timeout: float = SHUTDOWN_TIMEOUT):
+        self._stopping = True
+        tasks = [job.task for job in self._jobs.values() if job.task and not job.task.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        if self._inflight:
+            logging.info("Waiting for %s in-flight tasks", len(self._inflight))
+            done, pending = await asyncio.wait(self._inflight, timeout=timeout)
+            for task in pending:
+                logging.warning("Cancelling unfinished task %r", task)
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+
+supervisor = Supervisor()
@@ -0,0 +1,39 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# Тяжёлая по CPU работа (выгрузки, отчёты, графики) — в отдельных процессах:
+# ни event loop, ни GIL процесса бота она не занимает. Функции и аргументы
+# должны сериализоваться pickle, поэтому передаём путь к БД, а не соединение
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", 2))
+
+_pool: ProcessPoolExecutor | None = None
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # spawn, а не fork: копия процесса с потоками БД и event loop небезопасна
+        _pool = ProcessPoolExecutor(max_workers=WORKER_PROCESSES, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+async def run(func, *args):
+    global _pool
+    pool = _get_pool()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(pool, func, *args)
+    except BrokenProcessPool:
+        # Рабочий процесс убит (например, по памяти) — следующий вызов создаст новый пул
+        if _pool is pool:
+            _pool = None
+        raise
+
+
+def shutdown():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=True, cancel_futures=True)
+        _pool = None